@@ -0,0 +1,319 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+import weakref
+from typing import Callable, Dict, Iterable, Optional, Union
+
+import numpy as np
+import torch
+
+from pyrocov.util import atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Attributes of argparse namespaces that never affect results.
+DEFAULT_IGNORE = frozenset(
+    ["debug", "force", "jobs", "log_every", "no_cache", "no_new", "test"]
+)
+
+# Maps id(tensor) -> (weakref, version, digest), so that large tensors like
+# datasets are hashed only once, even when passed to many cached functions.
+_TENSOR_DIGESTS: Dict[int, tuple] = {}
+
+
+def _tensor_digest(x: torch.Tensor) -> bytes:
+    key = id(x)
+    cached = _TENSOR_DIGESTS.get(key)
+    if cached is not None and cached[0]() is x and cached[1] == x._version:
+        return cached[2]
+    h = hashlib.sha256()
+    h.update(f"{x.dtype} {x.layout} {tuple(x.shape)}".encode())
+    if x.is_sparse:
+        x_ = x.detach().coalesce()
+        parts = [x_.indices(), x_.values()]
+    else:
+        parts = [x.detach()]
+    for part in parts:
+        part = part.cpu().contiguous().reshape(-1)
+        h.update(part.view(torch.uint8).numpy().tobytes())
+    digest = h.digest()
+    ref = weakref.ref(x, lambda _: _TENSOR_DIGESTS.pop(key, None))
+    _TENSOR_DIGESTS[key] = ref, x._version, digest
+    return digest
+
+
+def _update_hash(h, x, ignore: frozenset) -> None:
+    """
+    Updates a hash with a canonical serialization of a nested value.
+    """
+    if x is None or isinstance(x, (bool, int, float, complex, str, bytes)):
+        h.update(f"{type(x).__name__}:{x!r};".encode())
+    elif isinstance(x, torch.Tensor):
+        h.update(b"tensor:")
+        h.update(_tensor_digest(x))
+    elif isinstance(x, np.ndarray):
+        h.update(f"ndarray:{x.dtype} {x.shape}:".encode())
+        h.update(np.ascontiguousarray(x).tobytes())
+    elif isinstance(x, (tuple, list)):
+        h.update(f"{type(x).__name__}:{len(x)}:".encode())
+        for value in x:
+            _update_hash(h, value, ignore)
+    elif isinstance(x, (set, frozenset)):
+        _update_hash(h, sorted(x, key=repr), ignore)
+    elif isinstance(x, dict):
+        h.update(f"dict:{len(x)}:".encode())
+        for key in sorted(x, key=repr):
+            _update_hash(h, key, ignore)
+            _update_hash(h, x[key], ignore)
+    elif isinstance(x, argparse.Namespace):
+        h.update(b"namespace:")
+        _update_hash(h, {k: v for k, v in vars(x).items() if k not in ignore}, ignore)
+    elif isinstance(x, torch.nn.Module):
+        h.update(f"module:{type(x).__qualname__}:".encode())
+        _update_hash(h, dict(x.state_dict()), ignore)
+    elif callable(x) and hasattr(x, "__qualname__"):
+        h.update(f"callable:{x.__module__}.{x.__qualname__};".encode())
+    else:
+        h.update(f"pickle:{type(x).__qualname__}:".encode())
+        h.update(pickle.dumps(x))
+
+
+def fingerprint(path: str) -> list:
+    """
+    Cheaply fingerprints a file or directory by the sizes and modification
+    times of its files.
+
+    :param str path: A file or directory path.
+    :rtype: list
+    """
+    if os.path.isdir(path):
+        result = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                result.extend(fingerprint(os.path.join(dirpath, name)))
+        return result
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return [(path, None, None)]
+    return [(path, stat.st_size, stat.st_mtime_ns)]
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of function results.
+
+    Results are keyed by a hash of a name, all function arguments, and
+    fingerprints of any input files. Results are written atomically, and
+    concurrent processes coordinate via file locks, so that each result is
+    computed at most once. A manifest records the size and access time of
+    each result, and least recently used results are evicted to keep the
+    total size within an optional disk budget.
+
+    :param str dirname: The directory in which to store results.
+    :param int max_bytes: An optional disk budget in bytes.
+    """
+
+    def __init__(self, dirname: str = "results/cache", *, max_bytes=None):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+
+    def key(
+        self,
+        name: str,
+        args: tuple = (),
+        kwargs: dict = {},
+        *,
+        files: Iterable[str] = (),
+        ignore: Iterable[str] = DEFAULT_IGNORE,
+    ) -> str:
+        """
+        Computes the content key of a function call.
+
+        :param str name: A name for the function.
+        :param tuple args: Positional arguments.
+        :param dict kwargs: Keyword arguments.
+        :param files: Names of input files or directories.
+        :param ignore: Names of :class:`argparse.Namespace` attributes to
+            ignore.
+        :returns: A hex digest.
+        :rtype: str
+        """
+        h = hashlib.sha256()
+        ignore = frozenset(ignore)
+        _update_hash(h, name, ignore)
+        _update_hash(h, args, ignore)
+        _update_hash(h, kwargs, ignore)
+        _update_hash(h, [fingerprint(f) for f in files], ignore)
+        return h.hexdigest()[:32]
+
+    def filename(self, name: str, key: str) -> str:
+        return os.path.join(self.dirname, f"{name}.{key}.pt")
+
+    @contextlib.contextmanager
+    def lock(self, name: str, *, blocking: bool = True):
+        """
+        Holds an exclusive inter-process lock on a name, yielding whether the
+        lock was acquired.
+        """
+        os.makedirs(self.dirname, exist_ok=True)
+        path = os.path.join(self.dirname, f"{name}.lock")
+        with open(path, "a") as f:
+            if fcntl is None:
+                yield True
+                return
+            flags = fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> Dict[str, dict]:
+        path = os.path.join(self.dirname, "manifest.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: Dict[str, dict]) -> None:
+        atomic_write(
+            os.path.join(self.dirname, "manifest.json"),
+            lambda f: f.write(json.dumps(manifest, indent=1).encode()),
+        )
+
+    def _touch(self, filename: str) -> None:
+        now = time.time()
+        with self.lock("manifest"):
+            manifest = self._read_manifest()
+            entry = manifest.setdefault(os.path.basename(filename), {})
+            entry["size"] = os.path.getsize(filename)
+            entry.setdefault("created", now)
+            entry["accessed"] = now
+            self._write_manifest(manifest)
+
+    def manifest(self) -> Dict[str, dict]:
+        """
+        Returns a dict mapping each result's basename to a dict with its
+        ``size`` in bytes and ``created`` and ``accessed`` timestamps.
+        """
+        with self.lock("manifest"):
+            return self._read_manifest()
+
+    def load(self, filename: str):
+        """
+        Loads a cached result, updating its access time.
+        """
+        logger.info(f"loading cached {filename}")
+        result = torch.load(filename, map_location=torch.empty(()).device)
+        self._touch(filename)
+        return result
+
+    def save(self, filename: str, result) -> None:
+        """
+        Atomically saves a result, then evicts old results if over budget.
+        """
+        logger.info(f"saving {filename}")
+        atomic_write(filename, lambda f: torch.save(result, f))
+        self._touch(filename)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=[filename])
+
+    def evict(self, max_bytes: int, *, keep: Iterable[str] = ()) -> int:
+        """
+        Removes least recently used results until their total size is at most
+        ``max_bytes``. Results currently being computed are never removed.
+
+        :param int max_bytes: A disk budget in bytes.
+        :param keep: Filenames of results not to remove.
+        :returns: The number of bytes freed.
+        :rtype: int
+        """
+        keep = {os.path.basename(f) for f in keep}
+        freed = 0
+        with self.lock("manifest"):
+            manifest = self._read_manifest()
+            for basename in list(manifest):
+                if not os.path.exists(os.path.join(self.dirname, basename)):
+                    del manifest[basename]  # removed externally
+            total = sum(e.get("size", 0) for e in manifest.values())
+            lru = sorted(manifest.items(), key=lambda kv: kv[1]["accessed"])
+            for basename, entry in lru:
+                if total <= max_bytes:
+                    break
+                if basename in keep:
+                    continue
+                with self.lock(basename[: -len(".pt")], blocking=False) as locked:
+                    if not locked:
+                        continue
+                    logger.info(f"evicting {basename}")
+                    os.remove(os.path.join(self.dirname, basename))
+                total -= entry.get("size", 0)
+                freed += entry.get("size", 0)
+                del manifest[basename]
+            self._write_manifest(manifest)
+        return freed
+
+    def cached(
+        self,
+        name: str,
+        *,
+        files: Optional[Union[Iterable[str], Callable]] = None,
+        ignore: Iterable[str] = DEFAULT_IGNORE,
+    ):
+        """
+        Decorator to cache results of a function whose first argument is an
+        :class:`argparse.Namespace`. The namespace's optional ``no_cache``,
+        ``force``, ``no_new``, and ``test`` flags respectively disable
+        caching, force recomputation, forbid computation, and disable saving.
+
+        :param str name: A name for the function, used in filenames.
+        :param files: Either a list of input file names or a function mapping
+            the decorated function's arguments to such a list.
+        :param ignore: Names of :class:`argparse.Namespace` attributes to
+            ignore, by default :data:`DEFAULT_IGNORE`.
+        """
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def cached_fn(*args, **kwargs):
+                options = args[0]
+                if getattr(options, "no_cache", False):
+                    return fn(*args, **kwargs)
+                input_files = files(*args, **kwargs) if callable(files) else files
+                key = self.key(
+                    name, args, kwargs, files=input_files or (), ignore=ignore
+                )
+                f = self.filename(name, key)
+                with self.lock(f"{name}.{key}"):
+                    if os.path.exists(f) and not getattr(options, "force", False):
+                        return self.load(f)
+                    if getattr(options, "no_new", False):
+                        raise ValueError(f"Missing {f}")
+                    result = fn(*args, **kwargs)
+                    if not getattr(options, "test", False):
+                        self.save(f, result)
+                return result
+
+            return cached_fn
+
+        return decorator
@@ -0,0 +1,176 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+A simple columnar on-disk format for the ``columns`` dicts produced by
+``scripts/preprocess_usher.py``.
+
+Each store is a directory containing one ``.npy`` file per numeric column and
+a pair of ``.codes.npy``, ``.categories.json`` files per string column. Arrays
+are loaded via ``np.load(..., mmap_mode="r")`` so that multiple processes
+share a single copy in the OS page cache.
+"""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+from pyrocov.util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Numeric columns and their on-disk dtypes.
+NUMERIC_DTYPES = {"day": np.int16}
+
+
+class DictionaryColumn:
+    """
+    A dictionary-encoded string column, with integer ``codes`` indexing into
+    a list of unique ``categories``.
+
+    :param np.ndarray codes: An int32 array of category ids.
+    :param list categories: A list of unique strings.
+    """
+
+    def __init__(self, codes: np.ndarray, categories: List[str]):
+        assert codes.dtype == np.int32
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def decode(self) -> List[str]:
+        """
+        Converts to a list of strings. This is expensive for long columns.
+        """
+        return [self.categories[i] for i in self.codes.tolist()]
+
+    @staticmethod
+    def encode(values: Sequence[str]) -> "DictionaryColumn":
+        categories: Dict[str, int] = {}
+        codes = np.fromiter(
+            (categories.setdefault(v, len(categories)) for v in values),
+            dtype=np.int32,
+            count=len(values),
+        )
+        return DictionaryColumn(codes, list(categories))
+
+
+Column = Union[np.ndarray, DictionaryColumn]
+
+
+def save_columnar(columns: dict, dirname: str) -> None:
+    """
+    Saves a dict of equal-length columns to a columnar store.
+
+    The store is written to a temporary directory and then renamed into
+    place, so an interrupted save leaves either the old store or none.
+
+    :param dict columns: A dict mapping column name to a list of ints or
+        strings, as produced by ``scripts/preprocess_usher.py``.
+    :param str dirname: The directory in which to save the store.
+    """
+    assert len(set(map(len, columns.values()))) == 1, "columns have unequal length"
+    parent = os.path.dirname(os.path.abspath(dirname))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp.")
+    try:
+        for name, values in columns.items():
+            if name in NUMERIC_DTYPES:
+                dtype = NUMERIC_DTYPES[name]
+                array = np.asarray(values)
+                info = np.iinfo(dtype)
+                assert info.min <= array.min() and array.max() <= info.max, name
+                np.save(os.path.join(tmp, f"{name}.npy"), array.astype(dtype))
+            else:
+                column = DictionaryColumn.encode(values)
+                np.save(os.path.join(tmp, f"{name}.codes.npy"), column.codes)
+                with open(os.path.join(tmp, f"{name}.categories.json"), "wt") as f:
+                    json.dump(column.categories, f)
+        # Directories cannot be atomically replaced, so first move aside.
+        if os.path.exists(dirname):
+            old = tempfile.mkdtemp(dir=parent, prefix=".old.")
+            os.replace(dirname, os.path.join(old, "store"))
+            os.replace(tmp, dirname)
+            shutil.rmtree(old)
+        else:
+            os.replace(tmp, dirname)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    logger.info(f"Saved {len(columns)} columns to {dirname}")
+
+
+def append_columns(filename: str, new_columns: dict, *, columnar: bool = True) -> int:
+    """
+    Appends rows to a pickled columns dict, skipping rows whose ``index`` is
+    already present. This is idempotent, so an interrupted update can simply
+    be rerun.
+
+    The pickle is replaced atomically and after its columnar store (named
+    after ``filename`` without extension), so it serves as the commit point.
+
+    :param str filename: The path of a pickled columns dict with an
+        ``index`` column.
+    :param dict new_columns: A dict with at least the same columns.
+    :param bool columnar: Whether to also rewrite the columnar store.
+    :returns: The number of rows appended.
+    :rtype: int
+    """
+    with open(filename, "rb") as f:
+        columns = pickle.load(f)
+    old_keys = frozenset(columns["index"])
+    rows = [i for i, key in enumerate(new_columns["index"]) if key not in old_keys]
+    if rows:
+        for k, v in columns.items():
+            v.extend(new_columns[k][i] for i in rows)
+        if columnar:
+            save_columnar(columns, os.path.splitext(filename)[0])
+        atomic_write(filename, lambda f: pickle.dump(columns, f))
+    logger.info(f"Appended {len(rows)} rows to {filename}")
+    return len(rows)
+
+
+def load_columnar(
+    dirname: str, names: Optional[Sequence[str]] = None, *, mmap: bool = True
+) -> Dict[str, Column]:
+    """
+    Loads a columnar store saved by :func:`save_columnar`.
+
+    :param str dirname: The directory of the store.
+    :param list names: An optional list of column names to load. Defaults to
+        all columns.
+    :param bool mmap: Whether to memory map arrays rather than reading them
+        into process memory.
+    :returns: A dict mapping column name to either a numeric ``np.ndarray`` or
+        a :class:`DictionaryColumn` .
+    :rtype: dict
+    """
+    if names is None:
+        names = sorted(
+            {
+                f.split(".")[0]
+                for f in os.listdir(dirname)
+                if f.endswith(".npy") and not f.startswith(".")
+            }
+        )
+    columns: Dict[str, Column] = {}
+    for name in names:
+        path = os.path.join(dirname, f"{name}.npy")
+        if os.path.exists(path):
+            columns[name] = np.load(path, mmap_mode="r" if mmap else None)
+            continue
+        path = os.path.join(dirname, f"{name}.codes.npy")
+        codes = np.load(path, mmap_mode="r" if mmap else None)
+        with open(os.path.join(dirname, f"{name}.categories.json")) as f:
+            categories = json.load(f)
+        columns[name] = DictionaryColumn(codes, categories)
+    assert len(set(map(len, columns.values()))) <= 1, "columns have unequal length"
+    return columns
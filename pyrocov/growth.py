@@ -68,26 +68,12 @@ def rank_loo_lineages(full_dataset: dict, min_samples: int = 50) -> List[str]:
     Compute a list of lineages ranked in descending order of cut size.
     This is used in growth rate leave-one-out prediction experiments.
     """
-
-    def get_parent(lineage):
-        lineage = pangolin.decompress(lineage)
-        parent = pangolin.get_parent(lineage)
-        if parent is not None:
-            parent = pangolin.compress(parent)
-        return parent
-
     # Compute sample counts.
     lineage_id_inv = full_dataset["lineage_id_inv"]
-    lineage_id = full_dataset["lineage_id"]
     lineage_counts = full_dataset["weekly_counts"].sum([0, 1])
-    descendent_counts = lineage_counts.clone()
-    for c, lineage in enumerate(lineage_id_inv):
-        ancestor = get_parent(lineage)
-        while ancestor is not None:
-            a = lineage_id.get(ancestor)
-            if a is not None:
-                descendent_counts[a] += lineage_counts[c]
-            ancestor = get_parent(ancestor)
+    descendent_counts = pangolin.LineageIndex(lineage_id_inv).subtree_sum(
+        lineage_counts
+    )
     total = lineage_counts.sum().item()
     cut_size = torch.min(descendent_counts, total - descendent_counts)
 
@@ -106,7 +92,14 @@ def dense_to_sparse(x):
     index = x.nonzero(as_tuple=False).T.contiguous()
     value = x[tuple(index)]
     total = x.sum(-1)
-    return {"index": index, "value": value, "total": total}
+    # Precompute the data-dependent part of the multinomial likelihood.
+    log_factorial = (total + 1).lgamma().sum() - (value + 1).lgamma().sum()
+    return {
+        "index": index,
+        "value": value,
+        "total": total,
+        "log_factorial": log_factorial,
+    }
 
 
 def load_nextstrain_data(
@@ -428,7 +421,10 @@ def model(dataset, model_type, *, forecast_steps=None):
         pyro.factor(
             "obs",
             sparse_multinomial_likelihood(
-                sparse_counts["total"], logits[t, p, c], sparse_counts["value"]
+                sparse_counts["total"],
+                logits[t, p, c],
+                sparse_counts["value"],
+                sparse_counts.get("log_factorial"),
             ),
         )
 
@@ -1,16 +1,18 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
+import contextlib
 import datetime
 import functools
 import logging
 import math
+import os
 import pickle
 import re
 import warnings
 from collections import Counter, OrderedDict, defaultdict
 from timeit import default_timer
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 import pyro
@@ -20,6 +22,7 @@ import tqdm
 from pyro import poutine
 from pyro.infer import SVI, JitTrace_ELBO, Trace_ELBO
 from pyro.infer.autoguide import (
+    AutoContinuous,
     AutoDelta,
     AutoGuideList,
     AutoLowRankMultivariateNormal,
@@ -32,12 +35,17 @@ from pyro.nn.module import PyroModule, PyroParam
 from pyro.ops.streaming import CountMeanVarianceStats, StatsOfDict
 from pyro.optim import ClippedAdam
 from pyro.poutine.util import site_is_subsample
-from torch.distributions import constraints
+from torch.distributions import biject_to, constraints, transform_to
 
 import pyrocov.geo
 
 from . import pangolin, sarscov2
-from .ops import sparse_multinomial_likelihood
+from .columnar import DictionaryColumn, load_columnar
+from .ops import (
+    linear_logsumexp,
+    segment_logsumexp,
+    sparse_multinomial_likelihood,
+)
 from .util import pearson_correlation, quotient_central_moments
 
 # Requires https://github.com/pyro-ppl/pyro/pull/2953
@@ -66,13 +74,22 @@ def get_fine_regions(columns, min_samples):
     Remaining regions will be coarsely aggregated up to country level.
     """
     # Count number of samples in each subregion.
+    locations = columns["location"]
+    if isinstance(locations, DictionaryColumn):
+        # Count each unique location string once.
+        location_counts = np.bincount(
+            locations.codes, minlength=len(locations.categories)
+        )
+        locations = Counter(dict(zip(locations.categories, location_counts.tolist())))
+    else:
+        locations = Counter(locations)
     counts = Counter()
-    for location in columns["location"]:
+    for location, count in locations.items():
         parts = location.split("/")
         if len(parts) < 2:
             continue
         parts = tuple(p.strip() for p in parts[:3])
-        counts[parts] += 1
+        counts[parts] += count
 
     # Select fine countries.
     return frozenset(parts for parts, count in counts.items() if count >= min_samples)
@@ -83,31 +100,15 @@ def rank_loo_lineages(full_dataset: dict, min_samples: int = 50) -> List[str]:
     Compute a list of lineages ranked in descending order of cut size.
     This is used in growth rate leave-one-out prediction experiments.
     """
-
-    def get_parent(lineage):
-        lineage = pangolin.decompress(lineage)
-        parent = pangolin.get_parent(lineage)
-        if parent is not None:
-            parent = pangolin.compress(parent)
-        return parent
-
     # Compute sample counts.
     lineage_id_inv = full_dataset["lineage_id_inv"]
-    lineage_id = full_dataset["lineage_id"]
     clade_counts = full_dataset["weekly_clades"].sum([0, 1])
-    lineage_counts = clade_counts.new_zeros(len(lineage_id)).scatter_add_(
+    lineage_counts = clade_counts.new_zeros(len(lineage_id_inv)).scatter_add_(
         0, full_dataset["clade_id_to_lineage_id"], clade_counts
     )
-    weekly_clades = full_dataset["weekly_clades"]  # [T, P, C]
-    lineage_counts = weekly_clades.sum([0, 1])  # [C]
-    descendent_counts = lineage_counts.clone()
-    for c, lineage in enumerate(lineage_id_inv):
-        ancestor = get_parent(lineage)
-        while ancestor is not None:
-            a = lineage_id.get(ancestor)
-            if a is not None:
-                descendent_counts[a] += lineage_counts[c]
-            ancestor = get_parent(ancestor)
+    descendent_counts = pangolin.LineageIndex(lineage_id_inv).subtree_sum(
+        lineage_counts
+    )
     total = lineage_counts.sum().item()
     cut_size = torch.min(descendent_counts, total - descendent_counts)
 
@@ -122,11 +123,36 @@ def rank_loo_lineages(full_dataset: dict, min_samples: int = 50) -> List[str]:
     return [name for gap, name in ranked_lineages]
 
 
+def load_columns(filename: str) -> dict:
+    """
+    Loads the columns needed by :func:`load_gisaid_data`, either from a
+    pickled dict of lists or from a memory-mapped columnar store saved by
+    :func:`pyrocov.columnar.save_columnar`.
+    """
+    if os.path.isdir(filename):
+        return load_columnar(filename, ["day", "location", "clade"])
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def _factorize(column) -> DictionaryColumn:
+    if isinstance(column, DictionaryColumn):
+        return column
+    return DictionaryColumn.encode(column)
+
+
 def dense_to_sparse(x):
     index = x.nonzero(as_tuple=False).T.contiguous()
     value = x[tuple(index)]
     total = x.sum(-1)
-    return {"index": index, "value": value, "total": total}
+    # Precompute the data-dependent part of the multinomial likelihood.
+    log_factorial = (total + 1).lgamma().sum() - (value + 1).lgamma().sum()
+    return {
+        "index": index,
+        "value": value,
+        "total": total,
+        "log_factorial": log_factorial,
+    }
 
 
 def load_gisaid_data(
@@ -139,6 +165,7 @@ def load_gisaid_data(
     columns_filename="results/usher.columns.pkl",
     features_filename="results/usher.features.pt",
     feature_type="aa",
+    sparse_features=False,
 ) -> dict:
     """
     Loads the two files columns_filename and features_filename,
@@ -149,10 +176,14 @@ def load_gisaid_data(
     :param dict include: filters of data to include
     :param dict exclude: filters of data to exclude
     :param end_day: last day to include
-    :param str columns_filename:
+    :param str columns_filename: Either a pickled dict of columns or the
+        directory of a columnar store, see :func:`load_columns`.
     :param str features_filename:
     :param str feature_type: Either "aa" for amino acid features or "nuc" for
         nucleotide features.
+    :param bool sparse_features: Whether to represent ``features`` as a sparse
+        COO tensor rather than a dense tensor. Features may be stored in
+        either layout in ``features_filename``.
     :returns: A dataset dict
     :rtype: dict
     """
@@ -164,8 +195,7 @@ def load_gisaid_data(
         logger.info(f"Load gisaid data end_day: {end_day}")
 
     # Load column data.
-    with open(columns_filename, "rb") as f:
-        columns = pickle.load(f)
+    columns = load_columns(columns_filename)
     logger.info(f"Training on {len(columns['day'])} rows with columns:")
     logger.info(", ".join(columns.keys()))
 
@@ -175,9 +205,12 @@ def load_gisaid_data(
     # Filter features into numbers of mutations and possibly genes.
     usher_features = torch.load(features_filename)
     mutations = usher_features[f"{feature_type}_mutations"]
-    features = usher_features[f"{feature_type}_features"].to(
-        device=device, dtype=torch.get_default_dtype()
-    )
+    features = usher_features[f"{feature_type}_features"]
+    if sparse_features:
+        features = features.to_sparse() if not features.is_sparse else features
+    elif features.is_sparse:
+        features = features.to_dense()
+    features = features.to(device=device, dtype=torch.get_default_dtype())
     keep = [m.count(",") == 0 for m in mutations]  # restrict to single mutations
     if include.get("gene"):
         re_gene = re.compile(include.pop("gene"))
@@ -200,52 +233,66 @@ def load_gisaid_data(
                 keep[i] = False
     mutations = [m for k, m in zip(keep, mutations) if k]
     if mutations:
-        features = features[:, keep]
+        keep_ids = torch.tensor(keep, device=device).nonzero(as_tuple=True)[0]
+        features = features.index_select(1, keep_ids)
     else:
         warnings.warn("No mutations selected; using empty features")
         mutations = ["S:D614G"]  # bogus
-        features = features[:, :1] * 0
+        features = features.index_select(1, torch.tensor([0], device=device)) * 0
     logger.info("Loaded {} feature matrix".format(" x ".join(map(str, features.shape))))
 
     # Construct the list of clades.
     clade_id_inv = usher_features["clades"]
     clade_id = {k: i for i, k in enumerate(clade_id_inv)}
-    clades = columns["clade"]
 
-    # Generate sparse_data.
-    sparse_data: dict = Counter()
+    # Factorize columns so that filters are evaluated once per unique value.
+    days = np.asarray(columns["day"], dtype=np.int64)
+    factors = {
+        "location": _factorize(columns["location"]),
+        "clade": _factorize(columns["clade"]),
+    }
+    num_rows = len(days)
+    keep = np.ones(num_rows, dtype=bool)
+
+    # Filter out unsampled clades.
+    clades = factors["clade"]
+    clade_ids = np.array([clade_id.get(c, -1) for c in clades.categories], np.int64)
+    skipped_clades = [c for c, i in zip(clades.categories, clade_ids) if i < 0]
+    for clade in skipped_clades:
+        if not clade.startswith("fine"):
+            logger.warning(f"WARNING skipping unsampled clade {clade}")
+    logger.warning(f"WARNING skipped {len(skipped_clades)} unsampled clades")
+    clade_ids = clade_ids[clades.codes]
+    keep &= clade_ids >= 0
+
+    # Filter by include/exclude
+    for k, v in include.items():
+        column = factors[k]
+        mask = np.array([bool(re.search(v, x)) for x in column.categories], bool)
+        keep &= mask[column.codes]
+    for k, v in exclude.items():
+        column = factors[k]
+        mask = np.array([bool(re.search(v, x)) for x in column.categories], bool)
+        keep &= ~mask[column.codes]
+
+    # Filter by day
+    if end_day is not None:
+        keep &= days <= end_day
+
+    # Assign place ids to unique locations, in order of first appearance.
+    locations = factors["location"]
+    kept_rows = np.flatnonzero(keep)
+    location_codes = locations.codes[kept_rows]
+    unique_codes, first_rows = np.unique(location_codes, return_index=True)
     countries = set()
     states = set()
     state_to_country_dict = {}
     location_id: dict = OrderedDict()
-    skipped_clades = set()
-    num_obs = 0
-    for day, location, clade in zip(columns["day"], columns["location"], clades):
-        if clade not in clade_id:
-            if clade not in skipped_clades:
-                skipped_clades.add(clade)
-                if not clade.startswith("fine"):
-                    logger.warning(f"WARNING skipping unsampled clade {clade}")
-            continue
-
-        # Filter by include/exclude
-        row = {
-            "location": location,
-            "day": day,
-            "clade": clade,
-        }
-        if not all(re.search(v, row[k]) for k, v in include.items()):
-            continue
-        if any(re.search(v, row[k]) for k, v in exclude.items()):
-            continue
-
-        # Filter by day
-        if end_day is not None:
-            if day > end_day:
-                continue
-
+    place_ids = np.zeros(len(locations.categories), np.int64)
+    place_valid = np.zeros(len(locations.categories), bool)
+    for code in unique_codes[first_rows.argsort()].tolist():
         # preprocess parts
-        parts = location.split("/")
+        parts = locations.categories[code].split("/")
         if len(parts) < 2:
             continue
         parts = tuple(p.strip() for p in parts[:3])
@@ -263,13 +310,8 @@ def load_gisaid_data(
             states.add(location)
             p = location_id.setdefault(location, -len(states))
             state_to_country_dict[p] = c
-
-        # Save sparse data.
-        num_obs += 1
-        t = day // TIMESTEP
-        c = clade_id[clade]
-        sparse_data[t, p, c] += 1
-    logger.warning(f"WARNING skipped {len(skipped_clades)} unsampled clades")
+        place_ids[code] = p
+        place_valid[code] = True
     state_to_country = torch.full((len(states),), 999999, dtype=torch.long)
     for s, c in state_to_country_dict.items():
         state_to_country[s] = c
@@ -279,22 +321,25 @@ def load_gisaid_data(
         location_id_inv[i] = k
     assert all(location_id_inv)
 
-    # Generate weekly_clades tensor from sparse_data.
+    # Generate weekly_clades tensor via a single scatter_add_.
     if end_day is not None:
         T = 1 + end_day // TIMESTEP
     else:
-        T = 1 + max(columns["day"]) // TIMESTEP
+        T = 1 + int(days.max()) // TIMESTEP
     P = len(location_id)
     C = len(clade_id)
+    kept_rows = kept_rows[place_valid[location_codes]]
+    location_codes = locations.codes[kept_rows]
+    num_obs = len(kept_rows)
+    t = days[kept_rows] // TIMESTEP
+    p = place_ids[location_codes] % max(P, 1)  # states have negative ids
+    c = clade_ids[kept_rows]
     weekly_clades = torch.zeros(T, P, C)
-    for tps, n in sparse_data.items():
-        weekly_clades[tps] = n
+    tpc = torch.from_numpy((t * P + p) * C + c).to(weekly_clades.device)
+    weekly_clades.view(-1).scatter_add_(0, tpc, weekly_clades.new_ones(num_obs))
     logger.info(f"Dataset size [T x P x C] {T} x {P} x {C}")
 
-    logger.info(
-        f"Keeping {num_obs}/{len(clades)} rows "
-        f"(dropped {len(clades) - int(num_obs)})"
-    )
+    logger.info(f"Keeping {num_obs}/{num_rows} rows (dropped {num_rows - num_obs})")
 
     # Construct sparse representation.
     pc_index = weekly_clades.ne(0).any(0).reshape(-1).nonzero(as_tuple=True)[0]
@@ -378,7 +423,7 @@ def subset_gisaid_data(
         new["sparse_counts"] = dense_to_sparse(new["weekly_clades"])
 
     # Select mutations.
-    gaps = new["features"].max(0).values - new["features"].min(0).values
+    gaps = get_feature_gaps(new["features"])
     ids = (gaps >= 0.5).nonzero(as_tuple=True)[0]
     new["mutations"] = [new["mutations"][i] for i in ids.tolist()]
     new["features"] = new["features"].index_select(-1, ids)
@@ -399,6 +444,43 @@ def subset_gisaid_data(
     return new
 
 
+def make_loo_dataset(dataset: dict, heldout: List[List[int]]) -> dict:
+    """
+    Creates a batch of leave-one-out datasets that can be fit by a single
+    call to :func:`fit_svi`.
+
+    Each element of the batch is equivalent to zeroing out the counts of a
+    set of held-out clades, as in leave-one-lineage-out experiments. All
+    elements share the features, time grid, and ``pc_index`` of the full
+    dataset, and :func:`model` batches over them in a "loo" plate.
+
+    :param dict dataset: A dataset as returned by :func:`load_gisaid_data`.
+    :param list heldout: A list of ``K`` lists of clade ids to hold out.
+    :returns: A shallow copy of ``dataset`` with an additional ``[K, C]``
+        shaped boolean "loo_mask" of held-out clades and per-batch sparse
+        counts "loo_sparse_counts".
+    :rtype: dict
+    """
+    weekly_clades = dataset["weekly_clades"]  # [T, P, C]
+    K = len(heldout)
+    C = weekly_clades.size(-1)
+    loo_mask = torch.zeros(K, C, dtype=torch.bool, device=weekly_clades.device)
+    for k, ids in enumerate(heldout):
+        loo_mask[k, ids] = True
+    keep = (~loo_mask).to(weekly_clades.dtype)
+
+    # Precompute the data-dependent part of each multinomial likelihood.
+    t, p, c = dataset["sparse_counts"]["index"]
+    value = dataset["sparse_counts"]["value"] * keep[:, c]  # [K, N]
+    total = weekly_clades @ keep.T  # [T, P, K]
+    log_factorial = (total + 1).lgamma().sum([0, 1]) - (value + 1).lgamma().sum(-1)
+
+    dataset = dataset.copy()
+    dataset["loo_mask"] = loo_mask
+    dataset["loo_sparse_counts"] = {"value": value, "log_factorial": log_factorial}
+    return dataset
+
+
 def load_jhu_data(gisaid_data: dict) -> dict:
     """
     Load case count time series.
@@ -449,7 +531,208 @@ def load_jhu_data(gisaid_data: dict) -> dict:
     }
 
 
-def model(dataset, model_type, *, forecast_steps=None):
+def get_feature_gaps(features):
+    """
+    Computes the range ``max - min`` of each column of a dense or sparse
+    ``[C, F]`` shaped feature matrix.
+    """
+    if not features.is_sparse:
+        return features.max(0).values - features.min(0).values
+    features = features.coalesce()
+    C, F = features.shape
+    cols = features.indices()[1]
+    values = features.values()
+    inf = values.new_full((F,), math.inf)
+    max_ = (-inf).scatter_reduce(0, cols, values, "amax")
+    min_ = inf.scatter_reduce(0, cols, values, "amin")
+    # Account for implicit zeros.
+    has_zeros = torch.bincount(cols, minlength=F) < C
+    max_ = torch.where(has_zeros, max_.clamp(min=0), max_)
+    min_ = torch.where(has_zeros, min_.clamp(max=0), min_)
+    return max_ - min_
+
+
+def features_matmul(coef, features):
+    """
+    Computes ``coef @ features.T`` for a batched ``[..., F]`` shaped ``coef``
+    and a dense or sparse ``[C, F]`` shaped ``features``.
+    """
+    if not features.is_sparse:
+        return coef @ features.T
+    batch_shape = coef.shape[:-1]
+    result = torch.sparse.mm(features, coef.reshape(-1, coef.size(-1)).T).T
+    return result.reshape(batch_shape + (-1,))
+
+
+def _flatten_place_clade(x, P, C):
+    # Reshapes a [..., P, C] tensor to [..., 1, P * C], or a [C] tensor to
+    # [P * C], preserving plate dims of batched tensors.
+    if x.dim() <= 1:
+        return x.expand(P, C).reshape(P * C)
+    return x.expand(x.shape[:-2] + (P, C)).reshape(x.shape[:-2] + (1, P * C))
+
+
+def _scatter_place_clade(flat, index, value, P, C):
+    # Scatters [..., PC] values into a [..., P * C] tensor at index, then
+    # reshapes to [..., P, C].
+    shape = torch.broadcast_shapes(flat.shape[:-1], value.shape[:-1])
+    flat = flat.expand(shape + (P * C,))
+    index = index.expand(shape + index.shape)
+    flat = flat.scatter(-1, index, value.expand(index.shape))
+    return flat.reshape(shape[:-1] + (P, C))
+
+
+def bucket_by_place(dataset: dict) -> dict:
+    """
+    Buckets place-clade pairs and sparse counts by place, so that
+    :func:`model` can slice out a subsample of places in time proportional to
+    the size of the subsample.
+
+    :param dict dataset: A dataset as returned by :func:`load_gisaid_data`.
+    :returns: A shallow copy of ``dataset`` with an additional
+        "place_buckets" dict of CSR-style row pointers "pc_ptr" into
+        ``pc_index`` and "count_ptr" into sparse counts permuted by
+        "count_order", together with each count's position "count_pc" in
+        ``pc_index``, per-place constants "log_factorial", and the ids of
+        places with any counts "active".
+    :rtype: dict
+    """
+    T, P, C = dataset["weekly_clades"].shape
+    pc_index = dataset["pc_index"]
+    sparse_counts = dataset["sparse_counts"]
+    t, p, c = sparse_counts["index"]
+    value = sparse_counts["value"]
+
+    # Note pc_index is sorted, hence already grouped by place.
+    pc_ptr = pc_index.new_zeros(P + 1)
+    pc_ptr[1:] = torch.bincount(pc_index // C, minlength=P).cumsum(0)
+    count_order = p.sort(stable=True).indices
+    count_ptr = p.new_zeros(P + 1)
+    count_ptr[1:] = torch.bincount(p, minlength=P).cumsum(0)
+    count_pc = torch.searchsorted(pc_index, p * C + c)[count_order]
+    log_factorial = (sparse_counts["total"] + 1).lgamma().sum(0)  # [P]
+    log_factorial = log_factorial.index_add(0, p, -(value + 1).lgamma())
+
+    dataset = dataset.copy()
+    dataset["place_buckets"] = {
+        "active": (pc_ptr[1:] > pc_ptr[:-1]).nonzero(as_tuple=True)[0],
+        "pc_ptr": pc_ptr,
+        "count_order": count_order,
+        "count_ptr": count_ptr,
+        "count_pc": count_pc,
+        "log_factorial": log_factorial,
+    }
+    return dataset
+
+
+def _gather_segments(ptr, rows):
+    # Concatenates the CSR segments of given rows, returning the positions of
+    # their entries, the index into rows of each entry, and row pointers into
+    # the result.
+    start = ptr[rows]
+    length = ptr[rows + 1] - start
+    local_ptr = length.new_zeros(len(rows) + 1)
+    local_ptr[1:] = length.cumsum(0)
+    segment = torch.repeat_interleave(
+        torch.arange(len(rows), device=ptr.device), length
+    )
+    positions = torch.arange(len(segment), device=ptr.device)
+    positions += (start - local_ptr[:-1])[segment]
+    return positions, segment, local_ptr
+
+
+class _ScaledPlate(pyro.plate):
+    # A subsampled plate whose sites are scaled by a given factor, rather
+    # than by size / subsample_size.
+    def __init__(self, *args, scale, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._scale = scale
+
+    def _process_message(self, msg):
+        super()._process_message(msg)
+        msg["scale"] = msg["scale"] * (self._scale * self.subsample_size / self.size)
+
+
+def _subsample_plates(dataset, subsample_size):
+    # Creates "place" and "place_clade" plates over a random subsample of
+    # places with counts and their place-clade pairs. Places without counts
+    # contribute nothing. Each place-clade pair is included exactly when its
+    # place is, so both plates scale by the inverse place sampling rate.
+    buckets = dataset["place_buckets"]
+    P = len(buckets["active"])
+    PC = len(dataset["pc_index"])
+    subsample_size = min(subsample_size, P)
+    place_plate = pyro.plate("place", P, dim=-2, subsample_size=subsample_size)
+    places = buckets["active"][place_plate.indices]
+    pc_subsample = _gather_segments(buckets["pc_ptr"], places)[0]
+    pc_plate = _ScaledPlate(
+        "place_clade", PC, dim=-1, subsample=pc_subsample, scale=P / subsample_size
+    )
+    return place_plate, pc_plate
+
+
+def create_plates(
+    dataset=None, model_type=None, *, forecast_steps=None, subsample_size=None
+):
+    """
+    Creates subsampled plates for guides of :func:`model`. This should be
+    passed as the ``create_plates`` argument to autoguides.
+    """
+    if subsample_size is None:
+        return []
+    return list(_subsample_plates(dataset, subsample_size))
+
+
+def _observe_subsample(
+    dataset,
+    model_type,
+    time,
+    place_plate,
+    pc_plate,
+    rate_loc,
+    init_loc,
+    rate_scale,
+    init_scale,
+):
+    # Samples place-clade variables and observes the counts of a subsample of
+    # places, in time and memory proportional to the size of the subsample.
+    C = dataset["features"].size(0)
+    buckets = dataset["place_buckets"]
+    places = buckets["active"][place_plate.indices]  # [B]
+    B = len(places)
+    pc_subsample, pc_row, pc_ptr = _gather_segments(buckets["pc_ptr"], places)
+    pc_clade = dataset["pc_index"][pc_subsample] % C
+    with pc_plate:
+        pc_rate = pyro.sample(
+            "pc_rate", dist.Normal(rate_loc.expand(C)[pc_clade], rate_scale)
+        )  # [PC']
+        pc_init = pyro.sample(
+            "pc_init", dist.Normal(init_loc.expand(C)[pc_clade], init_scale)
+        )  # [PC']
+
+    count_subsample, row, _ = _gather_segments(buckets["count_ptr"], places)
+    n = buckets["count_order"][count_subsample]
+    t, _, c = dataset["sparse_counts"]["index"][:, n]
+    value = dataset["sparse_counts"]["value"][n]
+    if "ragged" in model_type:
+        pc_logits = pc_init + pc_rate * time[:, None]  # [T, PC']
+        log_norm = segment_logsumexp(pc_logits, pc_ptr)  # [T, B]
+        pos = buckets["count_pc"][count_subsample]
+        pos = pos - buckets["pc_ptr"][places][row] + pc_ptr[row]
+        logits = pc_logits[t, pos] - log_norm[t, row]
+    else:
+        flat = pc_row * C + pc_clade
+        init = torch.full((B * C,), -1e2).scatter(0, flat, pc_init).view(B, C)
+        rate = rate_loc.expand(B, C).reshape(-1).scatter(0, flat, pc_rate)
+        rate = rate.view(B, C)
+        log_norm = linear_logsumexp(init, rate, time)  # [T, B]
+        logits = init[row, c] + rate[row, c] * time[t] - log_norm[t, row]
+    log_prob = buckets["log_factorial"][places].index_add(0, row, logits * value)
+    with place_plate:
+        pyro.factor("obs", log_prob.unsqueeze(-1))  # [B, 1]
+
+
+def model(dataset, model_type, *, forecast_steps=None, subsample_size=None):
     """
     Bayesian regression model of clade portions as a function of mutation features.
 
@@ -459,6 +742,23 @@ def model(dataset, model_type, *, forecast_steps=None):
     - During prediction (after training), the likelihood statement is omitted
       and instead a ``probs`` tensor is recorded; this is the predicted clade
       portions in each (time, regin) bin.
+
+    If the dataset was created by :func:`make_loo_dataset`, all variables are
+    batched over an outermost "loo" plate of independent leave-one-out models.
+    Place-clade variables of held-out clades are decoupled from the
+    likelihood, so they follow their prior.
+
+    If ``model_type`` contains "ragged", the likelihood normalizes clade
+    portions only over the place-clade pairs in ``pc_index``, costing
+    ``O(T * PC)`` rather than ``O(T * P * C)``. This differs from the default
+    only by the negligible mass of unobserved pairs, whose initial logits
+    are ``-100``.
+
+    During training, ``subsample_size`` may be set to observe only a random
+    subsample of places at each step, scaling the likelihood and place-clade
+    variables to remain unbiased. This requires a dataset prepared by
+    :func:`bucket_by_place` and guides created with
+    ``create_plates=create_plates``.
     """
     # Tensor shapes are commented at at the end of some lines.
     features = dataset["features"]
@@ -467,6 +767,7 @@ def model(dataset, model_type, *, forecast_steps=None):
     sparse_counts = dataset["sparse_counts"]
     clade_id_to_lineage_id = dataset["clade_id_to_lineage_id"]
     pc_index = dataset["pc_index"]
+    loo_mask = dataset.get("loo_mask")  # [K, C]
     T, P, C = weekly_clades.shape
     C, F = features.shape
     L = len(dataset["lineage_id"])
@@ -484,9 +785,21 @@ def model(dataset, model_type, *, forecast_steps=None):
         assert time.shape == (T,)
 
     clade_plate = pyro.plate("clade", C, dim=-1)
-    place_plate = pyro.plate("place", P, dim=-2)
     time_plate = pyro.plate("time", T, dim=-3)
-    pc_plate = pyro.plate("place_clade", PC, dim=-1)
+    if subsample_size is None:
+        place_plate = pyro.plate("place", P, dim=-2)
+        pc_plate = pyro.plate("place_clade", PC, dim=-1)
+    elif forecast_steps is not None or loo_mask is not None:
+        raise ValueError("subsample_size is supported only during training")
+    elif "dense" in model_type:
+        raise ValueError("subsample_size is not supported by dense models")
+    else:
+        place_plate, pc_plate = _subsample_plates(dataset, subsample_size)
+    if loo_mask is None:
+        loo_plate = contextlib.nullcontext()
+    else:
+        K = len(loo_mask)
+        loo_plate = pyro.plate("loo", K, dim=-4)
 
     # Configure reparametrization (which does not affect model density).
     reparam = {}
@@ -499,7 +812,7 @@ def model(dataset, model_type, *, forecast_steps=None):
             reparam["init_loc"] = LocScaleReparam()
         reparam["pc_rate"] = LocScaleReparam()
         reparam["pc_init"] = LocScaleReparam()
-    with poutine.reparam(config=reparam):
+    with poutine.reparam(config=reparam), loo_plate:
 
         # Sample global random variables.
         if "nofeatures" not in model_type:
@@ -516,50 +829,71 @@ def model(dataset, model_type, *, forecast_steps=None):
         # clade and place.
         if "nofeatures" not in model_type:
             coef = pyro.sample(
-                "coef", dist.Laplace(torch.zeros(F), coef_scale).to_event(1)
+                "coef",
+                dist.Laplace(torch.zeros(F), coef_scale.unsqueeze(-1)).to_event(1),
             )  # [F]
+            coef_rate = features_matmul(coef, features)
+            if coef_rate.dim() > 1:
+                coef_rate = coef_rate.squeeze(-2)  # Move C to the clade plate.
         with clade_plate:
             if "localrate" in model_type:
                 rate_loc = pyro.sample(
-                    "rate_loc", dist.Normal(0.01 * coef @ features.T, rate_loc_scale)
+                    "rate_loc", dist.Normal(0.01 * coef_rate, rate_loc_scale)
                 )  # [C]
             elif "nofeatures" in model_type:
                 rate_loc = pyro.sample(
-                    "rate_loc", dist.Normal(torch.zeros((C,)), rate_loc_scale.expand(C))
+                    "rate_loc", dist.Normal(torch.zeros(C), rate_loc_scale)
                 )  # [C]
             else:
-                rate_loc = pyro.deterministic(
-                    "rate_loc", 0.01 * coef @ features.T
-                )  # [C]
+                rate_loc = pyro.deterministic("rate_loc", 0.01 * coef_rate)  # [C]
             if "localinit" in model_type:
                 init_loc = pyro.sample(
                     "init_loc", dist.Normal(0, init_loc_scale)
                 )  # [C]
             else:
                 init_loc = rate_loc.new_zeros(())
+        if subsample_size is not None:
+            _observe_subsample(
+                dataset,
+                model_type,
+                time,
+                place_plate,
+                pc_plate,
+                rate_loc,
+                init_loc,
+                rate_scale,
+                init_scale,
+            )
+            return
         with pc_plate:
-            pc_rate_loc = rate_loc.expand(P, C).reshape(-1)
-            pc_init_loc = init_loc.expand(P, C).reshape(-1)
+            pc_rate_loc = _flatten_place_clade(rate_loc, P, C)
+            pc_init_loc = _flatten_place_clade(init_loc, P, C)
             pc_rate = pyro.sample(
-                "pc_rate", dist.Normal(pc_rate_loc[pc_index], rate_scale)
+                "pc_rate", dist.Normal(pc_rate_loc[..., pc_index], rate_scale)
             )  # [PC]
             pc_init = pyro.sample(
-                "pc_init", dist.Normal(pc_init_loc[pc_index], init_scale)
+                "pc_init", dist.Normal(pc_init_loc[..., pc_index], init_scale)
             )  # [PC]
+        if loo_mask is not None:
+            # Exclude held-out clades, as if they were missing from pc_index.
+            pc_heldout = loo_mask[:, pc_index % C].reshape(K, 1, 1, PC)
+            pc_rate = torch.where(pc_heldout, pc_rate_loc[..., pc_index], pc_rate)
+            pc_init = pc_init.masked_fill(pc_heldout, -1e2)
         with place_plate, clade_plate:
             rate = pyro.deterministic(
-                "rate",
-                pc_rate_loc.scatter(0, pc_index, pc_rate).reshape(P, C),
+                "rate", _scatter_place_clade(pc_rate_loc, pc_index, pc_rate, P, C)
             )  # [P, C]
             init = pyro.deterministic(
                 "init",
-                torch.full((P * C,), -1e2).scatter(0, pc_index, pc_init).reshape(P, C),
+                _scatter_place_clade(
+                    torch.full((P * C,), -1e2), pc_index, pc_init, P, C
+                ),
             )  # [P, C]
-        logits = init + rate * time[:, None, None]  # [T, P, C]
 
         # Optionally predict probabilities (during prediction).
         if forecast_steps is not None:
-            probs = logits.new_zeros(logits.shape[:2] + (L,)).scatter_add_(
+            logits = init + rate * time[:, None, None]  # [T, P, C]
+            probs = logits.new_zeros(logits.shape[:-1] + (L,)).scatter_add_(
                 -1, clade_id_to_lineage_id.expand_as(logits), logits.softmax(-1)
             )
             with time_plate, place_plate, pyro.plate("lineage", L, dim=-1):
@@ -569,6 +903,9 @@ def model(dataset, model_type, *, forecast_steps=None):
         # Finally observe counts (during inference).
         if "dense" in model_type:  # equivalent either way
             # Compute a dense likelihood.
+            logits = init + rate * time[:, None, None]  # [T, P, C]
+            if loo_mask is not None:
+                weekly_clades = weekly_clades * ~loo_mask[:, None, None]
             with time_plate, place_plate:
                 pyro.sample(
                     "obs",
@@ -576,13 +913,41 @@ def model(dataset, model_type, *, forecast_steps=None):
                     obs=weekly_clades.unsqueeze(-2),
                 )  # [T, P, 1, C]
             return
-        # Compromise between sparse and dense.
-        logits = logits.log_softmax(-1)
         t, p, c = sparse_counts["index"]
+        if "ragged" in model_type:
+            # Compute a sparse likelihood whose softmax normalizer ranges only
+            # over place-clade pairs in pc_index, grouped by place.
+            place_ptr = pc_index.new_zeros(P + 1)
+            place_ptr[1:] = torch.bincount(pc_index // C, minlength=P).cumsum(0)
+            if loo_mask is not None:
+                pc_init = pc_init.reshape(K, PC)
+                pc_rate = pc_rate.reshape(K, PC)
+            pc_logits = pc_init[..., None, :] + pc_rate[..., None, :] * time[:, None]
+            log_norm = segment_logsumexp(pc_logits, place_ptr)  # [T, P]
+            n = torch.searchsorted(pc_index, p * C + c)
+            logits = pc_logits[..., t, n] - log_norm[..., t, p]
+        else:
+            # Compute a sparse likelihood, materializing logits only at observed
+            # entries and accumulating the softmax normalizer blockwise over time.
+            if loo_mask is not None:
+                init = init.squeeze(-3)  # [K, P, C]
+                rate = rate.squeeze(-3)  # [K, P, C]
+            log_norm = linear_logsumexp(init, rate, time).movedim(0, -2)  # [T, P]
+            logits = init[..., p, c] + rate[..., p, c] * time[t] - log_norm[..., t, p]
+        if loo_mask is not None:
+            loo_counts = dataset["loo_sparse_counts"]
+            log_prob = loo_counts["log_factorial"] + torch.einsum(
+                "...n,...n->...", logits, loo_counts["value"]
+            )  # [K]
+            pyro.factor("obs", log_prob.reshape(K, 1, 1, 1))
+            return
         pyro.factor(
             "obs",
             sparse_multinomial_likelihood(
-                sparse_counts["total"], logits[t, p, c], sparse_counts["value"]
+                sparse_counts["total"],
+                logits,
+                sparse_counts["value"],
+                sparse_counts.get("log_factorial"),
             ),
         )
 
@@ -597,14 +962,23 @@ class InitLocFn:
     def __init__(self, dataset):
         # Initialize init.
         init = dataset["weekly_clades"].sum(0)  # [P, C]
+        loo_mask = dataset.get("loo_mask")  # [K, C]
+        if loo_mask is not None:
+            init = init * ~loo_mask[:, None]  # [K, P, C]
         init.add_(1 / init.size(-1)).div_(init.sum(-1, True))
         init.log_().sub_(init.median(-1, True).values).add_(torch.randn(init.shape))
+        init_loc = init.mean(-2)  # [C]
+        pc_init = init.reshape(init.shape[:-2] + (-1,))[..., dataset["pc_index"]]
+        if loo_mask is not None:
+            # Match the shapes of variables in the "loo" plate.
+            init = init.unsqueeze(1)  # [K, 1, P, C]
+            init_loc = init_loc[:, None, None]  # [K, 1, 1, C]
+            pc_init = pc_init[:, None, None]  # [K, 1, 1, PC]
         self.init = init  # [P, C]
         self.init_decentered = init / 2
-        self.init_loc = init.mean(0)  # [C]
+        self.init_loc = init_loc  # [C]
         self.init_loc_decentered = self.init_loc / 2
-        self.pc_init = self.init.reshape(-1)[dataset["pc_index"]]
-        self.pc_init = self.pc_init / 2
+        self.pc_init = pc_init / 2
         assert not torch.isnan(self.init).any()
         logger.info(f"init stddev = {self.init.std():0.3g}")
 
@@ -646,16 +1020,93 @@ class InitLocFn:
         raise ValueError(f"InitLocFn found unhandled site {repr(name)}; please update.")
 
 
+class AutoBatchedLowRankMultivariateNormal(AutoLowRankMultivariateNormal):
+    """
+    Variant of :class:`~pyro.infer.autoguide.AutoLowRankMultivariateNormal`
+    that fits an independent posterior to each element of an outermost plate,
+    e.g. to each model in a batch of leave-one-out models.
+
+    This reuses the parameters of the base guide, packed as usual, and
+    overrides only :meth:`get_posterior` to gather them into a batch of
+    independent low-rank posteriors, one per plate element. Note ``rank``
+    is the rank of each posterior.
+
+    All latent variables must be inside the plate.
+
+    :param str plate_name: The name of the outermost plate.
+    """
+
+    #: The name of the unbatched guide whose parameters can warm start this.
+    base_name = "AutoLowRankMultivariateNormal"
+
+    def __init__(self, model, *, plate_name="loo", **kwargs):
+        self.plate_name = plate_name
+        self._batch_index = None
+        super().__init__(model, **kwargs)
+
+    def _get_batch_index(self) -> torch.Tensor:
+        """
+        Returns a ``[batch_size, latent_dim // batch_size]`` tensor of the
+        positions of each batch element's latents in the packed latent.
+        """
+        if self._batch_index is None:
+            parts = []
+            pos = 0
+            for name, site in self.prototype_trace.iter_stochastic_nodes():
+                sizes = [
+                    f.size
+                    for f in site["cond_indep_stack"]
+                    if f.name == self.plate_name
+                ]
+                if not sizes:
+                    raise ValueError(f"{name} is not in plate {self.plate_name}")
+                shape = biject_to(site["fn"].support).inv(site["value"]).shape
+                if shape[0] != sizes[0]:
+                    raise ValueError(f"{name} is not in outermost plate")
+                size = math.prod(shape)
+                parts.append(torch.arange(pos, pos + size).reshape(sizes[0], -1))
+                pos += size
+            self._batch_index = torch.cat(parts, -1).to(self.loc.device)
+        return self._batch_index
+
+    @property
+    def batch_size(self) -> int:
+        return self._get_batch_index().size(0)
+
+    def get_posterior(self, *args, **kwargs):
+        index = self._get_batch_index()  # [K, D]
+        scale = self.scale[index]
+        cov_factor = self.cov_factor[index] * scale.unsqueeze(-1)
+        posterior = dist.LowRankMultivariateNormal(
+            self.loc[index], cov_factor, scale * scale
+        ).to_event(1)
+        # Flatten and permute batched latents back to the packed order.
+        return dist.TransformedDistribution(
+            posterior,
+            [
+                dist.transforms.ReshapeTransform(index.shape, (index.numel(),)),
+                dist.transforms.Permute(index.reshape(-1).argsort()),
+            ],
+        )
+
+
 class Guide(AutoGuideList):
     """
     Custom guide for large-scale inference.
 
     This combines a low-rank multivariate normal guide over small variables
     with a mean field guide over remaining latent variables.
+
+    :param str plate_name: Optional name of an outermost plate over which to
+        fit independent posteriors, e.g. "loo" for batched leave-one-out fits.
+    :param callable create_plates: Optional function creating subsampled
+        plates, see :func:`create_plates`.
     """
 
-    def __init__(self, model, init_loc_fn, init_scale, rank):
-        super().__init__(InitMessenger(init_loc_fn)(model))
+    def __init__(
+        self, model, init_loc_fn, init_scale, rank, plate_name=None, create_plates=None
+    ):
+        super().__init__(InitMessenger(init_loc_fn)(model), create_plates=create_plates)
 
         # Jointly estimate globals, mutation coefficients, and clade coefficients.
         mvn = [
@@ -671,14 +1122,20 @@ class Guide(AutoGuideList):
             "init_loc",
             "init_loc_decentered",
         ]
-        self.append(
-            AutoLowRankMultivariateNormal(
-                poutine.block(model, expose=mvn),
+        mvn_model = poutine.block(model, expose=mvn)
+        if plate_name is None:
+            mvn_guide = AutoLowRankMultivariateNormal(
+                mvn_model, init_loc_fn=init_loc_fn, init_scale=init_scale, rank=rank
+            )
+        else:
+            mvn_guide = AutoBatchedLowRankMultivariateNormal(
+                mvn_model,
+                plate_name=plate_name,
                 init_loc_fn=init_loc_fn,
                 init_scale=init_scale,
                 rank=rank,
             )
-        )
+        self.append(mvn_guide)
         model = poutine.block(model, hide=mvn)
 
         # Mean-field estimate all remaining latent variables.
@@ -742,6 +1199,8 @@ def predict(
     for name, value in get_conditionals(guide.median(dataset)).items():
         if value.numel() < 1e5 or name in save_params:
             result["median"][name] = value
+    if not num_samples:
+        return dict(result)
 
     # Compute moments.
     save_params = {
@@ -768,6 +1227,199 @@ def predict(
     return dict(result)
 
 
+def get_dataset_index(dataset: dict) -> dict:
+    """
+    Records the names of the feature, clade, place, and place-clade axes of a
+    dataset, so that a fit to this dataset can warm start a fit to another.
+
+    :param dict dataset: A dataset as returned by :func:`load_gisaid_data`.
+    :rtype: dict
+    """
+    return {
+        "mutations": list(dataset["mutations"]),
+        "clade_id_inv": list(dataset["clade_id_inv"]),
+        "location_id_inv": list(dataset["location_id_inv"]),
+        "pc_index": dataset["pc_index"].cpu(),
+    }
+
+
+def _match_index(old: dict, new: dict) -> dict:
+    """
+    Maps each axis kind to a tensor of the old positions of each new position,
+    or -1 where a new position has no old counterpart.
+    """
+
+    def match(old_names, new_names):
+        pos = {name: i for i, name in enumerate(old_names)}
+        return torch.tensor([pos.get(name, -1) for name in new_names])
+
+    result: dict = {None: torch.zeros(1, dtype=torch.long)}
+    result["feature"] = match(old["mutations"], new["mutations"])
+    result["clade"] = match(old["clade_id_inv"], new["clade_id_inv"])
+
+    # Match place-clade pairs via their places and clades.
+    place = match(old["location_id_inv"], new["location_id_inv"])
+    old_C = len(old["clade_id_inv"])
+    new_C = len(new["clade_id_inv"])
+    p = place[new["pc_index"].long() // new_C]
+    c = result["clade"][new["pc_index"].long() % new_C]
+    flat = p * old_C + c
+    old_pc_index = old["pc_index"].long()
+    pos = torch.searchsorted(old_pc_index, flat).clamp_(max=len(old_pc_index) - 1)
+    found = (p >= 0) & (c >= 0) & (old_pc_index[pos] == flat)
+    result["place_clade"] = torch.where(found, pos, torch.tensor(-1))
+    return result
+
+
+def _get_site_kinds(model, dataset, model_type) -> dict:
+    """
+    Maps each sample site of the model to the kind of its rightmost axis:
+    "feature", "clade", "place_clade", or None for other sites, which are
+    not remapped.
+    """
+    with torch.no_grad(), poutine.block():
+        trace = poutine.trace(model).get_trace(dataset, model_type)
+    num_features = len(dataset["mutations"])
+    result: dict = {}
+    for name, site in trace.nodes.items():
+        if site["type"] != "sample" or site_is_subsample(site):
+            continue
+        frames = {f.name for f in site["cond_indep_stack"]}
+        if "place_clade" in frames:
+            result[name] = "place_clade"
+        elif "clade" in frames:
+            result[name] = "clade"
+        elif site["fn"].event_dim and site["value"].size(-1) == num_features:
+            result[name] = "feature"
+        else:
+            result[name] = None
+    return result
+
+
+def _remap(new, old, index):
+    """
+    Copies ``old`` values into a copy of ``new`` along the rightmost dim,
+    where ``index`` gives the old position of each new position.
+    """
+    if index.size(0) != new.size(-1):
+        raise ValueError(f"Cannot remap shape {tuple(old.shape)} to {new.shape}")
+    index = index.to(new.device)
+    mask = index >= 0
+    result = new.detach().clone()
+    result[..., mask] = old.to(result)[..., index[mask]]
+    return result
+
+
+def _remap_flat(new, old, layout, batch_size=1):
+    """
+    Remaps the rightmost dim of a flattened :class:`AutoContinuous` parameter,
+    where ``layout`` is a list of ``(new_size, old_size, index)`` segments.
+    If ``batch_size > 1`` each segment of ``new`` is batched, and ``old`` may
+    be either unbatched, in which case it is broadcast, or batched alike.
+    """
+    old_total = sum(old_size for _, old_size, _ in layout)
+    if old.size(-1) == old_total:
+        old_batch_size = 1
+    elif old.size(-1) == batch_size * old_total:
+        old_batch_size = batch_size
+    else:
+        raise ValueError(f"Cannot remap shape {tuple(old.shape)} to {new.shape}")
+    result = new.detach().clone()
+    new_pos = old_pos = 0
+    for new_size, old_size, index in layout:
+        new_end = new_pos + batch_size * new_size
+        old_end = old_pos + old_batch_size * old_size
+        value = _remap(
+            result[..., new_pos:new_end].unflatten(-1, (batch_size, new_size)),
+            old[..., old_pos:old_end].unflatten(-1, (old_batch_size, old_size)),
+            index,
+        )
+        result[..., new_pos:new_end] = value.flatten(-2)
+        new_pos = new_end
+        old_pos = old_end
+    return result
+
+
+@torch.no_grad()
+def warm_start_guide(guide, model, dataset: dict, model_type: str, result: dict):
+    """
+    Initializes guide parameters from the ``params`` of a previous
+    :func:`fit_svi` ``result``, matching parameters by name and remapping the
+    feature, clade, and place-clade axes by name. Entries without an old
+    counterpart keep their current initialization, and parameters that
+    cannot be matched are left unchanged.
+
+    :param guide: An initialized guide.
+    :param callable model: The model.
+    :param dict dataset: The dataset to be fit.
+    :param str model_type: The model type.
+    :param dict result: A previous result of :func:`fit_svi`.
+    """
+    index = _match_index(result["index"], get_dataset_index(dataset))
+    site_kinds = _get_site_kinds(model, dataset, model_type)
+    old_params = result["params"]
+    old_sizes = {
+        None: 1,
+        "feature": len(result["index"]["mutations"]),
+        "clade": len(result["index"]["clade_id_inv"]),
+        "place_clade": len(result["index"]["pc_index"]),
+    }
+
+    # Find the layout of each flattened AutoContinuous parameter.
+    layouts = {}
+    parts = guide if isinstance(guide, AutoGuideList) else [guide]
+    for part in parts:
+        if not isinstance(part, AutoContinuous):
+            continue
+        batch_size = getattr(part, "batch_size", 1)
+        layout = []
+        for name, shape in part._unconstrained_shapes.items():
+            kind = site_kinds[name]
+            new_size = math.prod(shape) // batch_size
+            layout.append((new_size, old_sizes[kind], index[kind]))
+        for suffix in ("loc", "scale", "cov_factor"):
+            layouts[f"{part._pyro_name}.{suffix}"] = layout, batch_size
+
+    param_store = pyro.get_param_store()
+    param_constraints = param_store.get_state()["constraints"]
+    unconstrained_params = dict(param_store.named_parameters())
+    num_copied = 0
+    for name, new in param_store.items():
+        old = old_params.get(name)
+        if old is None and hasattr(guide, "base_name"):
+            # Batched guides may be warm started from their unbatched base.
+            if name.startswith(guide._pyro_name + "."):
+                old = old_params.get(guide.base_name + name[len(guide._pyro_name) :])
+        if old is None:
+            continue
+        site: Optional[str] = name.split(".")[-1]
+        if name.endswith("_centered"):
+            # LocScaleReparam centeredness params have the site's event shape.
+            site = name[: -len("_centered")]
+            if site_kinds.get(site) != "feature":
+                site = None
+        try:
+            if name.endswith(".cov_factor") and name in layouts:
+                value = _remap_flat(
+                    new.transpose(-1, -2), old.transpose(-1, -2), *layouts[name]
+                ).transpose(-1, -2)
+            elif name in layouts:
+                value = _remap_flat(new, old, *layouts[name])
+            elif site_kinds.get(site) is not None:
+                value = _remap(new, old, index[site_kinds[site]])
+            else:
+                value = old
+            value = value.to(new).expand(new.shape)
+        except (ValueError, RuntimeError, IndexError):
+            logger.info(f"Cannot warm start {name} from shape {tuple(old.shape)}")
+            continue
+        # Update in-place, so that guide modules share the updated values.
+        value = transform_to(param_constraints[name]).inv(value)
+        unconstrained_params[name].data.copy_(value)
+        num_copied += 1
+    logger.info(f"Warm started {num_copied} parameters")
+
+
 def fit_svi(
     dataset: dict,
     *,
@@ -786,9 +1438,36 @@ def fit_svi(
     seed=20210319,
     check_loss=False,
     num_ell_particles=256,
+    warm_start=None,
+    early_stop=0.0,
+    early_stop_window=100,
+    subsample_size=None,
 ) -> dict:
     """
     Fits a variational posterior using stochastic variational inference (SVI).
+
+    If ``dataset`` was created by :func:`make_loo_dataset`, this fits a batch
+    of leave-one-out posteriors in a single SVI run, and returns only their
+    medians, batched along the leftmost dimension. Note these posteriors are
+    not fully independent: for "reparam" model types they share the learned
+    centeredness parameters of :class:`~pyro.infer.reparam.LocScaleReparam` ,
+    so results may differ slightly from separate fits.
+
+    To cheaply fit perturbations of a dataset, e.g. with held-out lineages or
+    a subset of features, pass a previous result as ``warm_start`` and set
+    ``early_stop`` to a positive tolerance.
+
+    :param dict warm_start: An optional previous result of :func:`fit_svi`
+        from which to initialize guide parameters, see
+        :func:`warm_start_guide`.
+    :param float early_stop: Stop once the median loss per observation
+        (and per model of a leave-one-out batch) improves by less than this
+        between consecutive windows of ``early_stop_window`` steps. Defaults
+        to zero, i.e. never stop early.
+    :param int early_stop_window: The number of steps per window.
+    :param int subsample_size: Optional number of places to subsample at each
+        SVI step, see :func:`model`. This supports only guide types "map",
+        "normal", and "custom", and overrides ``jit`` to False.
     """
     start_time = default_timer()
 
@@ -802,10 +1481,44 @@ def fit_svi(
     model_ = poutine.condition(model, cond_data)
     init_loc_fn = InitLocFn(dataset)
     Elbo = JitTrace_ELBO if jit else Trace_ELBO
+    plate_name = None
+    num_loo = 1
+    if "loo_mask" in dataset:
+        # Fit a batch of leave-one-out models created by make_loo_dataset().
+        plate_name = "loo"
+        num_loo = len(dataset["loo_mask"])
+        if guide_type in ("structured", "regressive"):
+            raise ValueError(
+                f"guide_type={guide_type} does not support leave-one-out batching"
+            )
+    guide_kwargs = {}
+    if subsample_size is not None:
+        # Fit to a random subsample of places at each step.
+        if plate_name is not None:
+            raise ValueError("subsample_size does not support leave-one-out batching")
+        if guide_type in ("full", "structured", "regressive"):
+            raise ValueError(f"guide_type={guide_type} does not support subsampling")
+        if "place_buckets" not in dataset:
+            dataset = bucket_by_place(dataset)
+        guide_kwargs["create_plates"] = create_plates
+        if jit:
+            # JitTrace_ELBO would bake a single subsample into the trace.
+            logger.info("Disabling jit, which does not support subsample_size")
+            Elbo = Trace_ELBO
     if guide_type == "map":
-        guide = AutoDelta(model_, init_loc_fn=init_loc_fn)
+        guide = AutoDelta(model_, init_loc_fn=init_loc_fn, **guide_kwargs)
     elif guide_type == "normal":
-        guide = AutoNormal(model_, init_loc_fn=init_loc_fn, init_scale=0.01)
+        guide = AutoNormal(
+            model_, init_loc_fn=init_loc_fn, init_scale=0.01, **guide_kwargs
+        )
+    elif guide_type == "full" and plate_name is not None:
+        guide = AutoBatchedLowRankMultivariateNormal(
+            model_,
+            plate_name=plate_name,
+            init_loc_fn=init_loc_fn,
+            init_scale=0.01,
+            rank=rank,
+        )
     elif guide_type == "full":
         guide = AutoLowRankMultivariateNormal(
             model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank
@@ -827,7 +1540,14 @@ def fit_svi(
     elif guide_type == "regressive":
         guide = RegressiveGuide(model_, init_loc_fn=init_loc_fn, init_scale=0.01)
     else:
-        guide = Guide(model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank)
+        guide = Guide(
+            model_,
+            init_loc_fn=init_loc_fn,
+            init_scale=0.01,
+            rank=rank,
+            plate_name=plate_name,
+            **guide_kwargs,
+        )
     # This initializes the guide:
     latent_shapes = {k: v.shape for k, v in guide(dataset, model_type).items()}
     latent_numel = {k: v.numel() for k, v in latent_shapes.items()}
@@ -845,6 +1565,8 @@ def fit_svi(
             + [f" {k} {tuple(v)}" for k, v in param_shapes.items()]
         )
     )
+    if warm_start is not None:
+        warm_start_guide(guide, model_, dataset, model_type, warm_start)
 
     # Log gradient norms during inference.
     series: dict = defaultdict(list)
@@ -861,7 +1583,7 @@ def fit_svi(
             "lrd": learning_rate_decay ** (1 / num_steps),
             "clip_norm": clip_norm,
         }
-        scalars = [k for k, v in latent_numel.items() if v == 1]
+        scalars = [k for k, v in latent_numel.items() if v == num_loo]
         if any("locs." + s in name for s in scalars):
             config["lr"] *= 0.2
         elif "scales" in param_name:
@@ -879,12 +1601,16 @@ def fit_svi(
         return config
 
     optim = ClippedAdam(optim_config)
-    elbo = Elbo(max_plate_nesting=3, ignore_jit_warnings=True)
+    max_plate_nesting = 3 if plate_name is None else 4
+    elbo = Elbo(max_plate_nesting=max_plate_nesting, ignore_jit_warnings=True)
     svi = SVI(model_, guide, optim, elbo)
     losses = []
-    num_obs = dataset["weekly_clades"].count_nonzero()
+    # The loss of a leave-one-out batch sums over its num_loo models.
+    num_obs = dataset["weekly_clades"].count_nonzero() * num_loo
     for step in range(num_steps):
-        loss = svi.step(dataset=dataset, model_type=model_type)
+        loss = svi.step(
+            dataset=dataset, model_type=model_type, subsample_size=subsample_size
+        )
         assert not math.isnan(loss)
         losses.append(loss)
         median = guide.median()
@@ -908,6 +1634,14 @@ def fit_svi(
             prev = torch.tensor(losses[-50:-25], device="cpu").median().item()
             curr = torch.tensor(losses[-25:], device="cpu").median().item()
             assert (curr - prev) < num_obs, "loss is increasing"
+        if early_stop and (step + 1) % early_stop_window == 0:
+            if step + 1 >= 2 * early_stop_window:
+                w = early_stop_window
+                prev = torch.tensor(losses[-2 * w : -w], device="cpu").median().item()
+                curr = torch.tensor(losses[-w:], device="cpu").median().item()
+                if prev - curr < early_stop * num_obs:
+                    logger.info(f"Converged after {step + 1} steps")
+                    break
 
     # compute expected log probability
     ell = 0.0
@@ -921,19 +1655,35 @@ def fit_svi(
                 dataset=dataset, model_type=model_type
             )
             model_trace.compute_log_prob()
-            ell += model_trace.nodes["obs"]["unscaled_log_prob"].item() / float(
-                num_ell_particles
-            )
+            log_prob = model_trace.nodes["obs"]["unscaled_log_prob"]
+            if plate_name is None:
+                log_prob = log_prob.item()
+            else:
+                log_prob = log_prob.reshape(num_loo, -1).sum(-1)  # [K]
+            ell += log_prob / float(num_ell_particles)
 
-    result = predict(
-        model_,
-        guide,
-        dataset,
-        model_type,
-        num_samples=num_samples,
-        forecast_steps=forecast_steps,
-    )
+    if plate_name is None:
+        result = predict(
+            model_,
+            guide,
+            dataset,
+            model_type,
+            num_samples=num_samples,
+            forecast_steps=forecast_steps,
+        )
+    else:
+        # Summarize leave-one-out fits by their medians, batched along dim 0.
+        result = predict(
+            model_,
+            guide,
+            dataset,
+            model_type,
+            num_samples=0,
+            save_params=("coef", "rate_loc"),
+            forecast_steps=None,
+        )
     result["ELL"] = ell
+    result["index"] = get_dataset_index(dataset)
     result["losses"] = losses
     series["loss"] = losses
     result["series"] = dict(series)
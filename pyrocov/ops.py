@@ -1,13 +1,16 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
+import math
 import weakref
-from typing import Dict
+from collections import OrderedDict, namedtuple
 
 import torch
 
 
-def logistic_logsumexp(alpha, beta, delta, tau, *, backend="sequential"):
+def logistic_logsumexp(
+    alpha, beta, delta, tau, *, backend="sequential", block_size=None
+):
     """
     Computes::
 
@@ -20,7 +23,15 @@ def logistic_logsumexp(alpha, beta, delta, tau, *, backend="sequential"):
         delta.shape == [P, S]
         tau.shape == [T, P]
 
-    :param str backend: One of "naive", "sequential".
+    The "naive" backend materializes ``[T, P, S]`` shaped tensors. The
+    "sequential" backend processes one time step at a time, using only
+    ``[P, S]`` sized temporaries. The "chunked" backend processes blocks of
+    time steps at a time via :func:`linear_logsumexp` , trading a little
+    memory for fewer Python loop iterations.
+
+    :param str backend: One of "naive", "sequential", "chunked".
+    :param int block_size: Optional number of time steps to process at once
+        in the "chunked" backend, see :func:`linear_logsumexp` .
     """
     assert alpha.dim() == 2
     assert alpha.shape == beta.shape == delta.shape
@@ -32,6 +43,8 @@ def logistic_logsumexp(alpha, beta, delta, tau, *, backend="sequential"):
         return (alpha + beta * (delta + tau[:, :, None])).logsumexp(-1)
     if backend == "sequential":
         return LogisticLogsumexp.apply(alpha, beta, delta, tau)
+    if backend == "chunked":
+        return linear_logsumexp(alpha + beta * delta, beta, tau, block_size=block_size)
     raise ValueError(f"Unknown backend: {repr(backend)}")
 
 
@@ -66,17 +79,194 @@ class LogisticLogsumexp(torch.autograd.Function):
         return grad_alpha, grad_beta, grad_delta, None
 
 
-_log_factorial_cache: Dict[int, torch.Tensor] = {}
+# The default number of elements to materialize per block.
+_BLOCK_NUMEL = 2**20
+
+
+def linear_logsumexp(init, rate, time, *, block_size=None):
+    """
+    Computes::
+
+        torch.stack([(init + rate * t[..., None]).logsumexp(-1) for t in time])
+
+    where::
+
+        init.shape == rate.shape == [..., C]
+        time.shape == [T] or [T, ...]
+
+    without materializing the ``[T, ..., C]`` shaped logits. Time steps are
+    processed in blocks, so both forward and backward passes use memory
+    ``O(block_size * N * C)`` rather than ``O(T * N * C)``, where ``N`` is
+    the number of batch elements.
+
+    :param torch.Tensor init: Logits at time zero.
+    :param torch.Tensor rate: Rate of change of logits per unit time.
+    :param torch.Tensor time: A tensor of times, either one dimensional or
+        with trailing dims broadcastable to the batch shape of ``init``.
+    :param int block_size: Optional number of time steps to process at once.
+        Defaults to as many as fit in a block of about 1M elements.
+    :returns: A tensor of shape ``[T, ...]``.
+    :rtype: torch.Tensor
+    """
+    assert not time.requires_grad
+    shape = torch.broadcast_shapes(init.shape, rate.shape)
+    C = shape[-1]
+    T = len(time)
+    init = init.expand(shape).reshape(-1, C)
+    rate = rate.expand(shape).reshape(-1, C)
+    if time.dim() == 1:
+        time = time[:, None]  # [T, 1]
+    else:
+        time = time.expand((T,) + shape[:-1]).reshape(T, -1)  # [T, N]
+    if block_size is None:
+        block_size = max(1, _BLOCK_NUMEL // max(1, init.numel()))
+    output = LinearLogsumexp.apply(init, rate, time, block_size)
+    return output.reshape((T,) + shape[:-1])
+
+
+class LinearLogsumexp(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, init, rate, time, block_size):
+        N, C = init.shape
+        T = len(time)
+        output = init.new_empty(T, N)
+        for t0 in range(0, T, block_size):
+            tau = time[t0 : t0 + block_size, :, None]  # [B, N or 1, 1]
+            logits = (rate * tau).add_(init)  # [B, N, C]
+            output[t0 : t0 + block_size] = logits.logsumexp(-1)  # [B, N]
+
+        ctx.block_size = block_size
+        ctx.save_for_backward(init, rate, time, output)
+        return output  # [T, N]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        init, rate, time, output = ctx.saved_tensors
+        block_size = ctx.block_size
+        N, C = init.shape
+
+        grad_init = torch.zeros_like(init)  # [N, C]
+        grad_rate = torch.zeros_like(rate)  # [N, C]
+        for t0 in range(0, len(time), block_size):
+            tau = time[t0 : t0 + block_size]  # [B, N or 1]
+            logits = (rate * tau[:, :, None]).add_(init)  # [B, N, C]
+            probs = logits.sub_(output[t0 : t0 + block_size, :, None]).exp_()
+            grad_logits = probs.mul_(grad_output[t0 : t0 + block_size, :, None])
+            grad_init += grad_logits.sum(0)  # [N, C]
+            tau = tau.expand(len(tau), N)
+            grad_rate += torch.einsum("bnc,bn->nc", grad_logits, tau)  # [N, C]
+
+        return grad_init, grad_rate, None, None
+
+
+def segment_logsumexp(x, ptr):
+    """
+    Computes logsumexp over contiguous segments of the rightmost dimension,
+    where segments are given by CSR-style row pointers. This is equivalent
+    to::
+
+        torch.stack(
+            [x[..., i:j].logsumexp(-1) for i, j in zip(ptr[:-1], ptr[1:])], -1
+        )
+
+    Empty segments result in ``-inf``.
+
+    :param torch.Tensor x: A tensor of shape ``[..., N]``.
+    :param torch.Tensor ptr: A nondecreasing integer tensor of shape
+        ``[S + 1]`` with ``ptr[0] == 0`` and ``ptr[-1] == N``.
+    :returns: A tensor of shape ``[..., S]``.
+    :rtype: torch.Tensor
+    """
+    assert ptr.dim() == 1
+    S = len(ptr) - 1
+    segment = torch.repeat_interleave(
+        torch.arange(S, device=x.device), ptr.diff(), output_size=x.size(-1)
+    )  # [N]
+    shape = x.shape[:-1] + (S,)
+    # Compute the shift out of place on detached x, since no_grad() is not
+    # respected when tracing under the jit.
+    x_detached = x.detach()
+    shift = x_detached.new_full(shape, -math.inf).scatter_reduce(
+        -1, segment.expand(x.shape), x_detached, "amax"
+    )
+    shift = shift.masked_fill(shift == -math.inf, 0)
+    exp = (x - shift[..., segment]).exp()
+    return x.new_zeros(shape).index_add(-1, segment, exp).log() + shift
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class _LogFactorialCache:
+    """
+    Bounded LRU cache of ``(x + 1).lgamma().sum()``, keyed by tensor identity
+    and version, so that in-place modifications invalidate entries. Entries
+    are removed when their tensor is garbage collected.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        key = id(x)
+        entry = self._entries.get(key)
+        if entry is not None:
+            ref, version, result = entry
+            if ref() is x and version == x._version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            del self._entries[key]
+        self.misses += 1
+        result = (x + 1).lgamma().sum()
+        try:
+            ref = weakref.ref(x, lambda _: self._entries.pop(key, None))
+        except TypeError:
+            return result  # Cannot safely cache without a weak reference.
+        self._entries[key] = ref, x._version, result
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return result
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def cache_clear(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._entries.clear()
+
+
+_log_factorial_cache = _LogFactorialCache(maxsize=128)
 
 
 def log_factorial_sum(x: torch.Tensor) -> torch.Tensor:
+    """
+    Computes ``(x + 1).lgamma().sum()``, caching results for constant
+    tensors. Prefer precomputing constants where possible, e.g. the
+    "log_factorial" entry of sparse counts.
+    """
     if x.requires_grad:
         return (x + 1).lgamma().sum()
-    key = id(x)
-    if key not in _log_factorial_cache:
-        weakref.finalize(x, _log_factorial_cache.pop, key, None)
-        _log_factorial_cache[key] = (x + 1).lgamma().sum()
-    return _log_factorial_cache[key]
+    return _log_factorial_cache(x)
+
+
+def log_factorial_cache_info() -> CacheInfo:
+    """
+    Returns hit and miss counts and the size of the
+    :func:`log_factorial_sum` cache.
+    """
+    return _log_factorial_cache.cache_info()
+
+
+def log_factorial_cache_clear() -> None:
+    """
+    Clears the :func:`log_factorial_sum` cache and its counters.
+    """
+    _log_factorial_cache.cache_clear()
 
 
 def sparse_poisson_likelihood(full_log_rate, nonzero_log_rate, nonzero_value):
@@ -108,7 +298,9 @@ def sparse_poisson_likelihood(full_log_rate, nonzero_log_rate, nonzero_value):
     )
 
 
-def sparse_multinomial_likelihood(total_count, nonzero_logits, nonzero_value):
+def sparse_multinomial_likelihood(
+    total_count, nonzero_logits, nonzero_value, log_factorial=None
+):
     """
     The following are equivalent::
 
@@ -122,12 +314,16 @@ def sparse_multinomial_likelihood(total_count, nonzero_logits, nonzero_value):
             (logits - logits.logsumexp(-1))[nnz],
             value[nnz],
         )
+
+    :param torch.Tensor log_factorial: An optional precomputed constant
+        ``log_factorial_sum(total_count) - log_factorial_sum(nonzero_value)``,
+        as in the "log_factorial" entry of sparse counts.
     """
-    return (
-        log_factorial_sum(total_count)
-        - log_factorial_sum(nonzero_value)
-        + torch.dot(nonzero_logits, nonzero_value)
-    )
+    if log_factorial is None:
+        log_factorial = log_factorial_sum(total_count) - log_factorial_sum(
+            nonzero_value
+        )
+    return log_factorial + torch.dot(nonzero_logits, nonzero_value)
 
 
 def sparse_categorical_kl(log_q, p_support, log_p):
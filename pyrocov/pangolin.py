@@ -6,7 +6,7 @@ import os
 import re
 import warnings
 from collections import Counter
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import torch
 
@@ -95,9 +95,58 @@ def update_aliases():
         for k, v in json.load(f).items():
             if isinstance(v, str) and v:
                 PANGOLIN_ALIASES[k] = v
+    _build_alias_tries()
     return PANGOLIN_ALIASES
 
 
+# Prefix tries over dot-separated name components, mapping prefixes to
+# (order, alias, full name) triples. Each trie node is a dict mapping
+# components to child nodes, with the node's own entry under key None.
+_DECOMPRESS_TRIE: dict = {}
+_COMPRESS_TRIE: dict = {}
+
+
+def _build_alias_tries():
+    _DECOMPRESS_TRIE.clear()
+    _COMPRESS_TRIE.clear()
+    for order, (key, value) in enumerate(PANGOLIN_ALIASES.items()):
+        entry = order, key, value
+        _trie_insert(_DECOMPRESS_TRIE, key, entry)
+        if key != "I":  # obsolete
+            _trie_insert(_COMPRESS_TRIE, value, entry)
+
+
+def _trie_insert(trie: dict, name: str, entry: tuple) -> None:
+    node = trie
+    for part in name.split("."):
+        node = node.setdefault(part, {})
+    node.setdefault(None, entry)  # keep the first entry
+
+
+def _trie_search(trie: dict, name: str) -> Tuple[Optional[tuple], int]:
+    """
+    Finds the earliest-ordered entry whose name is a dot-separated prefix of
+    ``name`` , returning the entry and the length of its prefix.
+    """
+    best = None
+    best_length = 0
+    node = trie
+    length = -1
+    for part in name.split("."):
+        node = node.get(part)
+        if node is None:
+            break
+        length += len(part) + 1
+        entry = node.get(None)
+        if entry is not None and (best is None or entry[0] < best[0]):
+            best = entry
+            best_length = length
+    return best, best_length
+
+
+_build_alias_tries()
+
+
 try:
     update_aliases()
 except Exception as e:
@@ -131,13 +180,13 @@ def decompress(name: str) -> str:
     if name.split(".")[0] in ("A", "B"):
         DECOMPRESS[name] = name
         return name
-    for key, value in PANGOLIN_ALIASES.items():
-        if name == key or name.startswith(key + "."):
-            result = value + name[len(key) :]
-            assert result
-            DECOMPRESS[name] = result
-            return result
-    raise ValueError(f"Unknown alias: {repr(name)}")
+    entry, length = _trie_search(_DECOMPRESS_TRIE, name)
+    if entry is None:
+        raise ValueError(f"Unknown alias: {repr(name)}")
+    result = entry[2] + name[length:]
+    assert result
+    DECOMPRESS[name] = result
+    return result
 
 
 def compress(name: str) -> str:
@@ -153,17 +202,56 @@ def compress(name: str) -> str:
     if name.count(".") <= 3:
         result = name
     else:
-        for key, value in PANGOLIN_ALIASES.items():
-            if key == "I":
-                continue  # obsolete
-            if name == value or name.startswith(value + "."):
-                result = key + name[len(value) :]
-                break
+        entry, length = _trie_search(_COMPRESS_TRIE, name)
+        if entry is None:
+            raise ValueError(f"Cannot compress: {repr(name)}")
+        result = entry[1] + name[length:]
     assert is_pango_lineage(result), result
     COMPRESS[name] = result
     return result
 
 
+def _map_many(fn, names: Iterable[str], errors: str) -> List[Optional[str]]:
+    assert errors in ("raise", "warn", "ignore"), errors
+    names = list(names)
+    unique: Dict[str, Optional[str]] = dict.fromkeys(names)
+    for name in unique:
+        try:
+            unique[name] = fn(name)
+        except (ValueError, AssertionError) as e:
+            if errors == "raise":
+                raise
+            if errors == "warn":
+                warnings.warn(str(e))
+    return [unique[name] for name in names]
+
+
+def decompress_many(names: Iterable[str], *, errors="raise") -> List[Optional[str]]:
+    """
+    Bulk version of :func:`decompress` that resolves each unique name only once.
+
+    :param list names: A list of compressed names.
+    :param str errors: One of "raise", "warn", or "ignore". If not "raise",
+        names that fail to decompress are mapped to None.
+    :returns: A list of decompressed names, aligned with ``names``.
+    :rtype: list
+    """
+    return _map_many(decompress, names, errors)
+
+
+def compress_many(names: Iterable[str], *, errors="raise") -> List[Optional[str]]:
+    """
+    Bulk version of :func:`compress` that resolves each unique name only once.
+
+    :param list names: A list of decompressed names.
+    :param str errors: One of "raise", "warn", or "ignore". If not "raise",
+        names that fail to compress are mapped to None.
+    :returns: A list of compressed names, aligned with ``names``.
+    :rtype: list
+    """
+    return _map_many(compress, names, errors)
+
+
 assert compress("B.1.1.7") == "B.1.1.7"
 
 
@@ -217,20 +305,109 @@ def find_edges(names: List[str]) -> List[Tuple[str, str]]:
     return edges
 
 
+class LineageIndex:
+    """
+    Index of ancestry among a fixed list of short lineage names or fine clade
+    names, where ``x`` is a descendent of ``y`` iff the decompressed name of
+    ``x`` starts with the decompressed name of ``y`` followed by ".".
+    Note this treats "A" and "B" as separate roots.
+
+    Nodes are stored in preorder, so that each subtree occupies a contiguous
+    interval ``[pre[i], end[i])`` of the preorder. This allows O(1) ancestor
+    tests, O(k) enumeration of k descendents, and vectorized subtree sums.
+
+    :param list names: A list of unique short lineage names.
+    :ivar torch.Tensor parent: The id of each lineage's nearest ancestor in
+        ``names`` , or -1 for roots.
+    :ivar torch.Tensor pre: The preorder position of each lineage.
+    :ivar torch.Tensor end: The preorder position just after each lineage's
+        subtree.
+    :ivar torch.Tensor order: The inverse of ``pre`` , i.e. lineage ids in
+        preorder.
+    """
+
+    def __init__(self, names: List[str]):
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        assert len(self.ids) == len(self.names), "duplicate names"
+        keys = [tuple(decompress(name).split(".")) for name in self.names]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+
+        # Compute parents via a stack of ancestors in preorder.
+        parent = [-1] * len(keys)
+        end = [len(keys)] * len(keys)
+        stack: List[int] = []
+        for p, i in enumerate(order):
+            key = keys[i]
+            while stack:
+                top = keys[stack[-1]]
+                if len(top) < len(key) and key[: len(top)] == top:
+                    break
+                end[stack.pop()] = p
+            if stack:
+                parent[i] = stack[-1]
+            stack.append(i)
+
+        self.parent = torch.tensor(parent, dtype=torch.long)
+        self.order = torch.tensor(order, dtype=torch.long)
+        self.pre = torch.empty_like(self.order)
+        self.pre[self.order] = torch.arange(len(order))
+        self.end = torch.tensor(end, dtype=torch.long)
+        self._pre = self.pre.tolist()
+        self._end = self.end.tolist()
+        self._order = order
+
+    def __len__(self):
+        return len(self.names)
+
+    def is_ancestor(self, ancestor: str, descendent: str) -> bool:
+        """
+        Returns whether ``ancestor`` is a strict ancestor of ``descendent`` .
+        """
+        a = self.ids[ancestor]
+        d = self._pre[self.ids[descendent]]
+        return self._pre[a] < d < self._end[a]
+
+    def get_parent(self, name: str) -> Optional[str]:
+        """
+        Returns the nearest strict ancestor among ``names`` , or None.
+        """
+        p = int(self.parent[self.ids[name]])
+        return None if p < 0 else self.names[p]
+
+    def get_descendent_ids(self, name: str) -> List[int]:
+        """
+        Returns the sorted list of ids of strict descendents of ``name`` .
+        """
+        i = self.ids[name]
+        return sorted(self._order[self._pre[i] + 1 : self._end[i]])
+
+    def get_descendents(self, name: str) -> List[str]:
+        """
+        Returns the list of strict descendents of ``name`` , in the order of
+        ``names`` .
+        """
+        return [self.names[i] for i in self.get_descendent_ids(name)]
+
+    def subtree_sum(self, values: torch.Tensor) -> torch.Tensor:
+        """
+        Given a tensor of ``values`` with rightmost dimension indexed by
+        lineage id, computes the sum over each lineage's subtree, including
+        the lineage itself.
+        """
+        assert values.size(-1) == len(self)
+        cumsum = values.index_select(-1, self.order).cumsum(-1)
+        cumsum = torch.nn.functional.pad(cumsum, (1, 0))
+        return cumsum.index_select(-1, self.end) - cumsum.index_select(-1, self.pre)
+
+
 def find_descendents(names: List[str]) -> Dict[str, List[str]]:
     """
     Given a set of short lineages, returns a dict mapping short lineage to its
     list of descendents.
     """
-    longnames = [decompress(name) for name in names]
-    descendents: Dict[str, List[str]] = {}
-    for long1, short1 in zip(longnames, names):
-        prefix = long1 + "."
-        descendents1 = descendents[short1] = []
-        for long2, short2 in zip(longnames, names):
-            if long2.startswith(prefix):
-                descendents1.append(short2)
-    return descendents
+    index = LineageIndex(names)
+    return {name: index.get_descendents(name) for name in names}
 
 
 def merge_lineages(counts: Dict[str, int], min_count: int) -> Dict[str, str]:
@@ -1,10 +1,13 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import os
 import re
 from collections import OrderedDict, defaultdict
-from typing import Dict, List, Tuple
+from typing import Collection, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
 
 from .aa import DNA_TO_AA
 from .align import NEXTCLADE_DATA
@@ -51,6 +54,22 @@ def _():
 # as measured in the original Wuhan virus.
 GENE_TO_POSITION: Dict[str, Tuple[int, int]] = _()
 
+GENOME_LENGTH = 29903
+
+
+def _get_position_to_codons():
+    result: List[Tuple[Tuple[str, int, int], ...]] = [()] * (GENOME_LENGTH + 1)
+    for gene, (start, end) in GENE_TO_POSITION.items():
+        for position_nuc in range(start, end + 1):
+            position_aa, position_codon = divmod(position_nuc - start, 3)
+            result[position_nuc] += ((gene, position_aa, position_codon),)
+    return result
+
+
+# This maps each 1-based nucleotide position to a tuple of
+# (gene, position_aa, position_codon) triples, one per overlapping gene.
+POSITION_TO_CODONS = _get_position_to_codons()
+
 # This maps gene name to a set of regions in that gene.
 # These regions may be used in plotting e.g. mutrans.ipynb.
 # Each region has a string label and an extent (start, end)
@@ -172,58 +191,96 @@ def aa_mutation_to_position(m: str) -> int:
     return start + aa_offset * 3
 
 
-def nuc_mutations_to_aa_mutations(ms: List[str]) -> List[str]:
-    global REFERENCE_SEQ
-    if REFERENCE_SEQ is None:
-        REFERENCE_SEQ = load_reference_sequence()
+def nuc_mutations_to_aa_mutations(ms: Collection) -> List[str]:
+    """
+    Converts a collection of nucleotide mutations, either strings like
+    "A23403G", :class:`pyrocov.usher.Mutation` s, or a sorted int array of
+    mutation codes as produced by :func:`pyrocov.usher.encode_mutations` , to a
+    list of nonsynonymous amino acid mutations like "S:D614G".
+    """
+    if isinstance(ms, np.ndarray):
+        # Decode int codes as in pyrocov.usher.encode_mutations().
+        positions, nucs = np.divmod(ms, 4)
+        pairs = zip(positions.tolist(), ["ACGT"[n] for n in nucs.tolist()])
+    else:
+        pairs = map(_parse_nuc_mutation, ms)
 
     ms_by_aa = defaultdict(list)
+    for position_nuc, new_nuc in pairs:
+        # Find all matching genes.
+        for gene, position_aa, position_codon in POSITION_TO_CODONS[position_nuc]:
+            ms_by_aa[gene, position_aa].append((position_codon, new_nuc))
 
-    for m in ms:
-        # Parse a nucleotide mutation such as "A1234G" -> (1234, "G").
-        # Note this uses 1-based indexing.
-        if isinstance(m, str):
-            position_nuc = int(m[1:-1])
-            new_nuc = m[-1]
-        else:
-            # assert isinstance(m, pyrocov.usher.Mutation)
-            position_nuc = m.position
-            new_nuc = m.mut
+    # Format cumulative amino acid changes.
+    result = []
+    for (gene, position_aa), changes in ms_by_aa.items():
+        aa_mutation = _translate_codon(gene, position_aa, tuple(changes))
+        if aa_mutation is not None:
+            result.append(aa_mutation)
+    return result
 
-        # Find the first matching gene.
-        for gene, (start, end) in GENE_TO_POSITION.items():
-            if start <= position_nuc <= end:
-                position_aa = (position_nuc - start) // 3
-                position_codon = (position_nuc - start) % 3
-                ms_by_aa[gene, position_aa].append((position_codon, new_nuc))
 
-    # Format cumulative amino acid changes.
+def _parse_nuc_mutation(m) -> Tuple[int, str]:
+    # Parse a nucleotide mutation such as "A1234G" -> (1234, "G").
+    # Note this uses 1-based indexing.
+    if isinstance(m, str):
+        return int(m[1:-1]), m[-1]
+    # assert isinstance(m, pyrocov.usher.Mutation)
+    return m.position, m.mut
+
+
+def nuc_mutations_to_aa_mutations_batch(
+    mutation_sets: Iterable[Collection],
+) -> List[List[str]]:
+    """
+    Batched version of :func:`nuc_mutations_to_aa_mutations` , memoizing
+    results of repeated inputs such as frozensets or code arrays, which are
+    common across clades.
+    """
+    cache: Dict[Hashable, List[str]] = {}
     result = []
-    for (gene, position_aa), ms in ms_by_aa.items():
-        start, end = GENE_TO_POSITION[gene]
-
-        # Apply mutation to determine new aa.
-        pos = start + position_aa * 3
-        pos -= 1  # convert from 1-based to 0-based
-        old_codon = REFERENCE_SEQ[pos : pos + 3]
-        new_codon = list(old_codon)
-        for position_codon, new_nuc in ms:
-            new_codon[position_codon] = new_nuc
-        new_codon = "".join(new_codon)
-
-        # Format.
-        old_aa = DNA_TO_AA[old_codon]
-        new_aa = DNA_TO_AA[new_codon]
-        if new_aa == old_aa:  # ignore synonymous substitutions
-            continue
-        if old_aa is None:
-            old_aa = "STOP"
-        if new_aa is None:
-            new_aa = "STOP"
-        result.append(f"{gene}:{old_aa}{position_aa + 1}{new_aa}")  # 1-based
+    for ms in mutation_sets:
+        key = ms.tobytes() if isinstance(ms, np.ndarray) else ms
+        if isinstance(key, Hashable):
+            aa_mutations = cache.get(key)
+            if aa_mutations is None:
+                aa_mutations = cache[key] = nuc_mutations_to_aa_mutations(ms)
+        else:
+            aa_mutations = nuc_mutations_to_aa_mutations(ms)
+        result.append(aa_mutations)
     return result
 
 
+@functools.lru_cache(maxsize=2**16)
+def _translate_codon(
+    gene: str, position_aa: int, changes: Tuple[Tuple[int, str], ...]
+) -> Optional[str]:
+    global REFERENCE_SEQ
+    if REFERENCE_SEQ is None:
+        REFERENCE_SEQ = load_reference_sequence()
+
+    # Apply mutation to determine new aa.
+    start, end = GENE_TO_POSITION[gene]
+    pos = start + position_aa * 3
+    pos -= 1  # convert from 1-based to 0-based
+    old_codon = REFERENCE_SEQ[pos : pos + 3]
+    new_codon = list(old_codon)
+    for position_codon, new_nuc in changes:
+        new_codon[position_codon] = new_nuc
+    new_codon = "".join(new_codon)
+
+    # Format.
+    old_aa = DNA_TO_AA[old_codon]
+    new_aa = DNA_TO_AA[new_codon]
+    if new_aa == old_aa:  # ignore synonymous substitutions
+        return None
+    if old_aa is None:
+        old_aa = "STOP"
+    if new_aa is None:
+        new_aa = "STOP"
+    return f"{gene}:{old_aa}{position_aa + 1}{new_aa}"  # 1-based
+
+
 def load_reference_sequence():
     with open(os.path.join(NEXTCLADE_DATA, "reference.fasta")) as f:
         ref = "".join(line.strip() for line in f if not line.startswith(">"))
@@ -4,13 +4,17 @@
 import gzip
 import heapq
 import logging
+import math
+import os
+import re
 import shutil
 import warnings
-from collections import defaultdict, namedtuple
-from typing import Dict, FrozenSet, Optional, Set, Tuple
+from collections import OrderedDict, defaultdict, namedtuple
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
 
+import numpy as np
 import tqdm
-from Bio.Phylo.NewickIO import Parser, Writer
+from Bio.Phylo.NewickIO import Parser, token_dict, tokenizer
 
 from . import pangolin
 from .external.usher import parsimony_pb2
@@ -22,15 +26,265 @@ Mutation = namedtuple("Mutation", ["position", "ref", "mut"])
 NUCLEOTIDE = "ACGT"
 
 
-def load_proto(filename):
+def _read_proto(filename):
     open_ = gzip.open if filename.endswith(".gz") else open
     with open_(filename, "rb") as f:
-        proto = parsimony_pb2.data.FromString(f.read())  # type: ignore
+        return parsimony_pb2.data.FromString(f.read())  # type: ignore
+
+
+def load_proto(filename):
+    proto = _read_proto(filename)
     newick = proto.newick.replace(";", "")  # work around unescaped node names
     tree = next(Parser.from_string(newick).parse())
     return proto, tree
 
 
+def _parse_newick(newick: str):
+    """
+    Parses a newick string into preorder arrays, following the conventions of
+    ``Bio.Phylo.NewickIO.Parser`` but without creating ``Clade`` objects.
+    """
+    newick = "".join(line.rstrip() for line in newick.split("\n")).strip()
+    names: List[Optional[str]] = [None]
+    parents = [-1]
+    branch_lengths = [math.nan]
+    comments: Dict[int, str] = {}
+    current = 0
+    for match in re.finditer(tokenizer, newick):
+        token = match.group()
+        if token == "(":
+            parents.append(current)
+            names.append(None)
+            branch_lengths.append(math.nan)
+            current = len(parents) - 1
+        elif token == ",":
+            if current == 0:
+                raise ValueError("Newick tree is missing its outer parentheses")
+            parents.append(parents[current])
+            names.append(None)
+            branch_lengths.append(math.nan)
+            current = len(parents) - 1
+        elif token == ")":
+            current = parents[current]
+            if current < 0:
+                raise ValueError("Parenthesis mismatch")
+        elif token.startswith(":"):
+            branch_lengths[current] = float(token[1:])
+        elif token.startswith("'"):
+            name = names[current]
+            # Escaped quotes are parsed as adjacent quoted labels.
+            names[current] = token[1:-1] if not name else name + token[:-1]
+        elif token.startswith("["):
+            comments[current] = token[1:-1]
+        elif token == "\n":
+            pass
+        elif token == ";":
+            break
+        else:
+            names[current] = token
+    if current != 0:
+        raise ValueError("Parenthesis mismatch")
+    return names, parents, branch_lengths, comments
+
+
+class ArrayTree:
+    """
+    Array-backed representation of an usher mutation tree, with nodes
+    numbered in preorder, i.e. in the order of both ``proto.metadata`` and
+    ``Bio.Phylo`` ``tree.find_clades()``. The root is node 0.
+
+    Each node's children are ``children[child_offsets[i]:child_offsets[i+1]]``
+    and its mutations are the slice
+    ``mutation_offsets[i]:mutation_offsets[i+1]`` of the ``mutation_*``
+    arrays. Mutated nucleotides are stored as bitmasks over ``NUCLEOTIDE``.
+
+    Like ``Bio.Phylo``, names of internal nodes that parse as numbers are
+    interpreted as ``confidences``. Comments are stored in ``comments``.
+
+    :param proto: A ``parsimony_pb2.data`` proto.
+    """
+
+    def __init__(self, proto):
+        newick = proto.newick.replace(";", "")
+        names, parents, branch_lengths, self.comments = _parse_newick(newick)
+        N = len(names)
+        if len(proto.metadata) != N or len(proto.node_mutations) != N:
+            raise ValueError(
+                f"Expected {N} nodes but found {len(proto.metadata)} metadata, "
+                f"{len(proto.node_mutations)} node_mutations"
+            )
+        self.parents = np.array(parents, dtype=np.int32)
+        self.branch_lengths = np.array(branch_lengths, dtype=np.float64)
+
+        # Build a children CSR array. Since nodes are in preorder, children
+        # are sorted by (parent, preorder id).
+        counts = np.bincount(self.parents[1:], minlength=N)
+        self.child_offsets = np.zeros(N + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.child_offsets[1:])
+        self.children = np.argsort(self.parents[1:], kind="stable").astype(np.int32) + 1
+
+        self.confidences: Dict[int, float] = {}
+        for i in np.nonzero(counts)[0].tolist():
+            name = names[i]
+            if name:
+                confidence = _parse_confidence(name)
+                if confidence is not None:
+                    self.confidences[i] = confidence
+                    names[i] = None
+        self.names = names
+
+        # Build a mutations CSR array.
+        positions = []
+        refs = []
+        muts = []
+        num_mutations = np.zeros(N, dtype=np.int64)
+        for i, node in enumerate(proto.node_mutations):
+            num_mutations[i] = len(node.mutation)
+            for m in node.mutation:
+                positions.append(m.position)
+                refs.append(m.ref_nuc)
+                muts.append(sum(1 << n for n in m.mut_nuc))
+        self.mutation_offsets = np.zeros(N + 1, dtype=np.int64)
+        np.cumsum(num_mutations, out=self.mutation_offsets[1:])
+        self.mutation_positions = np.array(positions, dtype=np.int32)
+        self.mutation_refs = np.array(refs, dtype=np.int8)
+        self.mutation_muts = np.array(muts, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def num_mutations(self) -> np.ndarray:
+        return np.diff(self.mutation_offsets)
+
+    def get_children(self, i: int) -> np.ndarray:
+        return self.children[self.child_offsets[i] : self.child_offsets[i + 1]]
+
+    def get_mutations(self, i: int) -> List[Mutation]:
+        beg, end = self.mutation_offsets[i : i + 2].tolist()
+        return [
+            Mutation(position, NUCLEOTIDE[ref], _MUT_NUC[mut])
+            for position, ref, mut in zip(
+                self.mutation_positions[beg:end].tolist(),
+                self.mutation_refs[beg:end].tolist(),
+                self.mutation_muts[beg:end].tolist(),
+            )
+        ]
+
+    def get_mutation_codes(self) -> np.ndarray:
+        """
+        Returns an int32 array of interned mutation codes aligned with
+        ``mutation_positions``, see :func:`encode_mutations` .
+        """
+        nucs = _MASK_TO_NUC[self.mutation_muts]
+        if (nucs < 0).any():
+            raise ValueError("Cannot encode ambiguous mutations")
+        _register_refs(self.mutation_positions, self.mutation_refs)
+        return self.mutation_positions * 4 + nucs
+
+
+_MUT_NUC = [
+    "".join(n for i, n in enumerate(NUCLEOTIDE) if mask & (1 << i))
+    for mask in range(1 << len(NUCLEOTIDE))
+]
+
+
+_MASK_TO_NUC = np.full(1 << len(NUCLEOTIDE), -1, dtype=np.int32)
+_MASK_TO_NUC[[1 << i for i in range(len(NUCLEOTIDE))]] = range(len(NUCLEOTIDE))
+
+# Mutations may be interned as int32 codes ``position * 4 + NUCLEOTIDE.index(mut)``.
+# Since reference nucleotides depend only on position, codes can be decoded
+# given a global table of reference nucleotides.
+_REFS: Dict[int, str] = {}
+_MUTATIONS: Dict[int, Mutation] = {}
+
+
+def _register_refs(positions, refs) -> None:
+    for position, ref in set(zip(positions.tolist(), refs.tolist())):
+        ref = NUCLEOTIDE[ref]
+        old = _REFS.setdefault(position, ref)
+        if old != ref:
+            raise ValueError(f"Inconsistent reference at {position}: {old} vs {ref}")
+
+
+def encode_mutations(mutations: Iterable[Mutation]) -> np.ndarray:
+    """
+    Encodes a set of mutations as a sorted int32 array of codes
+    ``position * 4 + NUCLEOTIDE.index(mut)`` , registering reference
+    nucleotides in a global table for later decoding.
+    """
+    mutations = list(mutations)
+    positions = np.array([m.position for m in mutations], dtype=np.int32)
+    refs = np.array([NUCLEOTIDE.index(m.ref) for m in mutations], dtype=np.int32)
+    nucs = np.array([NUCLEOTIDE.index(m.mut) for m in mutations], dtype=np.int32)
+    _register_refs(positions, refs)
+    return np.unique(positions * 4 + nucs)
+
+
+def decode_mutations(codes: np.ndarray) -> FrozenSet[Mutation]:
+    """
+    Decodes an array of codes produced by :func:`encode_mutations` into a set
+    of interned :class:`Mutation` s.
+    """
+    result = []
+    for code in codes.tolist():
+        m = _MUTATIONS.get(code)
+        if m is None:
+            position, nuc = divmod(code, 4)
+            m = Mutation(position, _REFS[position], NUCLEOTIDE[nuc])
+            _MUTATIONS[code] = m
+        result.append(m)
+    return frozenset(result)
+
+
+def _merge_mutation_codes(codes: np.ndarray) -> np.ndarray:
+    """
+    Merges a sequence of mutation codes, where later codes overwrite earlier
+    codes at the same position, returning a sorted array.
+    """
+    codes = codes[::-1]
+    _, index = np.unique(codes >> 2, return_index=True)
+    return codes[index]
+
+
+def _parse_confidence(text: str) -> Optional[float]:
+    if text.isdigit():
+        return int(text)
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+_ARRAY_TREE_CACHE: "OrderedDict[tuple, ArrayTree]" = OrderedDict()
+_ARRAY_TREE_CACHE_SIZE = 2
+
+
+def load_array_tree(filename: str) -> Tuple[Any, ArrayTree]:
+    """
+    Loads an usher ``.pb`` or ``.pb.gz`` file into a fresh (mutable) proto
+    and an :class:`ArrayTree` . Trees are cached per file, keyed on file
+    modification time and size, so that repeated passes over the same file
+    parse the newick string only once.
+
+    :param str filename: The path to a protobuf file.
+    :returns: A pair ``(proto, tree)``.
+    :rtype: tuple
+    """
+    proto = _read_proto(filename)
+    stat = os.stat(filename)
+    key = os.path.realpath(filename), stat.st_mtime_ns, stat.st_size
+    tree = _ARRAY_TREE_CACHE.get(key)
+    if tree is None:
+        tree = ArrayTree(proto)
+        _ARRAY_TREE_CACHE[key] = tree
+        while len(_ARRAY_TREE_CACHE) > _ARRAY_TREE_CACHE_SIZE:
+            _ARRAY_TREE_CACHE.popitem(last=False)
+    else:
+        _ARRAY_TREE_CACHE.move_to_end(key)
+    return proto, tree
+
+
 def load_usher_clades(filename: str) -> Dict[str, Tuple[str, str]]:
     """
     Loads usher's output clades.txt and extracts the best lineage and a list of
@@ -54,44 +308,73 @@ def load_usher_clades(filename: str) -> Dict[str, Tuple[str, str]]:
 
 
 def load_mutation_tree(
-    filename: str,
-) -> Tuple[Dict[str, FrozenSet[Mutation]], object, object]:
+    filename: str, *, as_codes: bool = False
+) -> Tuple[Dict[str, Any], Any, ArrayTree]:
     """
     Loads an usher lineageTree.pb or lineageTree.pb.gz annotated with mutations
     and pango lineages, and creates a mapping from lineages to their set of
     mutations.
+
+    :param str filename: The path to a protobuf file.
+    :param bool as_codes: Whether to represent each set of mutations as a
+        sorted int32 array of codes, see :func:`encode_mutations` . Defaults to
+        frozensets of :class:`Mutation` s. Since ambiguous mutations cannot be
+        encoded, trees containing any fall back to frozensets with a warning.
     """
     logger.info(f"Loading tree from {filename}")
-    proto, tree = load_proto(filename)
-
-    # Extract phylogenetic tree.
-    clades = list(tree.find_clades())
-    assert len(proto.metadata) == len(clades)
-    assert len(proto.node_mutations) == len(clades)
+    proto, tree = load_array_tree(filename)
+    if as_codes:
+        num_ambiguous = int((_MASK_TO_NUC[tree.mutation_muts] < 0).sum())
+        if num_ambiguous:
+            logger.warning(
+                f"Found {num_ambiguous} ambiguous mutations, "
+                "falling back to frozensets of Mutations"
+            )
+            as_codes = False
 
     # Map lineages to clades.
     lineage_to_clade = {
-        str(meta.clade): clade
-        for clade, meta in zip(clades, proto.metadata)
-        if meta and meta.clade
+        str(meta.clade): i for i, meta in enumerate(proto.metadata) if meta.clade
     }
 
     # Accumulate mutations in each clade, which are overwritten at each position.
-    logger.info(f"Accumulating mutations on {len(clades)} nodes")
-    clade_to_muts: Dict[object, Dict[int, Mutation]] = defaultdict(dict)
-    for clade, muts in zip(tqdm.tqdm(clades), proto.node_mutations):
-        for mut in muts.mutation:
-            clade_to_muts[clade][mut.position] = Mutation(
-                mut.position,
-                NUCLEOTIDE[mut.ref_nuc],
-                "".join(NUCLEOTIDE[n] for n in mut.mut_nuc),
-            )
-        for c in clade.clades:
-            clade_to_muts[c].update(clade_to_muts[clade])
+    # To save memory, we materialize mutation sets only for labelled clades,
+    # each starting from its nearest labelled ancestor's set and applying
+    # mutations along the path between them.
+    logger.info(f"Accumulating mutations on {len(lineage_to_clade)} nodes")
+    parents = tree.parents.tolist()
+    is_labelled = [False] * len(tree)
+    for i in lineage_to_clade.values():
+        is_labelled[i] = True
+    if as_codes:
+        codes = tree.get_mutation_codes()
+        offsets = tree.mutation_offsets.tolist()
+        empty = np.zeros(0, dtype=np.int32)
+    nearest = [-1] * len(tree)  # nearest labelled ancestor-or-self
+    clade_to_muts: Dict[int, Any] = {}
+    for i, parent in enumerate(tqdm.tqdm(parents)):
+        base = nearest[parent] if parent >= 0 else -1
+        if not is_labelled[i]:
+            nearest[i] = base
+            continue
+        nearest[i] = i
+        path = []
+        j = i
+        while j != base:
+            path.append(j)
+            j = parents[j]
+        if as_codes:
+            parts = [clade_to_muts[base] if base >= 0 else empty]
+            parts.extend(codes[offsets[j] : offsets[j + 1]] for j in reversed(path))
+            clade_to_muts[i] = _merge_mutation_codes(np.concatenate(parts))
+            continue
+        muts = {m.position: m for m in clade_to_muts[base]} if base >= 0 else {}
+        for j in reversed(path):
+            for m in tree.get_mutations(j):
+                muts[m.position] = m
+        clade_to_muts[i] = frozenset(muts.values())
 
-    mutations_by_lineage = {
-        k: frozenset(clade_to_muts[v].values()) for k, v in lineage_to_clade.items()
-    }
+    mutations_by_lineage = {k: clade_to_muts[v] for k, v in lineage_to_clade.items()}
     return mutations_by_lineage, proto, tree
 
 
@@ -102,24 +385,21 @@ def refine_mutation_tree(filename_in: str, filename_out: str) -> Dict[str, str]:
     with have a .clade attribute, all descendents will have metadata.clade ==
     "". The tree structure remains unchanged.
     """
-    proto, tree = load_proto(filename_in)
-
-    # Extract phylogenetic tree.
-    clades = list(tree.find_clades())
-    logger.info(f"Refining a tree with {len(clades)} nodes")
-    assert len(proto.metadata) == len(clades)
-    assert len(proto.node_mutations) == len(clades)
-    metadata = dict(zip(clades, proto.metadata))
-    mutations = dict(zip(clades, proto.node_mutations))
+    proto, tree = load_array_tree(filename_in)
+    logger.info(f"Refining a tree with {len(tree)} nodes")
+    num_mutations = tree.num_mutations.tolist()
+    children = tree.children.tolist()
+    child_offsets = tree.child_offsets.tolist()
 
     # Add refined clades, collapsing clones.
     num_children: Dict[str, int] = defaultdict(int)
-    clade_to_fine = {clades[0]: "fine"}
-    fine_to_clade = {"fine": clades[0]}
-    for parent in clades:
+    clade_to_fine = [""] * len(tree)
+    clade_to_fine[0] = "fine"
+    fine_to_clade = {"fine": 0}
+    for parent in range(len(tree)):
         parent_fine = clade_to_fine[parent]
-        for child in parent.clades:
-            if mutations[child].mutation:
+        for child in children[child_offsets[parent] : child_offsets[parent + 1]]:
+            if num_mutations[child]:
                 # Create a new fine id.
                 n = num_children[parent_fine]
                 fine = f"{parent_fine}.{n - 1}" if n else parent_fine + "."
@@ -132,25 +412,252 @@ def refine_mutation_tree(filename_in: str, filename_out: str) -> Dict[str, str]:
 
     # Save basal fine clades and the fine -> coarse mapping.
     fine_to_coarse = {}
-    for clade, meta in metadata.items():
+    for clade, meta in enumerate(proto.metadata):
         fine = clade_to_fine[clade]
         if meta.clade and pangolin.is_pango_lineage(meta.clade):
             fine_to_coarse[fine] = pangolin.compress(meta.clade)
-        meta.clade = fine if clade is fine_to_clade[fine] else ""
+        meta.clade = fine if clade == fine_to_clade[fine] else ""
     # Propagate basal clade metadata downward.
-    for parent in clades:
+    for parent in range(len(tree)):
         parent_coarse = fine_to_coarse[clade_to_fine[parent]]
-        for child in parent.clades:
+        for child in children[child_offsets[parent] : child_offsets[parent + 1]]:
             fine_to_coarse.setdefault(clade_to_fine[child], parent_coarse)
 
     with open(filename_out, "wb") as f:
         f.write(proto.SerializeToString())
 
-    logger.info(f"Found {len(clades) - len(fine_to_coarse)} clones")
+    logger.info(f"Found {len(tree) - len(fine_to_coarse)} clones")
     logger.info(f"Refined {len(set(fine_to_coarse.values()))} -> {len(fine_to_coarse)}")
     return fine_to_coarse
 
 
+class MutationTreePruner:
+    """
+    Greedy pruning engine over an :class:`ArrayTree` , minimizing the
+    error-minimizing objective function::
+
+        value(node) = num_mutations(node) * weights(node)
+
+    Pruned nodes are spliced out of sibling linked lists in O(1) and their
+    mutations are lazily prepended to descendents via a weighted union-find
+    over pruned ancestors. Protos are materialized only by :meth:`save` .
+    Since pruning is deterministic, calling :meth:`prune` with decreasing
+    ``max_num_nodes`` yields the same trees as separate runs.
+
+    :param proto: A ``parsimony_pb2.data`` proto, which is not modified.
+    :param ArrayTree tree: The tree of the proto.
+    :param dict weights: An optional dict mapping clade name to weight.
+        Defaults to unit weight on every node.
+    """
+
+    def __init__(self, proto, tree: ArrayTree, weights: Optional[Dict] = None):
+        self.proto = proto
+        self.tree = tree
+        N = len(tree)
+
+        # Initialize weights.
+        if weights is None:
+            self._weights = [1] * N
+        else:
+            name_set = {m.clade for m in proto.metadata if m.clade}
+            assert set(weights).issubset(name_set)
+            old_weights = weights.copy()
+            self._weights = [
+                old_weights.pop(m.clade, 0) if m.clade else 0 for m in proto.metadata
+            ]
+            assert not old_weights, list(old_weights)
+
+        # Initialize topology. Each node links to an ancestor, with an offset
+        # counting mutations on pruned nodes strictly between them.
+        self._num_mutations = tree.num_mutations.tolist()
+        self._links = tree.parents.tolist()
+        self._offsets = [0] * N
+        self._pruned = [False] * N
+        self._num_nodes = N
+
+        # Initialize sibling linked lists.
+        children = tree.children
+        child_parents = tree.parents[children]
+        same = child_parents[1:] == child_parents[:-1]
+        next_sibling = np.full(N, -1)
+        prev_sibling = np.full(N, -1)
+        next_sibling[children[:-1][same]] = children[1:][same]
+        prev_sibling[children[1:][same]] = children[:-1][same]
+        first_child = np.full(N, -1)
+        last_child = np.full(N, -1)
+        has_children = tree.child_offsets[1:] > tree.child_offsets[:-1]
+        first_child[has_children] = children[tree.child_offsets[:-1][has_children]]
+        last_child[has_children] = children[tree.child_offsets[1:][has_children] - 1]
+        self._next_sibling = next_sibling.tolist()
+        self._prev_sibling = prev_sibling.tolist()
+        self._first_child = first_child.tolist()
+        self._last_child = last_child.tolist()
+
+        self._heap = [(self._get_loss(i), i) for i in range(1, N)]  # keep the root
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return self._num_nodes
+
+    def _find(self, i: int) -> Tuple[int, int]:
+        """
+        Returns the live parent of node ``i`` and the number of mutations on
+        pruned nodes between them, compressing paths along the way.
+        """
+        links = self._links
+        chain = [i]
+        while self._pruned[links[chain[-1]]]:
+            chain.append(links[chain[-1]])
+        parent = links[chain[-1]]
+        offset = self._offsets[chain[-1]]
+        links[chain[-1]] = parent
+        for k in range(len(chain) - 2, -1, -1):
+            offset += self._offsets[chain[k]] + self._num_mutations[chain[k + 1]]
+            links[chain[k]] = parent
+            self._offsets[chain[k]] = offset
+        return parent, self._offsets[i]
+
+    def _get_loss(self, i: int):
+        return self._weights[i] * (self._num_mutations[i] + self._find(i)[1])
+
+    def prune(self, max_num_nodes: int) -> None:
+        """
+        Greedily prunes nodes until at most ``max_num_nodes`` remain.
+        """
+        assert max_num_nodes >= 1
+        heap = self._heap
+        num_pruned = max(0, self._num_nodes - max_num_nodes)
+        logger.info(f"Pruning {num_pruned}/{self._num_nodes} nodes")
+        for step in tqdm.tqdm(range(num_pruned)):
+            # Find the clade with lowest loss.
+            stale_loss, i = heapq.heappop(heap)
+            loss = self._get_loss(i)
+            while loss != stale_loss:
+                # Reinsert clades whose loss was stale.
+                stale_loss, i = heapq.heappushpop(heap, (loss, i))
+                loss = self._get_loss(i)
+
+            # Prune this clade.
+            parent = self._find(i)[0]
+            self._weights[parent] += self._weights[i]  # makes the parent loss stale
+            self._weights[i] = 0
+            self._pruned[i] = True
+            self._num_nodes -= 1
+
+            # Remove i from its siblings and append its children to parent.
+            prev, next_ = self._prev_sibling[i], self._next_sibling[i]
+            if prev >= 0:
+                self._next_sibling[prev] = next_
+            else:
+                self._first_child[parent] = next_
+            if next_ >= 0:
+                self._prev_sibling[next_] = prev
+            else:
+                self._last_child[parent] = prev
+            first, last = self._first_child[i], self._last_child[i]
+            if first >= 0:
+                tail = self._last_child[parent]
+                if tail >= 0:
+                    self._next_sibling[tail] = first
+                else:
+                    self._first_child[parent] = first
+                self._prev_sibling[first] = tail
+                self._last_child[parent] = last
+
+    def _get_children(self, i: int) -> List[int]:
+        result = []
+        child = self._first_child[i]
+        while child >= 0:
+            result.append(child)
+            child = self._next_sibling[child]
+        return result
+
+    def _get_order(self) -> List[int]:
+        order = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            stack.extend(reversed(self._get_children(i)))
+        return order
+
+    def _get_label(self, i: int, terminal: bool) -> str:
+        tree = self.tree
+        label = tree.names[i] or ""
+        if label:
+            unquoted = token_dict["unquoted node label"].match(label)
+            if not unquoted or unquoted.end() < len(label):
+                label = "'%s'" % label.replace("'", "''")
+        branch_length = tree.branch_lengths[i]
+        if math.isnan(branch_length):
+            branch_length = 0.0
+        confidence = None if terminal else tree.confidences.get(i)
+        if confidence is None:
+            label += ":%1.8g" % branch_length
+        else:
+            label += "%1.2f:%1.8g" % (confidence, branch_length)
+        comment = tree.comments.get(i)
+        if comment:
+            label += "[%s]" % comment.replace("[", "\\[").replace("]", "\\]")
+        return label
+
+    def get_newick(self) -> str:
+        """
+        Formats the pruned tree as newick, matching ``Bio.Phylo`` 's writer.
+        """
+        parts = []
+        stack: List[object] = [0]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            assert isinstance(item, int)
+            children = self._get_children(item)
+            if not children:
+                parts.append(self._get_label(item, terminal=True))
+                continue
+            parts.append("(")
+            stack.append(")" + self._get_label(item, terminal=False))
+            for k, child in enumerate(reversed(children)):
+                if k:
+                    stack.append(",")
+                stack.append(child)
+        parts.append(";")
+        return "".join(parts)
+
+    def save(self, filename: str) -> Set[str]:
+        """
+        Saves the pruned tree as a proto, and returns the set of remaining
+        clade names.
+        """
+        proto = self.proto
+        parents = self.tree.parents.tolist()
+        order = self._get_order()
+        assert len(order) == self._num_nodes
+
+        pruned = parsimony_pb2.data()  # type: ignore
+        pruned.newick = self.get_newick()
+        for i in order:
+            # Prepend mutations of pruned ancestors, so as to be compatible
+            # with reversions.
+            ancestors = []
+            p = parents[i]
+            while p >= 0 and self._pruned[p]:
+                ancestors.append(p)
+                p = parents[p]
+            node = pruned.node_mutations.add()
+            for p in reversed(ancestors):
+                node.mutation.extend(proto.node_mutations[p].mutation)
+            node.mutation.extend(proto.node_mutations[i].mutation)
+        pruned.condensed_nodes.extend(proto.condensed_nodes)
+        pruned.metadata.extend(proto.metadata[i] for i in order)
+        with open(filename, "wb") as f:
+            f.write(pruned.SerializeToString())
+
+        return {m.clade for m in pruned.metadata if m.clade}
+
+
 def prune_mutation_tree(
     filename_in: str,
     filename_out: str,
@@ -163,86 +670,61 @@ def prune_mutation_tree(
 
         value(node) = num_mutations(node) * weights(node)
 
+    See :class:`MutationTreePruner` for details.
+
     Returns a restricted set of clade names.
     """
-    proto, tree = load_proto(filename_in)
-    num_pruned = len(proto.node_mutations) - max_num_nodes
-    if num_pruned < 0:
-        shutil.copyfile(filename_in, filename_out)
-        return {m.clade for m in proto.node_metadata if m.clade}
-
-    # Extract phylogenetic tree.
-    clades = list(tree.find_clades())
-    logger.info(f"Pruning {num_pruned}/{len(clades)} nodes")
-    assert len(clades) == len(set(clades))
-    clade_to_id = {c: i for i, c in enumerate(clades)}
-    assert len(proto.metadata) == len(clades)
-    assert len(proto.node_mutations) == len(clades)
-    metadata = dict(zip(clades, proto.metadata))
-    mutations = dict(zip(clades, proto.node_mutations))
-    name_set = {m.clade for m in proto.metadata if m.clade}
-
-    # Initialize weights and topology.
-    if weights is None:
-        weights = {c: 1 for c in clades}
-    else:
-        assert set(weights).issubset(name_set)
-        old_weights = weights.copy()
-        weights = {}
-        for c, m in metadata.items():
-            weights[c] = old_weights.pop(m.clade, 0) if m.clade else 0
-        assert not old_weights, list(old_weights)
-    parents = {c: parent for parent in clades for c in parent.clades}
-    assert tree.root not in parents
-
-    def get_loss(clade):
-        return weights[clade] * len(mutations[clade].mutation)
-
-    # Greedily prune nodes.
-    heap = [(get_loss(c), clade_to_id[c]) for c in clades[1:]]  # don't prune the root
-    heapq.heapify(heap)
-    for step in tqdm.tqdm(range(num_pruned)):
-        # Find the clade with lowest loss.
-        stale_loss, i = heapq.heappop(heap)
-        clade = clades[i]
-        loss = get_loss(clade)
-        while loss != stale_loss:
-            # Reinsert clades whose loss was stale.
-            stale_loss, i = heapq.heappushpop(heap, (loss, i))
-            clade = clades[i]
-            loss = get_loss(clade)
-
-        # Prune this clade.
-        parent = parents.pop(clade)
-        weights[parent] += weights.pop(clade, 0)  # makes the parent loss stale
-        parent.clades.remove(clade)
-        parent.clades.extend(clade.clades)
-        mutation = list(mutations.pop(clade).mutation)
-        for child in clade.clades:
-            parents[child] = parent
-            m = mutations[child].mutation
-            cat = mutation + list(m)  # order so as to be compatible with reversions
-            del m[:]
-            m.extend(cat)
-    clades = list(tree.find_clades())
-    assert len(clades) == max_num_nodes
-
-    # Create the pruned proto.
-    proto.newick = next(iter(Writer([tree]).to_strings()))
-    del proto.metadata[:]
-    del proto.node_mutations[:]
-    proto.metadata.extend(metadata[clade] for clade in clades)
-    proto.node_mutations.extend(mutations[clade] for clade in clades)
-    with open(filename_out, "wb") as f:
-        f.write(proto.SerializeToString())
+    return prune_mutation_trees(filename_in, {max_num_nodes: filename_out}, weights)[
+        max_num_nodes
+    ]
+
 
-    return {metadata[clade].clade for clade in clades if metadata[clade].clade}
+def prune_mutation_trees(
+    filename_in: str,
+    filenames_out: Dict[int, str],
+    weights: Optional[Dict[str, int]] = None,
+) -> Dict[int, Set[str]]:
+    """
+    Like :func:`prune_mutation_tree` but saves multiple resolutions in a
+    single greedy pruning pass, from the largest to the smallest.
+
+    :param str filename_in: The path to an input proto.
+    :param dict filenames_out: A dict mapping ``max_num_nodes`` to the
+        output filename for that resolution.
+    :param dict weights: An optional dict mapping clade name to weight.
+    :returns: A dict mapping each ``max_num_nodes`` to a restricted set of
+        clade names.
+    :rtype: dict
+    """
+    proto, tree = load_array_tree(filename_in)
+    pruner = None
+    result = {}
+    for max_num_nodes, filename_out in sorted(filenames_out.items(), reverse=True):
+        if len(tree) < max_num_nodes:
+            shutil.copyfile(filename_in, filename_out)
+            result[max_num_nodes] = {m.clade for m in proto.metadata if m.clade}
+            continue
+        if pruner is None:
+            pruner = MutationTreePruner(proto, tree, weights)
+        pruner.prune(max_num_nodes)
+        result[max_num_nodes] = pruner.save(filename_out)
+    return result
 
 
-def apply_mutations(ref: str, mutations: FrozenSet[Mutation]) -> str:
+def apply_mutations(ref: str, mutations: Union[FrozenSet[Mutation], np.ndarray]) -> str:
     """
     Applies a set of mutations to a reference sequence.
+
+    :param str ref: A reference sequence.
+    :param mutations: Either a set of :class:`Mutation` s or an array of
+        mutation codes as produced by :func:`encode_mutations` .
     """
+    if isinstance(mutations, np.ndarray):
+        seq = np.frombuffer(ref.encode(), dtype=np.uint8).copy()
+        positions, nucs = np.divmod(mutations, 4)
+        seq[positions - 1] = _NUCLEOTIDE_BYTES[nucs]
+        return seq.tobytes().decode()
+
     seq = list(ref)
     for m in mutations:
         if m.mut == m.ref:
@@ -253,6 +735,64 @@ def apply_mutations(ref: str, mutations: FrozenSet[Mutation]) -> str:
     return "".join(seq)
 
 
+_NUCLEOTIDE_BYTES = np.frombuffer(NUCLEOTIDE.encode(), dtype=np.uint8)
+
+
+def apply_mutations_batch(
+    ref: Union[str, np.ndarray],
+    codes: np.ndarray,
+    offsets: np.ndarray,
+    *,
+    writer=None,
+    names: Optional[List[str]] = None,
+    batch_size: int = 1000,
+) -> Optional[np.ndarray]:
+    """
+    Applies mutations to a reference sequence for many clades at once.
+
+    :param ref: A reference sequence, either a string or a uint8 array.
+    :param np.ndarray codes: A concatenated array of mutation codes, as
+        produced by :func:`encode_mutations` .
+    :param np.ndarray offsets: An array of length ``num_clades + 1`` such that
+        clade ``i`` has mutations ``codes[offsets[i]:offsets[i+1]]`` .
+    :param writer: An optional :class:`~pyrocov.fasta.ShardedFastaWriter` .
+        If provided, sequences are written in batches to the writer, named by
+        ``names`` , rather than returned.
+    :param list names: A list of clade names, required iff ``writer`` is
+        provided.
+    :param int batch_size: The number of sequences to create at a time when
+        writing.
+    :returns: If ``writer`` is None, a ``[num_clades, genome_len]`` shaped
+        uint8 array of ascii sequences; otherwise None.
+    :rtype: np.ndarray
+    """
+    if isinstance(ref, str):
+        ref = np.frombuffer(ref.encode(), dtype=np.uint8)
+    offsets = np.asarray(offsets)
+    num_clades = len(offsets) - 1
+    if writer is None:
+        return _apply_mutations_batch(ref, codes, offsets)
+
+    assert names is not None and len(names) == num_clades
+    for beg in range(0, num_clades, batch_size):
+        end = min(beg + batch_size, num_clades)
+        batch_codes = codes[offsets[beg] : offsets[end]]
+        seqs = _apply_mutations_batch(ref, batch_codes, offsets[beg : end + 1])
+        for name, seq in zip(names[beg:end], seqs):
+            writer.write(name, seq.tobytes().decode())
+    return None
+
+
+def _apply_mutations_batch(ref, codes, offsets):
+    offsets = offsets - offsets[0]
+    num_clades = len(offsets) - 1
+    result = np.repeat(ref[None], num_clades, axis=0)
+    rows = np.repeat(np.arange(num_clades), np.diff(offsets))
+    positions, nucs = np.divmod(codes, 4)
+    result[rows, positions - 1] = _NUCLEOTIDE_BYTES[nucs]
+    return result
+
+
 class FineToMeso:
     """
     Mapping from fine clade names like ``fine.1...3.`` to ancestors in
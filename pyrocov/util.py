@@ -1,19 +1,29 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
+import contextlib
 import functools
 import gzip
+import hashlib
+import inspect
 import itertools
+import logging
 import operator
 import os
+import pickle
+import shutil
+import tempfile
 import weakref
-from typing import Dict
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Tuple
 
 import pyro
 import torch
 import tqdm
 from torch.distributions import constraints, transform_to
 
+logger = logging.getLogger(__name__)
+
 
 def pearson_correlation(x: torch.Tensor, y: torch.Tensor):
     x = (x - x.mean()) / x.std()
@@ -72,6 +82,148 @@ def weak_memoize_by_id(fn):
     return memoized_fn
 
 
+class LRUCache:
+    """
+    Bounded least-recently-used memoizing wrapper around a function of
+    hashable arguments, with hit/miss counters for logging.
+
+    This is intended for functions like date parsing and location
+    normalization that are called once per row of metadata but see only a
+    small number of distinct inputs. Caches can be persisted across runs via
+    :func:`load_lru_caches` and :func:`save_lru_caches`. Persisted entries are
+    discarded whenever the source code of ``fn``'s module or of any of
+    ``depends`` changes, see :attr:`version` .
+
+    :param callable fn: A pure function.
+    :param int maxsize: The maximum number of cached results.
+    :param callable key: An optional function mapping ``fn``'s args to a cache
+        key. Defaults to the tuple of args.
+    :param list depends: An optional list of further modules or functions
+        whose source code determines ``fn``'s results.
+    """
+
+    def __init__(self, fn, *, maxsize=2**18, key=None, depends=()):
+        assert maxsize > 0
+        functools.update_wrapper(self, fn)
+        self.fn = fn
+        self.maxsize = maxsize
+        self.key = key
+        self.version = source_version(inspect.getmodule(fn) or fn, *depends)
+        self.cache: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Updates are recorded only in worker processes, see pop_stats().
+        self.record_updates = False
+        self.updates: list = []
+
+    def __call__(self, *args):
+        key = args if self.key is None else self.key(*args)
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            value = self.fn(*args)
+            if self.record_updates:
+                self.updates.append((key, value))
+            self.update([(key, value)])
+            return value
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return value
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __str__(self):
+        return (
+            f"{self.__name__} cache: {self.hits} hits, {self.misses} misses, "
+            f"{len(self)}/{self.maxsize} entries"
+        )
+
+    def update(self, items):
+        """
+        Inserts ``(key, value)`` pairs, evicting least recently used entries.
+        """
+        for key, value in items:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def pop_stats(self) -> Tuple[int, int, list]:
+        """
+        Returns and resets ``(hits, misses, updates)`` where ``updates`` is the
+        list of ``(key, value)`` pairs computed since the last reset, which is
+        nonempty only if ``.record_updates`` has been set. This is used to
+        merge stats from worker processes via :meth:`merge_stats`.
+        """
+        result = self.hits, self.misses, self.updates
+        self.hits = 0
+        self.misses = 0
+        self.updates = []
+        return result
+
+    def merge_stats(self, hits: int, misses: int, updates: list) -> None:
+        self.hits += hits
+        self.misses += misses
+        self.update(updates)
+
+
+def source_version(*objects) -> str:
+    """
+    Returns a hash of the source code of modules or functions, falling back
+    to their qualified names if source is unavailable.
+    """
+    digest = hashlib.sha1()
+    for obj in objects:
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = getattr(obj, "__qualname__", getattr(obj, "__name__", ""))
+        digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_lru_caches(filename: str, caches: Dict[str, LRUCache]) -> None:
+    """
+    Warms a dict of :class:`LRUCache` s from a file saved by
+    :func:`save_lru_caches`. Missing files are ignored, as are entries saved
+    by a different :attr:`LRUCache.version` .
+    """
+    if not filename or not os.path.exists(filename):
+        return
+    with open(filename, "rb") as f:
+        state = pickle.load(f)
+    for name, cache in caches.items():
+        saved = state.get(name)
+        if saved is None:
+            continue
+        if not isinstance(saved, dict) or saved["version"] != cache.version:
+            logger.info(f"Discarding stale cached {name} entries from {filename}")
+            continue
+        cache.update(saved["items"])
+        logger.info(f"Loaded {len(cache)} cached {name} entries from {filename}")
+
+
+def save_lru_caches(filename: str, caches: Dict[str, LRUCache]) -> None:
+    """
+    Saves a dict of :class:`LRUCache` s, preserving entries of other caches
+    previously saved to the same file.
+    """
+    if not filename:
+        return
+    state = {}
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            state = pickle.load(f)
+    for name, cache in caches.items():
+        state[name] = {"version": cache.version, "items": list(cache.cache.items())}
+    tempname = filename + ".temp"
+    with open(tempname, "wb") as f:
+        pickle.dump(state, f)
+    os.rename(tempname, filename)  # atomic
+
+
 _TENSORS: Dict[tuple, torch.Tensor] = {}
 
 
@@ -189,3 +341,73 @@ def gzip_open_tqdm(filename, mode="rb"):
                 pbar.n = f.tell()
                 pbar.update(0)
                 yield line
+
+
+def atomic_write(filename: str, write: Callable) -> None:
+    """
+    Writes a file via a temporary file and rename, so that readers never see
+    a partially written file.
+    """
+    dirname = os.path.dirname(filename) or "."
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@contextlib.contextmanager
+def gunzip_tempfile(filename: str) -> Iterator[str]:
+    """
+    Decompresses a ``.gz`` file to a temporary file next to the input, yields
+    the temporary filename, and finally deletes the temporary file.
+    """
+    assert filename.endswith(".gz")
+    dirname = os.path.dirname(os.path.abspath(filename))
+    with tempfile.TemporaryDirectory(dir=dirname) as tempdir:
+        tempname = os.path.join(tempdir, os.path.basename(filename)[:-3])
+        with open(filename, "rb") as f, gzip.open(f, "rb") as g:
+            with open(tempname, "wb") as h:
+                shutil.copyfileobj(g, h, 1 << 24)
+        yield tempname
+
+
+def split_lines(
+    filename: str, num_chunks: int, begin: int = 0
+) -> List[Tuple[int, int]]:
+    """
+    Splits a text file into roughly equal byte ranges ``(begin, end)`` that
+    are aligned to line boundaries, e.g. for parallel parsing via
+    :func:`read_lines`.
+    """
+    size = os.path.getsize(filename)
+    bounds = [begin]
+    with open(filename, "rb") as f:
+        for i in range(1, num_chunks):
+            pos = max(begin + (size - begin) * i // num_chunks, bounds[-1])
+            f.seek(pos)
+            f.readline()  # Advance to the next line boundary.
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(b, e) for b, e in zip(bounds[:-1], bounds[1:]) if b < e]
+
+
+def read_lines(filename: str, begin: int, end: int) -> Iterator[str]:
+    """
+    Iterates over decoded lines in the byte range ``[begin, end)`` of a text
+    file, as produced by :func:`split_lines`.
+    """
+    with open(filename, "rb") as f:
+        f.seek(begin)
+        while begin < end:
+            line = f.readline()
+            if not line:
+                break
+            begin += len(line)
+            yield line.decode("utf-8")
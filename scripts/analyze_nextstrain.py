@@ -2,56 +2,53 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-import functools
 import gc
 import logging
-import os
-import re
-from typing import Callable, Union
 
 import pyro
 import torch
 import tqdm
 
 from pyrocov import growth, pangolin, sarscov2
+from pyrocov.cache import DEFAULT_IGNORE, ResultCache
 from pyrocov.util import torch_map
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
-def cached(filename: Union[str, Callable]):
-    """
-    Simple dicorator to cache function results based on filename.
-    """
-
-    def decorator(fn):
-        @functools.wraps(fn)
-        def cached_fn(*args, **kwargs):
-            base_args = args[0]
-            if base_args.no_cache:
-                return fn(*args, **kwargs)
-            f = filename(*args, **kwargs) if callable(filename) else filename
-            if os.path.exists(f) and not base_args.force:
-                logger.info(f"loading cached {f}")
-                return torch.load(f, map_location=torch.empty(()).device)
-            if base_args.no_new:
-                raise ValueError(f"Missing {f}")
-            result = fn(*args, **kwargs)
-            if not args[0].test:
-                logger.info(f"saving {f}")
-                torch.save(result, f)
-            return result
-
-        return cached_fn
-
-    return decorator
-
-
-def _safe_str(v):
-    v = str(v)
-    v = re.sub("[^A-Za-x0-9-]", "_", v)
-    return v
+cache = ResultCache("results/cache")
+
+# Options that affect neither datasets nor fits. Results are device agnostic,
+# since they are loaded onto the current default device.
+FIT_IGNORE = DEFAULT_IGNORE | {
+    "backtesting_max_day",
+    "cuda",
+    "device",
+    "vary_gene",
+    "vary_guide_type",
+    "vary_holdout",
+    "vary_leaves",
+    "vary_model_type",
+    "vary_nsp",
+    "vary_num_steps",
+}
+
+# Options that affect fits but not datasets.
+DATA_IGNORE = FIT_IGNORE | {
+    "clip_norm",
+    "cond_data",
+    "forecast_steps",
+    "guide_type",
+    "jit",
+    "learning_rate",
+    "learning_rate_decay",
+    "model_type",
+    "num_samples",
+    "num_steps",
+    "rank",
+    "seed",
+}
 
 
 def holdout_to_hashable(holdout):
@@ -62,17 +59,11 @@ def hashable_to_holdout(holdout):
     return {k: dict(v) for k, v in holdout}
 
 
-def _load_data_filename(args, **kwargs):
-    parts = ["data", "double" if args.double else "single"]
-    for k, v in sorted(kwargs.get("include", {}).items()):
-        parts.append(f"I{k}={_safe_str(v)}")
-    for k, v in sorted(kwargs.get("exclude", {}).items()):
-        parts.append(f"E{k}={_safe_str(v)}")
-    parts.append(str(kwargs.get("end_day")))
-    return "results/growth.{}.pt".format(".".join(parts))
-
-
-@cached(_load_data_filename)
+@cache.cached(
+    "growth.data",
+    files=["results/nextstrain.columns.pkl", "results/nextstrain.features.pt"],
+    ignore=DATA_IGNORE,
+)
 def load_data(args, **kwargs):
     """
     Cached wrapper to load and subset data.
@@ -80,17 +71,7 @@ def load_data(args, **kwargs):
     return growth.load_nextstrain_data(device=args.device, **kwargs)
 
 
-def _fit_filename(name, *args):
-    parts = [name]
-    for arg in args[2:]:
-        if isinstance(arg, tuple):
-            parts.append("-".join(f"{k}={_safe_str(v)}" for k, v in arg))
-        else:
-            parts.append(str(arg))
-    return "results/growth.{}.pt".format(".".join(parts))
-
-
-@cached(lambda *args: _fit_filename("svi", *args))
+@cache.cached("growth.svi", ignore=FIT_IGNORE)
 def fit_svi(
     args,
     dataset,
@@ -221,7 +202,7 @@ def vary_leaves(args, default_config):
     """
     # Load a single common dataset.
     dataset = load_data(args)
-    descendents = pangolin.find_descendents(dataset["lineage_id_inv"])
+    lineage_index = pangolin.LineageIndex(dataset["lineage_id_inv"])
 
     # Run default config to get a ranking of leaves.
     def make_config(**holdout):
@@ -241,7 +222,9 @@ def vary_leaves(args, default_config):
 
     # Run inference for each lineage. This is very expensive.
     lineage_id = dataset["lineage_id"]
-    num_obs = int(dataset["weekly_counts"].sum())
+    lineage_counts = dataset["weekly_counts"].sum([0, 1])
+    heldout_counts = lineage_index.subtree_sum(lineage_counts).tolist()
+    num_obs = int(lineage_counts.sum())
     results = {}
     for lineage in tqdm.tqdm([None] + lineages):
         if lineage is None:
@@ -251,14 +234,12 @@ def vary_leaves(args, default_config):
         else:
             # Construct a leave-one-out dataset by zeroing out a sublineage.
             config = make_config(exclude={"lineage": "^" + lineage + "$"})
-            heldout = [lineage_id[lineage]]
-            for descendent in descendents[lineage]:
-                heldout.append(lineage_id[descendent])
+            i = lineage_id[lineage]
+            heldout = [i] + lineage_index.get_descendent_ids(lineage)
             loo_dataset = dataset.copy()
             loo_dataset["weekly_counts"] = dataset["weekly_counts"].clone()
             loo_dataset["weekly_counts"][:, :, heldout] = 0
-            loo_num_obs = int(loo_dataset["weekly_counts"].sum())
-            logger.info(f"Holding out {num_obs - loo_num_obs}/{num_obs} samples")
+            logger.info(f"Holding out {int(heldout_counts[i])}/{num_obs} samples")
             loo_dataset["sparse_counts"] = growth.dense_to_sparse(
                 loo_dataset["weekly_counts"]
             )
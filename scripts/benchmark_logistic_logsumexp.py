@@ -0,0 +1,92 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import logging
+from timeit import default_timer
+
+import torch
+
+from pyrocov.ops import logistic_logsumexp
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
+
+
+def parse_size(size):
+    T, P, S = map(int, size.split(","))
+    return T, P, S
+
+
+def benchmark(args, backend, T, P, S):
+    """
+    Returns the mean wall time in seconds of a forward and backward pass.
+    """
+    alpha = torch.randn(P, S, requires_grad=True)
+    beta = torch.randn(P, S).mul(0.1).requires_grad_()
+    delta = torch.randn(P, S, requires_grad=True)
+    tau = torch.linspace(-3, 3, T)[:, None].expand(T, P).contiguous()
+    probe = torch.randn(T, P)
+
+    def step():
+        output = logistic_logsumexp(
+            alpha, beta, delta, tau, backend=backend, block_size=args.block_size
+        )
+        torch.autograd.grad((output * probe).sum(), [alpha, beta, delta])
+        if args.cuda:
+            torch.cuda.synchronize()
+
+    step()  # Warm up.
+    start_time = default_timer()
+    for _ in range(args.num_repeats):
+        step()
+    return (default_timer() - start_time) / args.num_repeats
+
+
+def main(args):
+    if args.cuda:
+        torch.set_default_tensor_type(torch.cuda.FloatTensor)
+    backends = args.backends.split(",")
+    sizes = [parse_size(size) for size in args.sizes.split(";")]
+
+    header = "{:>6} {:>6} {:>6} ".format("T", "P", "S")
+    header += " ".join(f"{backend:>12}" for backend in backends)
+    print(header)
+    for T, P, S in sizes:
+        line = f"{T:>6} {P:>6} {S:>6} "
+        for backend in backends:
+            if backend == "naive" and T * P * S > args.max_naive_numel:
+                line += " {:>12}".format("-")  # Would run out of memory.
+                continue
+            seconds = benchmark(args, backend, T, P, S)
+            line += f" {seconds:12.4f}"
+        print(line, flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark backends of pyrocov.ops.logistic_logsumexp"
+    )
+    parser.add_argument(
+        "--sizes",
+        default="10,100,100;50,100,100;50,1000,100;50,100,1000;200,1000,1000",
+        help="semicolon delimited list of T,P,S sizes",
+    )
+    parser.add_argument(
+        "--backends",
+        default="naive,sequential,chunked",
+        help="comma delimited list of backends",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help="number of time steps per block of the chunked backend",
+    )
+    parser.add_argument("--max-naive-numel", default=10**8, type=int)
+    parser.add_argument("-n", "--num-repeats", default=5, type=int)
+    parser.add_argument(
+        "--cuda", action="store_true", default=torch.cuda.is_available()
+    )
+    parser.add_argument("--cpu", dest="cuda", action="store_false")
+    args = parser.parse_args()
+    main(args)
@@ -2,56 +2,66 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-import functools
+import contextlib
 import gc
 import logging
 import os
-import re
-from typing import Callable, Union
+from collections import defaultdict
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import pyro
 import torch
 import tqdm
 
 from pyrocov import mutrans, pangolin, sarscov2
+from pyrocov.cache import DEFAULT_IGNORE, ResultCache
 from pyrocov.util import torch_map
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
-def cached(filename: Union[str, Callable]):
-    """
-    Simple dicorator to cache function results based on filename.
-    """
-
-    def decorator(fn):
-        @functools.wraps(fn)
-        def cached_fn(*args, **kwargs):
-            base_args = args[0]
-            if base_args.no_cache:
-                return fn(*args, **kwargs)
-            f = filename(*args, **kwargs) if callable(filename) else filename
-            if os.path.exists(f) and not base_args.force:
-                logger.info(f"loading cached {f}")
-                return torch.load(f, map_location=torch.empty(()).device)
-            if base_args.no_new:
-                raise ValueError(f"Missing {f}")
-            result = fn(*args, **kwargs)
-            if not args[0].test:
-                logger.info(f"saving {f}")
-                torch.save(result, f)
-            return result
-
-        return cached_fn
-
-    return decorator
-
-
-def _safe_str(v):
-    v = str(v)
-    v = re.sub("[^A-Za-x0-9-]", "_", v)
-    return v
+cache = ResultCache("results/cache")
+
+# Options that affect neither datasets nor fits. Results are device agnostic,
+# since they are loaded onto the current default device.
+FIT_IGNORE = DEFAULT_IGNORE | {
+    "backtesting_max_day",
+    "cache_max_gb",
+    "cuda",
+    "device",
+    "loo_batch_size",
+    "vary_coef_scale",
+    "vary_gene",
+    "vary_guide_type",
+    "vary_holdout",
+    "vary_leaves",
+    "vary_model_type",
+    "vary_nsp",
+    "vary_num_steps",
+    "warm_start",
+}
+
+# Batched leave-one-out fits depend on their batch, see fit_svi_loo().
+LOO_FIT_IGNORE = FIT_IGNORE - {"loo_batch_size"}
+
+# Options that affect fits but not datasets.
+DATA_IGNORE = FIT_IGNORE | {
+    "clip_norm",
+    "cond_data",
+    "early_stop",
+    "forecast_steps",
+    "guide_type",
+    "jit",
+    "learning_rate",
+    "learning_rate_decay",
+    "model_type",
+    "num_samples",
+    "num_steps",
+    "rank",
+    "seed",
+    "subsample_size",
+}
 
 
 def holdout_to_hashable(holdout):
@@ -62,50 +72,47 @@ def hashable_to_holdout(holdout):
     return {k: dict(v) for k, v in holdout}
 
 
-def _load_data_filename(args, **kwargs):
-    parts = ["data", "double" if args.double else "single"]
-    parts.append(str(args.max_num_clades))
-    parts.append(str(args.min_num_mutations))
-    parts.append(str(args.min_region_size))
-    for k, v in sorted(kwargs.get("include", {}).items()):
-        parts.append(f"I{k}={_safe_str(v)}")
-    for k, v in sorted(kwargs.get("exclude", {}).items()):
-        parts.append(f"E{k}={_safe_str(v)}")
-    parts.append(str(kwargs.get("end_day")))
-    return "results/mutrans.{}.pt".format(".".join(parts))
+def _load_data_files(args, **kwargs):
+    features_filename = (
+        f"results/features.{args.max_num_clades}.{args.min_num_mutations}.pt"
+    )
+    # Prefer the memory-mapped columnar store if available.
+    columns_filename = f"results/columns.{args.max_num_clades}"
+    if not os.path.isdir(columns_filename):
+        columns_filename += ".pkl"
+    return [columns_filename, features_filename]
 
 
-@cached(_load_data_filename)
+@cache.cached("mutrans.data", files=_load_data_files, ignore=DATA_IGNORE)
 def load_data(args, **kwargs):
     """
     Cached wrapper to load GENBANK or GISAID data.
     """
-    features_filename = (
-        f"results/features.{args.max_num_clades}.{args.min_num_mutations}.pt"
-    )
+    columns_filename, features_filename = _load_data_files(args)
     return mutrans.load_gisaid_data(
         device=args.device,
-        columns_filename=f"results/columns.{args.max_num_clades}.pkl",
+        columns_filename=columns_filename,
         features_filename=features_filename,
         min_region_size=args.min_region_size,
+        sparse_features=args.sparse_features,
         **kwargs,
     )
 
 
-def _fit_filename(name, *args):
-    parts = [name]
-    parts.append(str(args[0].max_num_clades))
-    parts.append(str(args[0].min_num_mutations))
-    parts.append(str(args[0].min_region_size))
-    for arg in args[2:]:
-        if isinstance(arg, tuple):
-            parts.append("-".join(f"{k}={_safe_str(v)}" for k, v in arg))
-        else:
-            parts.append(str(arg))
-    return "results/mutrans.{}.pt".format(".".join(parts))
+def get_warm_start(args, result):
+    """
+    Extracts what is needed to warm start later fits from a ``result``, or
+    returns None if warm starting is disabled or impossible.
+    """
+    if not args.warm_start:
+        return None
+    if "params" not in result or "index" not in result:
+        logger.info("Cannot warm start from a result without params")
+        return None
+    return {"params": result["params"], "index": result["index"]}
 
 
-@cached(lambda *args: _fit_filename("svi", *args))
+@cache.cached("mutrans.svi", ignore=FIT_IGNORE)
 def fit_svi(
     args,
     dataset,
@@ -120,6 +127,8 @@ def fit_svi(
     f=6,
     end_day=None,
     holdout=(),
+    *,
+    warm_start=None,
 ):
     """
     Cached wrapper to fit a model via SVI.
@@ -143,6 +152,9 @@ def fit_svi(
         seed=args.seed,
         jit=args.jit,
         num_samples=args.num_samples,
+        warm_start=warm_start,
+        early_stop=args.early_stop,
+        subsample_size=args.subsample_size,
     )
 
     if "lineage" in holdout.get("exclude", {}):
@@ -158,6 +170,267 @@ def fit_svi(
     return result
 
 
+def fit_svi_loo(args, dataset, heldout, configs, *, warm_start=None):
+    """
+    Fits a batch of leave-one-lineage-out models in a single SVI run, caching
+    each result separately. Since the batched models share the centeredness
+    parameters of their ``LocScaleReparam`` s, results depend slightly on the
+    whole batch, see :func:`pyrocov.mutrans.fit_svi` . Hence each result's
+    cache key includes all held-out sets of its batch, and if any result is
+    missing then the whole batch is refit.
+
+    :param list heldout: A list of lists of held-out clade ids.
+    :param list configs: A list of configs, one per held-out set, differing
+        only in their holdout.
+    :param dict warm_start: An optional result from which to warm start.
+    :returns: A list of results, with None for missing results when
+        ``args.no_new`` is set.
+    :rtype: list
+    """
+    if args.no_cache:
+        return _fit_svi_loo(args, dataset, heldout, configs, warm_start)
+
+    # Lock all results while fitting, so that concurrent workers wait.
+    keys = [
+        cache.key(
+            "mutrans.svi_loo",
+            (args, dataset) + tuple(config),
+            {"warm_start": warm_start, "loo_heldout": heldout},
+            ignore=LOO_FIT_IGNORE,
+        )
+        for config in configs
+    ]
+    filenames = [cache.filename("mutrans.svi_loo", key) for key in keys]
+    with contextlib.ExitStack() as stack:
+        for key in sorted(set(keys)):
+            stack.enter_context(cache.lock(f"mutrans.svi_loo.{key}"))
+        missing = [args.force or not os.path.exists(f) for f in filenames]
+        if any(missing) and not args.no_new:
+            results = _fit_svi_loo(args, dataset, heldout, configs, warm_start)
+            if not args.test:
+                for filename, result in zip(filenames, results):
+                    cache.save(filename, result)
+        else:
+            results = []
+            for config, filename, m in zip(configs, filenames, missing):
+                if m:
+                    logger.info(f"Skipping {config}")
+                    results.append(None)
+                else:
+                    results.append(cache.load(filename))
+    return results
+
+
+def _fit_svi_loo(args, dataset, heldout, configs, warm_start):
+    cond_data, model_type, guide_type, n, lr, lrd, cn, r, f = configs[0][:9]
+    cond_data = [kv.split("=") for kv in cond_data.split(",") if kv]
+    cond_data = {k: float(v) for k, v in cond_data}
+    loo_dataset = mutrans.make_loo_dataset(dataset, heldout)
+    result = mutrans.fit_svi(
+        loo_dataset,
+        cond_data=cond_data,
+        model_type=model_type,
+        guide_type=guide_type,
+        num_steps=n,
+        learning_rate=lr,
+        learning_rate_decay=lrd,
+        clip_norm=cn,
+        rank=r,
+        forecast_steps=f,
+        log_every=args.log_every,
+        seed=args.seed,
+        jit=args.jit,
+        num_samples=args.num_samples,
+        warm_start=warm_start,
+        early_stop=args.early_stop,
+    )
+
+    # Save only what's needed to evaluate loo predictions.
+    K = len(configs)
+    coef = result["median"]["coef"].reshape(K, -1).float()  # [K, F]
+    rate_loc = result["median"]["rate_loc"].reshape(K, -1).float()  # [K, S]
+    results = []
+    for k in range(K):
+        result = {"median": {"coef": coef[k], "rate_loc": rate_loc[k]}}
+        result["args"] = args
+        results.append(result)
+    return results
+
+
+def configure(args):
+    """
+    Configures global torch and cache settings, in both the main process and
+    worker processes.
+    """
+    torch.set_default_dtype(torch.double if args.double else torch.float)
+    if args.cuda:
+        torch.set_default_tensor_type(
+            torch.cuda.DoubleTensor if args.double else torch.cuda.FloatTensor
+        )
+    if args.debug:
+        torch.autograd.set_detect_anomaly(True)
+    if args.cache_max_gb is not None:
+        cache.max_bytes = int(args.cache_max_gb * 1e9)
+
+
+def _init_worker(args, num_threads):
+    configure(args)
+    torch.set_num_threads(num_threads)
+
+
+def _fit_config(args, summarize, config, dataset, warm_start=None):
+    result = fit_svi(args, dataset, *config, warm_start=warm_start)
+    return summarize(args, config, dataset, result)
+
+
+def map_configs(args, summarize, configs, *, warm_start_first=False):
+    """
+    Fits each of a list of independent configs via :func:`fit_svi`, loading
+    each config's dataset by its ``end_day`` and ``holdout``, and returns a
+    list of ``summarize(args, config, dataset, result)``, one per config.
+
+    If ``args.jobs > 1``, configs are fit in a pool of worker processes, each
+    with an equal share of torch threads. Datasets are then loaded once by
+    this process and passed to workers via shared memory. At most
+    ``args.jobs`` datasets are held at once, each released once all of its
+    configs have been fit. Workers are spawned rather than forked, since
+    forking after this process has used torch's OpenMP thread pool, e.g. to
+    fit the first config, can deadlock the workers.
+
+    :param callable summarize: A picklable function extracting what is to be
+        saved from a fit.
+    :param list configs: A list of configs.
+    :param bool warm_start_first: Whether, if ``args.warm_start`` is set, to
+        first fit ``configs[0]`` and warm start the remaining fits from it.
+    :rtype: list
+    """
+
+    def load(config):
+        holdout = hashable_to_holdout(config[-1])
+        return load_data(args, end_day=config[-2], **holdout)
+
+    results = []
+    warm_start = None
+    if warm_start_first and args.warm_start and configs:
+        config, *configs = configs
+        logger.info(f"Config: {config}")
+        dataset = load(config)
+        result = fit_svi(args, dataset, *config)
+        warm_start = get_warm_start(args, result)
+        results.append(summarize(args, config, dataset, result))
+
+        # Cleanup
+        del dataset, result
+        pyro.clear_param_store()
+        gc.collect()
+
+    if args.jobs <= 1:
+        # Sequentially fit models.
+        for config in tqdm.tqdm(configs):
+            logger.info(f"Config: {config}")
+            dataset = load(config)
+            results.append(_fit_config(args, summarize, config, dataset, warm_start))
+
+            # Cleanup
+            del dataset
+            pyro.clear_param_store()
+            gc.collect()
+        return results
+
+    # Fit models in parallel, sharing each dataset among workers.
+    groups = defaultdict(list)
+    for i, config in enumerate(configs):
+        groups[config[-2:]].append(i)
+    num_threads = max(1, torch.get_num_threads() // args.jobs)
+    logger.info(
+        f"Fitting {len(configs)} configs in {args.jobs} processes "
+        f"with {num_threads} threads each"
+    )
+    parallel_results = [None] * len(configs)
+    pending = {}  # future -> (dataset key, config index)
+    num_pending = {}  # dataset key -> number of pending futures
+    with ProcessPoolExecutor(
+        args.jobs,
+        mp_context=torch.multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(args, num_threads),
+    ) as executor:
+
+        def collect(return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                key, i = pending.pop(future)
+                parallel_results[i] = future.result()
+                num_pending[key] -= 1
+                if not num_pending[key]:
+                    del num_pending[key]  # releases the dataset
+
+        for key, indices in groups.items():
+            while len(num_pending) >= args.jobs:
+                collect(FIRST_COMPLETED)
+            dataset = load(configs[indices[0]])
+            for i in indices:
+                future = executor.submit(
+                    _fit_config, args, summarize, configs[i], dataset, warm_start
+                )
+                pending[future] = key, i
+            num_pending[key] = len(indices)
+            del dataset
+        collect(ALL_COMPLETED)
+    results.extend(parallel_results)
+    return results
+
+
+def summarize_fit(args, config, dataset, result):
+    """
+    Collects the results of a fit as saved by :func:`main`.
+    """
+    mutrans.log_stats(dataset, result)
+
+    # Augment gisaid dataset with JHU timeseries counts
+    dataset = dataset.copy()
+    dataset.update(mutrans.load_jhu_data(dataset))
+
+    # Generate results
+    result["mutations"] = dataset["mutations"]
+    result["weekly_clades"] = dataset["weekly_clades"]
+    result["weekly_cases"] = dataset["weekly_cases"]
+    result["weekly_clades_shape"] = tuple(dataset["weekly_clades"].shape)
+    result["location_id"] = dataset["location_id"]
+    result["clade_id_inv"] = dataset["clade_id_inv"]
+    result["clade_to_lineage"] = dataset["clade_to_lineage"]
+    result["lineage_to_clade"] = dataset["lineage_to_clade"]
+    result["location_id_inv"] = dataset["location_id_inv"]
+    result["lineage_id_inv"] = dataset["lineage_id_inv"]
+
+    result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
+
+    # Ensure number of regions match
+    assert dataset["weekly_clades"].shape[1] == result["mean"]["probs"].shape[1]
+    assert dataset["weekly_cases"].shape[1] == result["mean"]["probs"].shape[1]
+    return result
+
+
+def summarize_stats(args, config, dataset, result):
+    """
+    Collects only the statistics of a fit, see :func:`mutrans.log_stats`.
+    """
+    return mutrans.log_stats(dataset, result)
+
+
+def summarize_coef(args, config, dataset, result):
+    """
+    Collects only what is needed to generate plots determining coef_scale.
+    """
+    mutrans.log_stats(dataset, result)
+    result = {
+        "mutations": dataset["mutations"],
+        "mean": {"coef": result["mean"]["coef"]},
+        "std": {"coef": result["std"]["coef"]},
+    }
+    return torch_map(result, device="cpu", dtype=torch.float)  # to save space
+
+
 def backtesting(args, default_config):
     configs = []
     empty_holdout = ()
@@ -178,51 +451,11 @@ def backtesting(args, default_config):
                 empty_holdout,
             )
         )
-    # Sequentially fit models.
-    results = {}
-    for config in configs:
-        logger.info(f"Config: {config}")
-
-        # Holdout is the last in the config
-        holdout = hashable_to_holdout(config[-1])
-        # end_day is second from last
-        end_day = config[-2]
-
-        # load dataset
-        dataset = load_data(args, end_day=end_day, **holdout)
-
-        # Run SVI
-        result = fit_svi(args, dataset, *config)
-        mutrans.log_stats(dataset, result)
-
-        # Save the results for this config
-
-        # Augment gisaid dataset with JHU timeseries counts
-        dataset.update(mutrans.load_jhu_data(dataset))
-
-        # Generate results
-        result["mutations"] = dataset["mutations"]
-        result["weekly_clades"] = dataset["weekly_clades"]
-        result["weekly_cases"] = dataset["weekly_cases"]
-        result["weekly_clades_shape"] = tuple(dataset["weekly_clades"].shape)
-        result["location_id"] = dataset["location_id"]
-        result["clade_id_inv"] = dataset["clade_id_inv"]
-        result["clade_to_lineage"] = dataset["clade_to_lineage"]
-        result["lineage_to_clade"] = dataset["lineage_to_clade"]
-        result["location_id_inv"] = dataset["location_id_inv"]
-        result["lineage_id_inv"] = dataset["lineage_id_inv"]
-
-        result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
-        results[config] = result
-
-        # Ensure number of regions match
-        assert dataset["weekly_clades"].shape[1] == result["mean"]["probs"].shape[1]
-        assert dataset["weekly_cases"].shape[1] == result["mean"]["probs"].shape[1]
-
-        # Cleanup
-        del dataset
-        pyro.clear_param_store()
-        gc.collect()
+    # Fit models, warm starting from the earliest fit to avoid leaking data.
+    configs.sort(key=lambda config: config[-2])
+    results = dict(
+        zip(configs, map_configs(args, summarize_fit, configs, warm_start_first=True))
+    )
 
     if args.vary_holdout:
         mutrans.log_holdout_stats({k[-1]: v for k, v in results.items()})
@@ -239,7 +472,7 @@ def vary_leaves(args, default_config):
     """
     # Load a single common dataset.
     dataset = load_data(args)
-    descendents = pangolin.find_descendents(dataset["clade_id_inv"])
+    lineage_index = pangolin.LineageIndex(dataset["clade_id_inv"])
 
     # Run default config to get a ranking of leaves.
     def make_config(**holdout):
@@ -259,9 +492,13 @@ def vary_leaves(args, default_config):
     # Run inference for each lineage. This is very expensive.
     lineage_to_clade = dataset["lineage_to_clade"]
     clade_id = dataset["clade_id"]
-    num_obs = int(dataset["weekly_clades"].sum())
+    clade_counts = dataset["weekly_clades"].sum([0, 1])
+    heldout_counts = lineage_index.subtree_sum(clade_counts).tolist()
+    num_obs = int(clade_counts.sum())
     results = {}
-    for lineage in tqdm.tqdm([None] + lineages):
+    warm_start = None
+    batch_size = args.loo_batch_size
+    for lineage in tqdm.tqdm([None] + (lineages if batch_size <= 1 else [])):
         if lineage is None:
             # Run with the full dataset.
             config = default_config
@@ -270,9 +507,8 @@ def vary_leaves(args, default_config):
             # Construct a leave-one-out dataset by zeroing out a subclade.
             config = make_config(exclude={"lineage": "^" + lineage + "$"})
             clade = lineage_to_clade[lineage]
-            heldout = [clade_id[clade]]
-            for descendent in descendents[clade]:
-                heldout.append(clade_id[descendent])
+            c = clade_id[clade]
+            heldout = [c] + lineage_index.get_descendent_ids(clade)
             loo_dataset = dataset.copy()
             weekly_clades = dataset["weekly_clades"].clone()
             weekly_clades[:, :, heldout] = 0
@@ -281,18 +517,20 @@ def vary_leaves(args, default_config):
             loo_dataset["pc_index"] = (
                 weekly_clades.ne(0).any(0).reshape(-1).nonzero(as_tuple=True)[0]
             )
-            loo_num_obs = int(loo_dataset["weekly_clades"].sum())
-            logger.info(f"Holding out {num_obs - loo_num_obs}/{num_obs} samples")
+            logger.info(f"Holding out {int(heldout_counts[c])}/{num_obs} samples")
 
         # Run SVI
         logger.info(f"Config: {config}")
         try:
-            result = fit_svi(args, loo_dataset, *config)
+            result = fit_svi(args, loo_dataset, *config, warm_start=warm_start)
         except ValueError as e:
             if not args.no_new:
                 raise e from None
             logger.info(f"Skipping {config}")
             continue
+        if lineage is None:
+            # Warm start leave-one-out fits from the full fit.
+            warm_start = get_warm_start(args, result)
         result["mutations"] = dataset["mutations"]
         result["location_id"] = dataset["location_id"]
         result["clade_id_inv"] = dataset["clade_id_inv"]
@@ -303,6 +541,34 @@ def vary_leaves(args, default_config):
         pyro.clear_param_store()
         gc.collect()
 
+    if batch_size > 1:
+        # Fit batches of leave-one-out models, one SVI run per batch.
+        for i in tqdm.tqdm(range(0, len(lineages), batch_size)):
+            batch = lineages[i : i + batch_size]
+            configs = []
+            heldout = []
+            for lineage in batch:
+                configs.append(make_config(exclude={"lineage": "^" + lineage + "$"}))
+                clade = lineage_to_clade[lineage]
+                c = clade_id[clade]
+                heldout.append([c] + lineage_index.get_descendent_ids(clade))
+                logger.info(f"Holding out {int(heldout_counts[c])}/{num_obs} samples")
+            logger.info(f"Configs: {configs}")
+            batch_results = fit_svi_loo(
+                args, dataset, heldout, configs, warm_start=warm_start
+            )
+            for config, result in zip(configs, batch_results):
+                if result is None:
+                    continue
+                result["mutations"] = dataset["mutations"]
+                result["location_id"] = dataset["location_id"]
+                result["clade_id_inv"] = dataset["clade_id_inv"]
+                results[config] = result
+
+            # Cleanup
+            pyro.clear_param_store()
+            gc.collect()
+
     if not args.test:
         logger.info("saving results/mutrans.vary_leaves.pt")
         torch.save(results, "results/mutrans.vary_leaves.pt")
@@ -331,21 +597,14 @@ def vary_gene(args, default_config, *, exclude_genes=False):
         config = tuple(config)
         return config
 
-    results = {}
-    for holdout in tqdm.tqdm(grid):
-        # Fit a single model.
-        logger.info(f"Holdout: {holdout}")
-        dataset = load_data(args, **holdout)
-        result = fit_svi(args, dataset, *make_config(**holdout))
-
-        # Save metrics.
-        key = holdout_to_hashable(holdout)
-        results[key] = mutrans.log_stats(dataset, result)
-
-        # Clean up to save memory.
-        del dataset, result
-        pyro.clear_param_store()
-        gc.collect()
+    # Fit models, warm starting from the first, largest model.
+    configs = [make_config(**holdout) for holdout in grid]
+    results = dict(
+        zip(
+            [config[-1] for config in configs],
+            map_configs(args, summarize_stats, configs, warm_start_first=True),
+        )
+    )
 
     if not args.test:
         logger.info("saving results/mutrans.vary_gene.pt")
@@ -369,21 +628,14 @@ def vary_nsp(args, default_config):
         config = tuple(config)
         return config
 
-    results = {}
-    for holdout in tqdm.tqdm(grid):
-        # Fit a single model.
-        logger.info(f"Holdout: {holdout}")
-        dataset = load_data(args, **holdout)
-        result = fit_svi(args, dataset, *make_config(**holdout))
-
-        # Save metrics.
-        key = holdout_to_hashable(holdout)
-        results[key] = mutrans.log_stats(dataset, result)
-
-        # Clean up to save memory.
-        del dataset, result
-        pyro.clear_param_store()
-        gc.collect()
+    # Fit models, warm starting from the first, largest model.
+    configs = [make_config(**holdout) for holdout in grid]
+    results = dict(
+        zip(
+            [config[-1] for config in configs],
+            map_configs(args, summarize_stats, configs, warm_start_first=True),
+        )
+    )
 
     if not args.test:
         logger.info("saving results/mutrans.vary_nsp.pt")
@@ -416,36 +668,7 @@ def vary_coef_scale(args, default_config):
             )
             configs.append(config)
 
-    # Sequentially fit models.
-    results = {}
-    for config in configs:
-        logger.info(f"Config: {config}")
-
-        # Holdout is the last in the config
-        holdout = hashable_to_holdout(config[-1])
-        # end_day is second from last
-        end_day = config[-2]
-
-        # load dataset
-        dataset = load_data(args, end_day=end_day, **holdout)
-
-        # Run SVI
-        result = fit_svi(args, dataset, *config)
-        mutrans.log_stats(dataset, result)
-
-        # Save only what is needed to generate plots determining coef_scale.
-        result = {
-            "mutations": dataset["mutations"],
-            "mean": {"coef": result["mean"]["coef"]},
-            "std": {"coef": result["std"]["coef"]},
-        }
-        result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
-        results[config] = result
-
-        # Cleanup
-        del dataset
-        pyro.clear_param_store()
-        gc.collect()
+    results = dict(zip(configs, map_configs(args, summarize_coef, configs)))
 
     if not args.test:
         logger.info("saving results/mutrans.vary_coef_scale.pt")
@@ -456,13 +679,9 @@ def main(args):
     """Main Entry Point"""
 
     # Torch configuration
-    torch.set_default_dtype(torch.double if args.double else torch.float)
-    if args.cuda:
-        torch.set_default_tensor_type(
-            torch.cuda.DoubleTensor if args.double else torch.cuda.FloatTensor
-        )
-    if args.debug:
-        torch.autograd.set_detect_anomaly(True)
+    configure(args)
+    if args.jobs > 1 and args.cuda:
+        raise ValueError("--jobs is supported only with --cpu")
 
     # Configure fits.
     configs = []
@@ -564,51 +783,7 @@ def main(args):
     else:
         configs.append(default_config)
 
-    # Sequentially fit models.
-    results = {}
-    for config in configs:
-        logger.info(f"Config: {config}")
-
-        # Holdout is the last in the config
-        holdout = hashable_to_holdout(config[-1])
-        # end_day is second from last
-        end_day = config[-2]
-
-        # load dataset
-        dataset = load_data(args, end_day=end_day, **holdout)
-
-        # Run SVI
-        result = fit_svi(args, dataset, *config)
-        mutrans.log_stats(dataset, result)
-
-        # Save the results for this config
-
-        # Augment gisaid dataset with JHU timeseries counts
-        dataset.update(mutrans.load_jhu_data(dataset))
-
-        # Generate results
-        result["mutations"] = dataset["mutations"]
-        result["weekly_clades"] = dataset["weekly_clades"]
-        result["weekly_cases"] = dataset["weekly_cases"]
-        result["weekly_clades_shape"] = tuple(dataset["weekly_clades"].shape)
-        result["location_id"] = dataset["location_id"]
-        result["clade_id_inv"] = dataset["clade_id_inv"]
-        result["clade_to_lineage"] = dataset["clade_to_lineage"]
-        result["lineage_to_clade"] = dataset["lineage_to_clade"]
-        result["location_id_inv"] = dataset["location_id_inv"]
-        result["lineage_id_inv"] = dataset["lineage_id_inv"]
-
-        result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
-        results[config] = result
-
-        # Ensure number of regions match
-        assert dataset["weekly_clades"].shape[1] == result["mean"]["probs"].shape[1]
-        assert dataset["weekly_cases"].shape[1] == result["mean"]["probs"].shape[1]
-
-        # Cleanup
-        del dataset
-        pyro.clear_param_store()
-        gc.collect()
+    results = dict(zip(configs, map_configs(args, summarize_fit, configs)))
 
     if args.vary_holdout:
         mutrans.log_holdout_stats({k[-1]: v for k, v in results.items()})
@@ -626,12 +801,23 @@ if __name__ == "__main__":
     parser.add_argument("--vary-coef-scale", help="comma delimited list of coef_scale")
     parser.add_argument("--vary-holdout", action="store_true")
     parser.add_argument("--vary-leaves", action="store_true")
+    parser.add_argument(
+        "--loo-batch-size",
+        default=1,
+        type=int,
+        help="number of leave-one-out models to fit per SVI run in --vary-leaves",
+    )
     parser.add_argument("--vary-gene", action="store_true")
     parser.add_argument("--vary-nsp", action="store_true")
     parser.add_argument("--gisaid", action="store_true", default=False)
     parser.add_argument("--max-num-clades", default=3000, type=int)
     parser.add_argument("--min-num-mutations", default=1, type=int)
     parser.add_argument("--min-region-size", default=50, type=int)
+    parser.add_argument(
+        "--sparse-features",
+        action="store_true",
+        help="use sparse feature matrices, e.g. for many clades",
+    )
     parser.add_argument("-cd", "--cond-data", default="coef_scale=0.05")
     parser.add_argument("-m", "--model-type", default="reparam-localinit")
     parser.add_argument("-g", "--guide-type", default="full")
@@ -653,6 +839,36 @@ if __name__ == "__main__":
     parser.add_argument("--no-jit", dest="jit", action="store_false")
     parser.add_argument("--seed", default=20210319, type=int)
     parser.add_argument("-l", "--log-every", default=100, type=int)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="number of worker processes in which to fit independent configs",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="initialize perturbed fits, e.g. in --vary-leaves, from a full fit",
+    )
+    parser.add_argument(
+        "--early-stop",
+        default=0.0,
+        type=float,
+        help="stop SVI once the loss per observation improves by less than this "
+        "per 100 steps",
+    )
+    parser.add_argument(
+        "--subsample-size",
+        type=int,
+        help="number of places to subsample per SVI step, e.g. for fitting "
+        "with small --min-region-size",
+    )
+    parser.add_argument(
+        "--cache-max-gb",
+        type=float,
+        help="disk budget for cached results, evicting least recently used",
+    )
     parser.add_argument("--no-new", action="store_true")
     parser.add_argument("--no-cache", action="store_true")
     parser.add_argument("--force", action="store_true")
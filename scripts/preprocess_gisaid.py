@@ -7,13 +7,11 @@ import json
 import logging
 import os
 import pickle
-import warnings
 from collections import Counter, defaultdict
 
-from pyrocov import pangolin
-from pyrocov.geo import gisaid_normalize
+from pyrocov import geo, pangolin
 from pyrocov.mutrans import START_DATE
-from pyrocov.util import open_tqdm
+from pyrocov.util import LRUCache, load_lru_caches, open_tqdm, save_lru_caches
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
@@ -21,6 +19,7 @@ logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.IN
 DATE_FORMATS = {4: "%Y", 7: "%Y-%m", 10: "%Y-%m-%d"}
 
 
+@LRUCache
 def parse_date(string):
     fmt = DATE_FORMATS.get(len(string))
     if fmt is None:
@@ -32,6 +31,11 @@ def parse_date(string):
     return datetime.datetime.strptime(string, fmt)
 
 
+gisaid_normalize = LRUCache(geo.gisaid_normalize)
+
+# Memoized functions whose caches are persisted across runs via --cache-file.
+CACHES = {"gisaid.parse_date": parse_date, "gisaid_normalize": gisaid_normalize}
+
 FIELDS = ["virus_name", "accession_id", "collection_date", "location", "add_location"]
 
 
@@ -42,7 +46,6 @@ def main(args):
     os.makedirs("results", exist_ok=True)
 
     columns = defaultdict(list)
-    stats = defaultdict(Counter)
     covv_fields = ["covv_" + key for key in FIELDS]
 
     for i, line in enumerate(open_tqdm(args.gisaid_file_in)):
@@ -60,13 +63,6 @@ def main(args):
         lineage = datum["covv_lineage"]
         if lineage in (None, "None", ""):
             continue  # Drop rows with unknown lineage.
-        try:
-            lineage = pangolin.compress(lineage)
-            lineage = pangolin.decompress(lineage)
-            assert lineage
-        except (ValueError, AssertionError) as e:
-            warnings.warn(str(e))
-            continue
 
         # Fix duplicate locations.
         datum["covv_location"] = gisaid_normalize(datum["covv_location"])
@@ -77,14 +73,28 @@ def main(args):
             columns[key].append(datum[covv_key])
         columns["day"].append((date - args.start_date).days)
 
-        # Aggregate statistics.
-        stats["date"][datum["covv_collection_date"]] += 1
-        stats["location"][datum["covv_location"]] += 1
-        stats["lineage"][lineage] += 1
-
         if i >= args.truncate:
             break
 
+    # Resolve lineage aliases once per unique lineage rather than once per row.
+    unique = list(dict.fromkeys(columns["lineage"]))
+    compressed = pangolin.compress_many(unique, errors="warn")
+    valid = [c for c in compressed if c is not None]
+    decompressed = dict(zip(valid, pangolin.decompress_many(valid, errors="warn")))
+    resolved = {u: decompressed.get(c) for u, c in zip(unique, compressed)}
+    keep = [bool(resolved[lineage]) for lineage in columns["lineage"]]
+    if not all(keep):
+        for key, values in list(columns.items()):
+            columns[key] = [v for v, k in zip(values, keep) if k]
+    columns["lineage"] = [resolved[lineage] for lineage in columns["lineage"]]
+
+    # Aggregate statistics.
+    stats = {
+        "date": Counter(columns["collection_date"]),
+        "location": Counter(columns["location"]),
+        "lineage": Counter(columns["lineage"]),
+    }
+
     num_dropped = i + 1 - len(columns["day"])
     logger.info(f"dropped {num_dropped}/{i+1} = {num_dropped*100/(i+1):0.2g}% rows")
 
@@ -94,7 +104,7 @@ def main(args):
 
     logger.info(f"saving {args.stats_file_out}")
     with open(args.stats_file_out, "wb") as f:
-        pickle.dump(dict(stats), f)
+        pickle.dump(stats, f)
 
 
 if __name__ == "__main__":
@@ -104,6 +114,15 @@ if __name__ == "__main__":
     parser.add_argument("--stats-file-out", default="results/gisaid.stats.pkl")
     parser.add_argument("--start-date", default=START_DATE)
     parser.add_argument("--truncate", default=int(1e10), type=int)
+    parser.add_argument(
+        "--cache-file",
+        default="results/preprocess.cache.pkl",
+        help="file to persist parsed dates and locations across runs",
+    )
     args = parser.parse_args()
     args.start_date = parse_date(args.start_date)
+    load_lru_caches(args.cache_file, CACHES)
     main(args)
+    for cache in CACHES.values():
+        logger.info(cache)
+    save_lru_caches(args.cache_file, CACHES)
@@ -21,16 +21,21 @@ from collections import Counter, defaultdict
 import torch
 
 from pyrocov.growth import START_DATE, dense_to_sparse
-from pyrocov.util import gzip_open_tqdm
+from pyrocov.util import LRUCache, gzip_open_tqdm, load_lru_caches, save_lru_caches
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
+@LRUCache
 def parse_date(string):
     return datetime.datetime.strptime(string, "%Y-%m-%d")
 
 
+# Memoized functions whose caches are persisted across runs via --cache-file.
+CACHES = {"nextstrain.parse_date": parse_date}
+
+
 def coarsen_locations(args, counts):
     """
     Select regions that have at least ``args.min_region_size`` samples.
@@ -191,6 +196,15 @@ if __name__ == "__main__":
     parser.add_argument("--start-date", default=START_DATE)
     parser.add_argument("--time-step-days", default=14, type=int)
     parser.add_argument("--min-region-size", default=50, type=int)
+    parser.add_argument(
+        "--cache-file",
+        default="results/preprocess.cache.pkl",
+        help="file to persist parsed dates across runs",
+    )
     args = parser.parse_args()
     args.start_date = parse_date(args.start_date)
+    load_lru_caches(args.cache_file, CACHES)
     main(args)
+    for cache in CACHES.values():
+        logger.info(cache)
+    save_lru_caches(args.cache_file, CACHES)
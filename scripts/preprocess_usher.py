@@ -3,27 +3,42 @@
 
 import argparse
 import datetime
+import functools
+import io
 import logging
 import math
+import multiprocessing as mp
+import os
 import pickle
 import re
 from collections import Counter, defaultdict
 
+import numpy as np
 import pandas as pd
 import torch
 import tqdm
 
-from pyrocov.geo import get_canonical_location_generator, gisaid_normalize
+from pyrocov import geo
+from pyrocov.columnar import append_columns, save_columnar
 from pyrocov.mutrans import START_DATE
-from pyrocov.sarscov2 import nuc_mutations_to_aa_mutations
+from pyrocov.sarscov2 import nuc_mutations_to_aa_mutations_batch
 from pyrocov.usher import (
     FineToMeso,
+    decode_mutations,
+    load_array_tree,
     load_mutation_tree,
-    load_proto,
-    prune_mutation_tree,
+    prune_mutation_trees,
     refine_mutation_tree,
 )
-from pyrocov.util import gzip_open_tqdm
+from pyrocov.util import (
+    LRUCache,
+    gunzip_tempfile,
+    gzip_open_tqdm,
+    load_lru_caches,
+    read_lines,
+    save_lru_caches,
+    split_lines,
+)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
@@ -31,6 +46,7 @@ logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.IN
 DATE_FORMATS = {7: "%Y-%m", 10: "%Y-%m-%d"}
 
 
+@LRUCache
 def try_parse_date(string):
     fmt = DATE_FORMATS.get(len(string))
     if fmt is not None:
@@ -40,6 +56,33 @@ def try_parse_date(string):
             return
 
 
+gisaid_normalize = LRUCache(geo.gisaid_normalize)
+
+_CANONICAL_LOCATION = {
+    recover: geo.get_canonical_location_generator(recover) for recover in (False, True)
+}
+
+
+def _canonical_location_key(recover, strain, region, country, division, location):
+    # The strain is needed only to recover a missing USA state.
+    if recover and country == "USA" and division == "USA":
+        return recover, strain, region, country, division
+    return recover, None, region, country, division
+
+
+@functools.partial(LRUCache, key=_canonical_location_key, depends=[geo])
+def get_canonical_location(recover, strain, region, country, division, location):
+    return _CANONICAL_LOCATION[recover](strain, region, country, division, location)
+
+
+# Memoized functions whose caches are persisted across runs via --cache-file.
+CACHES = {
+    "usher.try_parse_date": try_parse_date,
+    "gisaid_normalize": gisaid_normalize,
+    "canonical_location": get_canonical_location,
+}
+
+
 def try_parse_genbank(strain):
     match = re.search(r"([A-Z]+[0-9]+)\.[0-9]", strain)
     if match:
@@ -56,17 +99,9 @@ def try_parse_gisaid(string, public_to_gisaid):
             return result
 
 
-def load_nextstrain_metadata(args):
-    """
-    Returns a dict of dictionaries from genbank_accession to metadata.
-    """
-    logger.info("Loading nextstrain metadata")
-    get_canonical_location = get_canonical_location_generator(
-        args.recover_missing_usa_state
-    )
-    df = pd.read_csv("results/nextstrain/metadata.tsv", sep="\t", dtype=str)
+def _parse_nextstrain_rows(rows, start_date, recover_missing_usa_state):
     result = defaultdict(dict)
-    for row in tqdm.tqdm(df.itertuples(), total=len(df)):
+    for row in rows:
         # Key on genbank accession.
         key = row.genbank_accession
         if not isinstance(key, str) or not key:
@@ -77,13 +112,18 @@ def load_nextstrain_metadata(args):
         if isinstance(date, str) and date and date != "?":
             date = try_parse_date(date)
             if date is not None:
-                if date < args.start_date:
-                    date = args.start_date  # Clip rows before start date.
-                result["day"][key] = (date - args.start_date).days
+                if date < start_date:
+                    date = start_date  # Clip rows before start date.
+                result["day"][key] = (date - start_date).days
 
         # Extract a standard location.
         location = get_canonical_location(
-            row.strain, row.region, row.country, row.division, row.location
+            recover_missing_usa_state,
+            row.strain,
+            row.region,
+            row.country,
+            row.division,
+            row.location,
         )
         if location is not None:
             location = gisaid_normalize(location)
@@ -93,7 +133,81 @@ def load_nextstrain_metadata(args):
         lineage = row.pango_lineage
         if isinstance(lineage, str) and lineage and lineage != "?":
             result["lineage"][key] = lineage
+    return dict(result)
+
+
+def _load_nextstrain_chunk(filename, begin, end, header, *args):
+    text = "".join(read_lines(filename, begin, end))
+    df = pd.read_csv(io.StringIO(text), sep="\t", dtype=str, header=None, names=header)
+    return _parse_nextstrain_rows(df.itertuples(), *args)
+
+
+def load_nextstrain_metadata(args):
+    """
+    Returns a dict of dictionaries from genbank_accession to metadata.
+    """
+    logger.info("Loading nextstrain metadata")
+    filename = "results/nextstrain/metadata.tsv"
+    if args.processes > 1:
+        return load_parallel(
+            _load_nextstrain_chunk,
+            filename,
+            args.processes,
+            args.start_date,
+            args.recover_missing_usa_state,
+        )
+    df = pd.read_csv(filename, sep="\t", dtype=str)
+    result = _parse_nextstrain_rows(
+        tqdm.tqdm(df.itertuples(), total=len(df)),
+        args.start_date,
+        args.recover_missing_usa_state,
+    )
+    result = defaultdict(dict, result)
+    logger.info("Found metadata:\n{}".format({k: len(v) for k, v in result.items()}))
+    return result
+
+
+def _load_chunk(task):
+    fn, *args = task
+    for cache in CACHES.values():
+        cache.pop_stats()  # Reset stats inherited from the parent process.
+        cache.record_updates = True
+    result = fn(*args)
+    cache_stats = {name: cache.pop_stats() for name, cache in CACHES.items()}
+    return result, cache_stats
 
+
+def load_parallel(fn, filename, processes, *args):
+    """
+    Parses a tsv file in parallel by splitting it into byte ranges aligned to
+    line boundaries, calling ``fn(filename, begin, end, header, *args)`` on
+    each range in a process pool, and merging the resulting dicts of dicts.
+    Gzipped files are first decompressed to a temporary file.
+
+    Note this assumes the file has one record per line, i.e. that no quoted
+    field contains an embedded newline, since chunks are split on newlines.
+    """
+    if filename.endswith(".gz"):
+        logger.info(f"Decompressing {filename}")
+        with gunzip_tempfile(filename) as tempname:
+            return load_parallel(fn, tempname, processes, *args)
+
+    with open(filename, "rb") as f:
+        header = f.readline()
+    begin = len(header)
+    header = header.decode("utf-8").strip().split("\t")
+    chunks = split_lines(filename, 4 * processes, begin)
+    tasks = [(fn, filename, b, e, header) + args for b, e in chunks]
+    logger.info(f"Parsing {len(tasks)} chunks with {processes} processes")
+    result = defaultdict(dict)
+    with mp.Pool(processes) as pool:
+        for part, cache_stats in tqdm.tqdm(
+            pool.imap(_load_chunk, tasks), total=len(tasks)
+        ):
+            for k, v in part.items():
+                result[k].update(v)
+            for name, stats in cache_stats.items():
+                CACHES[name].merge_stats(*stats)
     logger.info("Found metadata:\n{}".format({k: len(v) for k, v in result.items()}))
     return result
 
@@ -147,52 +261,73 @@ def load_usher_metadata(args):
     return result
 
 
-def load_gisaid_metadata(args):
-    """
-    Returns a dict of dictionaries from gisaid accession to metadata.
-    """
-    filename = args.gisaid_metadata_file_in
-    logger.info(f"Loading gisaid metadata from {filename}")
-    assert filename.endswith(".tsv.gz")
+GISAID_FIELDS = ["Accession ID", "Collection date", "Location", "Pango lineage"]
+
+
+def _parse_gisaid_lines(lines, header, start_date):
+    # Look up column positions once rather than building a dict per row.
+    positions = [header.index(f) if f in header else None for f in GISAID_FIELDS]
     result = defaultdict(dict)
-    header = ()
-    for i, line in enumerate(gzip_open_tqdm(filename, "rt")):
+    for line in lines:
         line = line.strip().split("\t")
-        if i == 0:
-            header = tuple(line)
-            continue
-        row = dict(zip(header, line))
+        key, date, location, lineage = (
+            line[i] if i is not None and i < len(line) else None for i in positions
+        )
 
         # Key on gisaid accession id.
-        key = row.get("Accession ID")
         if not key:
             continue
 
         # Extract date.
-        date = row.get("Collection date")
         if date and date != "?":
             date = try_parse_date(date)
             if date is not None:
-                if date < args.start_date:
-                    date = args.start_date  # Clip rows before start date.
-                result["day"][key] = (date - args.start_date).days
+                if date < start_date:
+                    date = start_date  # Clip rows before start date.
+                result["day"][key] = (date - start_date).days
 
         # Extract location.
-        location = row.get("Location")
         if location:
             location = gisaid_normalize(location)
             result["location"][key] = location
 
         # Extract pango lineage.
-        lineage = row.get("Pango lineage")
         if lineage:
             result["lineage"][key] = lineage
+    return dict(result)
+
+
+def _load_gisaid_chunk(filename, begin, end, header, start_date):
+    return _parse_gisaid_lines(read_lines(filename, begin, end), header, start_date)
 
+
+def load_gisaid_metadata(args):
+    """
+    Returns a dict of dictionaries from gisaid accession to metadata.
+    """
+    filename = args.gisaid_metadata_file_in
+    logger.info(f"Loading gisaid metadata from {filename}")
+    assert filename.endswith(".tsv.gz")
+    if args.processes > 1:
+        return load_parallel(
+            _load_gisaid_chunk, filename, args.processes, args.start_date
+        )
+    lines = gzip_open_tqdm(filename, "rt")
+    header = next(lines).strip().split("\t")
+    result = defaultdict(dict, _parse_gisaid_lines(lines, header, args.start_date))
     logger.info("Found metadata:\n{}".format({k: len(v) for k, v in result.items()}))
     return result
 
 
-def load_metadata(args):
+def load_metadata(args, *, keep_key=None):
+    """
+    Joins metadata to samples in the usher tree, returning columns and a
+    count of rows per tree node.
+
+    :param callable keep_key: An optional predicate on sample keys. If
+        provided, only matching samples are collected and neither columns nor
+        stats are saved; this is used for incremental updates.
+    """
     # Load metadata.
     public_to_gisaid = {}
     if args.gisaid_metadata_file_in:
@@ -218,28 +353,28 @@ def load_metadata(args):
 
     # Load usher tree.
     # Collect all names appearing in the usher tree.
-    nuc_mutations_by_clade, proto, tree = load_mutation_tree(args.tree_file_out)
+    nuc_mutations_by_clade, proto, tree = load_mutation_tree(
+        args.tree_file_out, as_codes=True
+    )
     assert nuc_mutations_by_clade
 
     # Collect background mutation statistics.
     stats = defaultdict(Counter)
     aa_substitutions = stats["aaSubstitutions"]
-    for mutations in nuc_mutations_by_clade.values():
-        aa_substitutions.update(nuc_mutations_to_aa_mutations(mutations))
+    for aa_mutations in nuc_mutations_to_aa_mutations_batch(
+        nuc_mutations_by_clade.values()
+    ):
+        aa_substitutions.update(aa_mutations)
 
     # Collect condensed samples.
     condensed_nodes = {}
     for node in proto.condensed_nodes:
         condensed_nodes[node.node_name] = list(node.condensed_leaves)
 
-    # Propagate fine clade names downward.
-    node_to_clade = {}
-    for clade, meta in zip(tree.find_clades(), proto.metadata):
-        if meta.clade:
-            node_to_clade[clade] = meta.clade
-        # Propagate down to descendent clones.
-        for child in clade.clades:
-            node_to_clade[child] = node_to_clade[clade]
+    # Propagate fine clade names downward to descendent clones.
+    node_to_clade = []
+    for parent, meta in zip(tree.parents.tolist(), proto.metadata):
+        node_to_clade.append(meta.clade or node_to_clade[parent])
 
     # Collect info from each node in the tree.
     fields = "day", "location", "lineage"
@@ -248,8 +383,8 @@ def load_metadata(args):
     skipped = stats["skipped"]
     skipped_by_day = Counter()
     nodename_to_count = Counter()
-    for node, meta in zip(tree.find_clades(), proto.metadata):
-        keys = condensed_nodes.get(node.name, [node.name])
+    for node, name in enumerate(tree.names):
+        keys = condensed_nodes.get(name, [name])
         for key in keys:
             if key is None:
                 continue
@@ -260,6 +395,8 @@ def load_metadata(args):
                 if key is None:
                     skipped["no gisaid id"] += 1
                     continue
+            if keep_key is not None and not keep_key(key):
+                continue
 
             row = {k: metadata[k].get(key) for k in fields}
             if row["day"] is None:
@@ -274,10 +411,13 @@ def load_metadata(args):
             columns["index"].append(key)
             for k, v in row.items():
                 columns[k].append(v)
-            nodename_to_count[node.name] += 1
+            nodename_to_count[name] += 1
     logger.info(f"Found {len(sample_keys)} samples in the usher tree")
     logger.info(f"Skipped {sum(skipped.values())} nodes because:\n{skipped}")
     columns = dict(columns)
+    if keep_key is not None:
+        logger.info(f"Kept {len(columns.get('day', []))} new rows")
+        return columns, nodename_to_count
     assert columns
     assert len(set(map(len, columns.values()))) == 1, "columns have unequal length"
     assert sum(skipped.values()) < args.max_skippage, f"suspicious skippage:\n{skipped}"
@@ -295,39 +435,55 @@ def load_metadata(args):
     return columns, nodename_to_count
 
 
+def get_pruned_tree_file_out(max_num_clades):
+    return f"results/lineageTree.{max_num_clades}.pb"
+
+
+def get_columns_file_out(max_num_clades):
+    return f"results/columns.{max_num_clades}.pkl"
+
+
+def get_features_file_out(max_num_clades):
+    return f"results/features.{max_num_clades}.1.pt"
+
+
 def prune_tree(args, max_num_clades, coarse_to_fine, nodename_to_count):
-    proto, tree = load_proto(args.tree_file_out)
+    """
+    Prunes the fine tree to each of a list of resolutions, in a single greedy
+    pruning pass. Returns a list of ``(fine_to_meso, pruned_tree_filename)``
+    pairs, one per entry of ``max_num_clades``.
+    """
+    proto, tree = load_array_tree(args.tree_file_out)
+    children = tree.children.tolist()
+    child_offsets = tree.child_offsets.tolist()
+    reverse_clades = range(len(tree) - 1, -1, -1)  # from leaves to root
 
     # Add weights for leaves.
-    cum_weights = {}
-    mrca_weights = {}
-    for clade in tree.find_clades():
-        count = nodename_to_count[clade.name]
-        cum_weights[clade] = count
-        mrca_weights[clade] = count**2
+    cum_weights = [nodename_to_count[name] for name in tree.names]
+    mrca_weights = [count**2 for count in cum_weights]
 
     # Add weights of MRCA pairs.
-    reverse_clades = list(tree.find_clades())
-    reverse_clades.reverse()  # from leaves to root
     for parent in reverse_clades:
-        for child in parent.clades:
+        kids = children[child_offsets[parent] : child_offsets[parent + 1]]
+        for child in kids:
             cum_weights[parent] += cum_weights[child]
-        for child in parent.clades:
+        for child in kids:
             mrca_weights[parent] += cum_weights[child] * (
                 cum_weights[parent] - cum_weights[child]
             )
     num_samples = sum(nodename_to_count.values())
-    assert cum_weights[tree.root] == num_samples
-    assert sum(mrca_weights.values()) == num_samples**2
+    assert cum_weights[0] == num_samples
+    assert sum(mrca_weights) == num_samples**2
 
     # Aggregate among clones to basal representative.
     weights = defaultdict(float)
     for meta, parent in zip(reversed(proto.metadata), reverse_clades):
-        for child in parent.clades:
-            mrca_weights[parent] += mrca_weights.get(child, 0)
+        for child in children[child_offsets[parent] : child_offsets[parent + 1]]:
+            mrca_weights[parent] += mrca_weights[child]
         assert isinstance(meta.clade, str)
         if meta.clade:
-            weights[meta.clade] = mrca_weights.pop(parent)
+            weights[meta.clade] = mrca_weights[parent]
+            mrca_weights[parent] = 0  # moved to weights
     assert sum(weights.values()) == num_samples**2
 
     # To ensure pango lineages remain distinct, set their weights to infinity.
@@ -336,28 +492,27 @@ def prune_tree(args, max_num_clades, coarse_to_fine, nodename_to_count):
     assert "" not in weights
 
     # Prune the tree, minimizing the number of incorrect mutations.
-    max_num_clades = max(max_num_clades, len(coarse_to_fine))
-    pruned_tree_filename = f"results/lineageTree.{max_num_clades}.pb"
-    meso_set = prune_mutation_tree(
-        args.tree_file_out, pruned_tree_filename, max_num_clades, weights
-    )
-    assert len(meso_set) == max_num_clades
-    return FineToMeso(meso_set), pruned_tree_filename
+    max_num_clades = [max(n, len(coarse_to_fine)) for n in max_num_clades]
+    filenames = {n: get_pruned_tree_file_out(n) for n in max_num_clades}
+    meso_sets = prune_mutation_trees(args.tree_file_out, filenames, weights)
+    result = []
+    for n in max_num_clades:
+        assert len(meso_sets[n]) == n
+        result.append((FineToMeso(meso_sets[n]), filenames[n]))
+    return result
 
 
 def extract_features(
     args,
     max_num_clades,
+    fine_to_meso,
+    pruned_tree_filename,
     fine_to_coarse,
     coarse_to_fine,
-    nodename_to_count,
     columns,
 ):
     logger.info(f"Extracting features with {max_num_clades} clades")
-    # Prune tree, updating data structures to use meso-scale clades.
-    fine_to_meso, pruned_tree_filename = prune_tree(
-        args, max_num_clades, coarse_to_fine, nodename_to_count
-    )
+    # Update data structures to use meso-scale clades.
     fine_to_coarse = {fine_to_meso(f): c for f, c in fine_to_coarse.items()}
     coarse_to_fine = {c: fine_to_meso(f) for c, f in coarse_to_fine.items()}
 
@@ -366,32 +521,42 @@ def extract_features(
     columns["clade"] = [fine_to_meso(f) for f in columns["clade"]]
     clade_set = set(columns["clade"])
     assert len(clade_set) <= max_num_clades
-    columns_file_out = f"results/columns.{max_num_clades}.pkl"
+    columns_file_out = get_columns_file_out(max_num_clades)
     with open(columns_file_out, "wb") as f:
         pickle.dump(columns, f)
     logger.info(f"Saved {columns_file_out}")
+    # Also save a memory-mappable columnar copy for fast loading.
+    save_columnar(columns, os.path.splitext(columns_file_out)[0])
     del columns
 
     # Convert from nucleotide mutations to amino acid mutations.
-    nuc_mutations_by_clade = load_mutation_tree(pruned_tree_filename)[0]
+    nuc_mutations_by_clade = load_mutation_tree(pruned_tree_filename, as_codes=True)[0]
     assert nuc_mutations_by_clade
-    aa_mutations_by_clade = {
-        clade: nuc_mutations_to_aa_mutations(mutations)
-        for clade, mutations in nuc_mutations_by_clade.items()
-    }
+    aa_mutations_by_clade = dict(
+        zip(
+            nuc_mutations_by_clade,
+            nuc_mutations_to_aa_mutations_batch(nuc_mutations_by_clade.values()),
+        )
+    )
 
-    # Create dense aa features.
+    # Create aa features, optionally as a sparse matrix.
     clades = sorted(nuc_mutations_by_clade)
     clade_ids = {k: i for i, k in enumerate(clades)}
     aa_mutations = sorted(set().union(*aa_mutations_by_clade.values()))
     logger.info(f"Found {len(aa_mutations)} amino acid mutations")
     mutation_ids = {k: i for i, k in enumerate(aa_mutations)}
-    aa_features = torch.zeros(len(clade_ids), len(mutation_ids), dtype=torch.bool)
-    for clade, ms in aa_mutations_by_clade.items():
-        i = clade_ids[clade]
-        for m in ms:
-            j = mutation_ids.get(m)
-            aa_features[i, j] = True
+    indices = [
+        (clade_ids[clade], mutation_ids[m])
+        for clade, ms in aa_mutations_by_clade.items()
+        for m in ms
+    ]
+    indices = torch.tensor(indices, dtype=torch.long).reshape(-1, 2).T
+    shape = len(clade_ids), len(mutation_ids)
+    aa_features = torch.sparse_coo_tensor(
+        indices, torch.ones(indices.size(1), dtype=torch.bool), shape
+    ).coalesce()
+    if not args.sparse_features:
+        aa_features = aa_features.to_dense()
 
     # Save features.
     features = {
@@ -401,36 +566,139 @@ def extract_features(
         "aa_mutations": aa_mutations,
         "aa_features": aa_features,
     }
-    features_file_out = f"results/features.{max_num_clades}.1.pt"
+    features_file_out = get_features_file_out(max_num_clades)
     logger.info(f"saving {tuple(aa_features.shape)} aa features to {features_file_out}")
     torch.save(features, features_file_out)
     logger.info(f"Saved {features_file_out}")
 
 
+def _same_mutations(a, b):
+    # Mutation sets may be either code arrays or frozensets of Mutations.
+    if isinstance(a, np.ndarray) and isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    if isinstance(a, np.ndarray):
+        a = decode_mutations(a)
+    if isinstance(b, np.ndarray):
+        b = decode_mutations(b)
+    return a == b
+
+
+def update_incremental(args, fine_to_coarse, coarse_to_fine):
+    """
+    Appends rows for new samples to previously saved columns, reusing the
+    previous meso-scale clades and features.
+
+    Returns False if a full rebuild is needed, e.g. if new pango lineages
+    have appeared or if any meso-scale clade now names a different node of
+    the refined tree than in the previous run.
+    """
+    max_num_clades = list(map(int, args.max_num_clades.split(",")))
+    features_files = [get_features_file_out(n) for n in max_num_clades]
+    columns_files = [get_columns_file_out(n) for n in max_num_clades]
+    pruned_tree_files = [
+        get_pruned_tree_file_out(max(n, len(coarse_to_fine))) for n in max_num_clades
+    ]
+    for filename in (
+        ["results/columns.pkl"] + features_files + columns_files + pruned_tree_files
+    ):
+        if not os.path.exists(filename):
+            logger.info(f"Missing {filename}, falling back to a full rebuild")
+            return False
+
+    # Check whether previous clade assignments are still valid. Since fine
+    # clade names depend on child order, we check that each meso-scale clade
+    # has the same mutations in the previous pruned tree as in the new tree.
+    fine_mutations = load_mutation_tree(args.tree_file_out, as_codes=True)[0]
+    meso_sets = []
+    for features_file, pruned_tree_file in zip(features_files, pruned_tree_files):
+        features = torch.load(features_file)
+        if set(features["lineage_to_clade"]) != set(coarse_to_fine):
+            logger.info("Lineages have changed, falling back to a full rebuild")
+            return False
+        for coarse, meso in features["lineage_to_clade"].items():
+            if coarse_to_fine[coarse] != meso:
+                logger.info("Clades have changed, falling back to a full rebuild")
+                return False
+        meso_mutations = load_mutation_tree(pruned_tree_file, as_codes=True)[0]
+        if set(meso_mutations) != set(features["clades"]):
+            logger.info(f"{pruned_tree_file} is stale, falling back to a full rebuild")
+            return False
+        for meso, mutations in meso_mutations.items():
+            if meso not in fine_mutations or not _same_mutations(
+                mutations, fine_mutations[meso]
+            ):
+                logger.info("Clades have changed, falling back to a full rebuild")
+                return False
+        meso_sets.append(features["clades"])
+
+    # Determine which samples are new.
+    with open("results/columns.pkl", "rb") as f:
+        columns = pickle.load(f)
+    old_keys = frozenset(columns["index"])
+    del columns
+    logger.info(f"Found {len(old_keys)} previous samples")
+    new_keys = None
+    if args.new_ids_file_in:
+        with open(args.new_ids_file_in) as f:
+            new_keys = frozenset(line.strip() for line in f) - {""}
+        logger.info(f"Found {len(new_keys)} new sample ids")
+
+    def keep_key(key):
+        if new_keys is not None and key not in new_keys:
+            return False
+        return key not in old_keys
+
+    # Load and append only the new rows.
+    new_columns, _ = load_metadata(args, keep_key=keep_key)
+    if not new_columns:
+        logger.info("No new rows found, nothing to update")
+        return True
+    new_columns["lineage"] = [fine_to_coarse[f] for f in new_columns["clade"]]
+
+    # Remap new rows through existing meso-scale clades. Each file is updated
+    # atomically and skips rows it already has, and results/columns.pkl is
+    # updated last, so an interrupted update can simply be rerun.
+    for meso_set, columns_file in zip(meso_sets, columns_files):
+        fine_to_meso = FineToMeso(meso_set)
+        meso_columns = dict(new_columns)
+        meso_columns["clade"] = [fine_to_meso(f) for f in new_columns["clade"]]
+        append_columns(columns_file, meso_columns)
+    append_columns("results/columns.pkl", new_columns, columnar=False)
+    return True
+
+
 def main(args):
     # Extract mappings between coarse lineages and fine clades.
     coarse_proto = args.tree_file_in
     fine_proto = args.tree_file_out
     fine_to_coarse = refine_mutation_tree(coarse_proto, fine_proto)
 
-    # Create columns.
-    columns, nodename_to_count = load_metadata(args)
-    columns["lineage"] = [fine_to_coarse[f] for f in columns["clade"]]
-
     # Choose the basal representative.
     coarse_to_fines = defaultdict(list)
     for fine, coarse in fine_to_coarse.items():
         coarse_to_fines[coarse].append(fine)
     coarse_to_fine = {c: min(fs) for c, fs in coarse_to_fines.items()}
 
-    # Extract features at various granularities.
-    for max_num_clades in map(int, args.max_num_clades.split(",")):
+    # Optionally append new samples to previous results.
+    if args.incremental:
+        if update_incremental(args, fine_to_coarse, coarse_to_fine):
+            return
+
+    # Create columns.
+    columns, nodename_to_count = load_metadata(args)
+    columns["lineage"] = [fine_to_coarse[f] for f in columns["clade"]]
+
+    # Extract features at various granularities, pruning in a single pass.
+    max_num_clades = list(map(int, args.max_num_clades.split(",")))
+    pruned = prune_tree(args, max_num_clades, coarse_to_fine, nodename_to_count)
+    for n, (fine_to_meso, pruned_tree_filename) in zip(max_num_clades, pruned):
         extract_features(
             args,
-            max_num_clades,
+            n,
+            fine_to_meso,
+            pruned_tree_filename,
             fine_to_coarse,
             coarse_to_fine,
-            nodename_to_count,
             columns,
         )
 
@@ -446,11 +714,43 @@ if __name__ == "__main__":
     parser.add_argument("--gisaid-metadata-file-in", default="")
     parser.add_argument("--tree-file-in", default="results/usher/all.masked.pb")
     parser.add_argument("--tree-file-out", default="results/lineageTree.fine.pb")
+    parser.add_argument(
+        "--sparse-features",
+        action="store_true",
+        help="save features as sparse COO tensors",
+    )
     parser.add_argument("--stats-file-out", default="results/stats.pkl")
     parser.add_argument("--recover-missing-usa-state", action="store_true")
     parser.add_argument("-s", "--max-skippage", type=float, default=1e7)
     parser.add_argument("-c", "--max-num-clades", default="2000,3000,5000,10000")
     parser.add_argument("--start-date", default=START_DATE)
+    parser.add_argument(
+        "--cache-file",
+        default="results/preprocess.cache.pkl",
+        help="file to persist parsed dates and locations across runs",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        default=1,
+        type=int,
+        help="number of processes for parsing metadata, assuming one record "
+        "per line; defaults to 1, i.e. parsing serially",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="append new samples to previous results when possible",
+    )
+    parser.add_argument(
+        "--new-ids-file-in",
+        default="",
+        help="optional file of new sample ids, one per line, for --incremental",
+    )
     args = parser.parse_args()
     args.start_date = try_parse_date(args.start_date)
+    load_lru_caches(args.cache_file, CACHES)
     main(args)
+    for cache in CACHES.values():
+        logger.info(cache)
+    save_lru_caches(args.cache_file, CACHES)
@@ -2,45 +2,50 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-import functools
 import logging
 import math
-import os
 
 import torch
 from pyro import poutine
 
 from pyrocov import mutrans
+from pyrocov.cache import DEFAULT_IGNORE, ResultCache
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
-def cached(filename):
-    def decorator(fn):
-        @functools.wraps(fn)
-        def cached_fn(*args, **kwargs):
-            f = filename(*args, **kwargs) if callable(filename) else filename
-            if args[0].force or not os.path.exists(f):
-                result = fn(*args, **kwargs)
-                logger.info(f"saving {f}")
-                torch.save(result, f)
-            else:
-                logger.info(f"loading cached {f}")
-                result = torch.load(f, map_location=args[0].device)
-            return result
-
-        return cached_fn
-
-    return decorator
-
-
-@cached("results/mutrans.data.pt")
+cache = ResultCache("results/cache")
+
+# Options that affect no results. Results are device agnostic, since they are
+# loaded onto the current default device.
+IGNORE = DEFAULT_IGNORE | {"cuda", "device", "dropout", "hessian"}
+
+# Options that affect rankings but not datasets.
+DATA_IGNORE = IGNORE | {
+    "full",
+    "full_learning_rate",
+    "full_learning_rate_decay",
+    "full_num_steps",
+    "map_learning_rate",
+    "map_num_steps",
+    "seed",
+    "svi_learning_rate",
+    "svi_num_steps",
+    "warm_start",
+}
+
+
+@cache.cached(
+    "mutrans.data",
+    files=["results/usher.columns.pkl", "results/usher.features.pt"],
+    ignore=DATA_IGNORE,
+)
 def load_data(args):
     return mutrans.load_gisaid_data(device=args.device)
 
 
-@cached("results/rank_mutations.rank_mf_svi.pt")
+@cache.cached("rank_mutations.rank_mf_svi", ignore=IGNORE)
 def rank_mf_svi(args, dataset):
     result = mutrans.fit_mf_svi(
         dataset,
@@ -61,7 +66,7 @@ def rank_mf_svi(args, dataset):
     return result
 
 
-@cached("results/rank_mutations.rank_full_svi.pt")
+@cache.cached("rank_mutations.rank_full_svi", ignore=IGNORE)
 def rank_full_svi(args, dataset):
     result = mutrans.fit_full_svi(
         dataset,
@@ -87,7 +92,7 @@ def rank_full_svi(args, dataset):
     return result
 
 
-@cached("results/rank_mutations.hessian.pt")
+@cache.cached("rank_mutations.hessian", ignore=IGNORE)
 def compute_hessian(args, dataset, result):
     logger.info("Computing Hessian")
     features = dataset["features"]
@@ -143,11 +148,7 @@ def _sym_inverse(mat):
     raise e from None
 
 
-def _fit_map_filename(args, dataset, cond_data, guide=None, without_feature=None):
-    return f"results/rank_mutations.{guide is None}.{without_feature}.pt"
-
-
-@cached(_fit_map_filename)
+@cache.cached("rank_mutations.fit_map", ignore=IGNORE)
 def fit_map(args, dataset, cond_data, guide=None, without_feature=None):
     if without_feature is not None:
         # Drop feature.
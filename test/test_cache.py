@@ -0,0 +1,152 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import pytest
+import torch
+
+from pyrocov.cache import ResultCache
+
+
+def make_args(**kwargs):
+    kwargs.setdefault("seed", 0)
+    return argparse.Namespace(**kwargs)
+
+
+def test_key():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = ResultCache(dirname)
+        x = torch.randn(3, 4)
+        dataset = {"x": x, "names": ["a", "b"], "sparse": torch.eye(3).to_sparse()}
+        key = cache.key("fit", (make_args(), dataset, 1.0))
+
+        # Keys are deterministic.
+        assert cache.key("fit", (make_args(), dataset, 1.0)) == key
+        dataset2 = {
+            k: v.clone() if torch.is_tensor(v) else v for k, v in dataset.items()
+        }
+        assert cache.key("fit", (make_args(), dataset2, 1.0)) == key
+
+        # Keys depend on all arguments, including tensor contents.
+        assert cache.key("fit2", (make_args(), dataset, 1.0)) != key
+        assert cache.key("fit", (make_args(seed=1), dataset, 1.0)) != key
+        assert cache.key("fit", (make_args(), dataset, 1)) != key
+        assert cache.key("fit", (make_args(), dataset, 1.0), {"n": 1}) != key
+        x[0, 0] += 1
+        assert cache.key("fit", (make_args(), dataset, 1.0)) != key
+
+        # Ignored attributes do not affect keys.
+        key = cache.key("fit", (make_args(),))
+        assert cache.key("fit", (make_args(force=True, log_every=10),)) == key
+
+        # Keys depend on input files.
+        filename = os.path.join(dirname, "input.txt")
+        with open(filename, "w") as f:
+            f.write("foo")
+        key = cache.key("fit", files=[filename])
+        assert cache.key("fit", files=[filename]) == key
+        time.sleep(0.01)
+        with open(filename, "w") as f:
+            f.write("bar!")
+        assert cache.key("fit", files=[filename]) != key
+
+
+def test_cached():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = ResultCache(dirname)
+        calls = []
+
+        @cache.cached("square")
+        def square(args, x):
+            calls.append(x)
+            return {"y": torch.tensor(x) ** 2}
+
+        args = make_args(no_cache=False, force=False, no_new=False, test=False)
+        assert square(args, 3)["y"] == 9
+        assert square(args, 3)["y"] == 9
+        assert calls == [3]
+        assert square(args, 4)["y"] == 16
+        assert calls == [3, 4]
+        manifest = cache.manifest()
+        assert len(manifest) == 2
+        for entry in manifest.values():
+            assert entry["size"] > 0
+            assert entry["accessed"] >= entry["created"]
+
+        args.force = True
+        square(args, 3)
+        assert calls == [3, 4, 3]
+        args.force = False
+
+        args.no_new = True
+        square(args, 3)
+        with pytest.raises(ValueError, match="Missing"):
+            square(args, 5)
+        args.no_new = False
+
+        args.test = True
+        square(args, 6)
+        square(args, 6)
+        assert calls == [3, 4, 3, 6, 6]
+        args.test = False
+
+        args.no_cache = True
+        square(args, 3)
+        assert calls == [3, 4, 3, 6, 6, 3]
+
+        # No temporary files are left behind.
+        assert not [f for f in os.listdir(dirname) if f.startswith(".tmp.")]
+
+
+def test_evict():
+    with tempfile.TemporaryDirectory() as dirname:
+        cache = ResultCache(dirname)
+
+        @cache.cached("zeros")
+        def zeros(args, n):
+            return torch.zeros(n)
+
+        args = make_args()
+        for n in [1000, 2000, 3000]:
+            zeros(args, n)
+        zeros(args, 1000)  # Make 2000 the least recently used.
+        sizes = {k: v["size"] for k, v in cache.manifest().items()}
+        total = sum(sizes.values())
+        smallest = min(sizes.values())
+
+        cache.max_bytes = total - smallest
+        zeros(args, 10)
+        names = [f for f in os.listdir(dirname) if f.endswith(".pt")]
+        assert len(names) == 3
+        assert set(names) == set(cache.manifest())
+        remaining = torch.tensor(
+            sorted(torch.load(os.path.join(dirname, f)).numel() for f in names)
+        )
+        assert remaining.tolist() == [10, 1000, 3000]
+
+
+def _count_and_square(dirname, x):
+    cache = ResultCache(dirname)
+
+    @cache.cached("square")
+    def square(args, x):
+        with open(os.path.join(dirname, "calls.txt"), "a") as f:
+            f.write(f"{x}\n")
+        time.sleep(0.1)
+        return x * x
+
+    return square(make_args(), x)
+
+
+def test_concurrent():
+    with tempfile.TemporaryDirectory() as dirname:
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            results = pool.starmap(_count_and_square, [(dirname, 3)] * 8)
+        assert results == [9] * 8
+        with open(os.path.join(dirname, "calls.txt")) as f:
+            assert f.read().split() == ["3"]
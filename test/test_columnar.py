@@ -0,0 +1,91 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pytest
+
+import pyrocov.columnar
+from pyrocov.columnar import (
+    DictionaryColumn,
+    append_columns,
+    load_columnar,
+    save_columnar,
+)
+
+
+def test_save_load_columnar():
+    columns = {
+        "day": [0, 3, 3, 700],
+        "location": ["Asia / China", "Europe / Spain", "Asia / China", "Europe"],
+        "clade": ["fine.", "fine.0", "fine.", "fine.1.2"],
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        dirname = os.path.join(tmpdirname, "columns")
+        save_columnar(columns, dirname)
+
+        actual = load_columnar(dirname)
+        assert set(actual) == set(columns)
+        assert isinstance(actual["day"], np.ndarray)
+        assert actual["day"].dtype == np.int16
+        assert actual["day"].tolist() == columns["day"]
+        for name in ["location", "clade"]:
+            assert isinstance(actual[name], DictionaryColumn)
+            assert actual[name].codes.dtype == np.int32
+            assert actual[name].decode() == columns[name]
+
+        actual = load_columnar(dirname, ["location"], mmap=False)
+        assert list(actual) == ["location"]
+        assert actual["location"].decode() == columns["location"]
+
+
+def test_append_columns_rerun(monkeypatch):
+    old = {"index": ["a", "b"], "day": [0, 1], "clade": ["fine.", "fine.0"]}
+    new = {"index": ["c", "d"], "day": [2, 3], "clade": ["fine.1", "fine."]}
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = [os.path.join(dirname, f"columns.{n}.pkl") for n in [1, 2]]
+        main_file = os.path.join(dirname, "columns.pkl")
+        for filename in filenames + [main_file]:
+            with open(filename, "wb") as f:
+                pickle.dump(old, f)
+            save_columnar(old, os.path.splitext(filename)[0])
+
+        def update():
+            # This mimics the write order of update_incremental().
+            with open(main_file, "rb") as f:
+                old_keys = frozenset(pickle.load(f)["index"])
+            rows = [i for i, key in enumerate(new["index"]) if key not in old_keys]
+            new_rows = {k: [v[i] for i in rows] for k, v in new.items()}
+            for filename in filenames:
+                append_columns(filename, new_rows)
+            append_columns(main_file, new_rows, columnar=False)
+
+        # Fail while writing the second file.
+        atomic_write = pyrocov.columnar.atomic_write
+
+        def flaky_atomic_write(filename, write):
+            if filename == filenames[1]:
+                raise OSError("disk full")
+            atomic_write(filename, write)
+
+        monkeypatch.setattr(pyrocov.columnar, "atomic_write", flaky_atomic_write)
+        with pytest.raises(OSError):
+            update()
+        for filename, expected in zip(filenames + [main_file], [4, 2, 2]):
+            with open(filename, "rb") as f:
+                assert len(pickle.load(f)["index"]) == expected
+
+        # A rerun recovers the missing rows without duplicating any.
+        monkeypatch.setattr(pyrocov.columnar, "atomic_write", atomic_write)
+        update()
+        expected = {k: old[k] + new[k] for k in old}
+        for filename in filenames + [main_file]:
+            with open(filename, "rb") as f:
+                assert pickle.load(f) == expected
+        for filename in filenames:
+            actual = load_columnar(os.path.splitext(filename)[0])
+            assert actual["index"].decode() == expected["index"]
+            assert actual["day"].tolist() == expected["day"]
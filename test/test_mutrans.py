@@ -0,0 +1,507 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import itertools
+import math
+import os
+import pickle
+import random
+import tempfile
+
+import pyro
+import pyro.distributions as dist
+import pytest
+import torch
+from pyro import poutine
+from pyro.poutine.util import site_is_subsample
+
+from pyrocov import pangolin
+from pyrocov.columnar import save_columnar
+from pyrocov.mutrans import (
+    TIMESTEP,
+    AutoBatchedLowRankMultivariateNormal,
+    _get_site_kinds,
+    bucket_by_place,
+    dense_to_sparse,
+    features_matmul,
+    fit_svi,
+    get_feature_gaps,
+    load_gisaid_data,
+    make_loo_dataset,
+    model,
+    rank_loo_lineages,
+    subset_gisaid_data,
+)
+
+LOCATIONS = [
+    "Asia / China",
+    "Asia / Japan / Tokyo",
+    "Europe / Spain",
+    "Europe / United Kingdom / England",
+    "Europe / United Kingdom / Wales",
+    "North America / USA / CA",
+    "North America / USA / MA",
+]
+CLADES = ["fine", "fine.", "fine.0", "fine.0.", "fine.1", "fine.1.0"]
+LINEAGES = ["A", "B", "B.1", "B.1.1", "B.1.1.7", "B.1.617.2"]
+MUTATIONS = ["S:D614G", "S:N501Y", "S:E484K", "S:L452R", "N:R203K", "ORF1a:T265I"]
+
+
+def make_data(dirname, num_rows=1000):
+    columns = {
+        "day": [random.randrange(200) for _ in range(num_rows)],
+        "location": [random.choice(LOCATIONS) for _ in range(num_rows)],
+        "clade": [random.choice(CLADES) for _ in range(num_rows)],
+    }
+    features = {
+        "clades": CLADES,
+        "clade_to_lineage": dict(zip(CLADES, LINEAGES)),
+        "lineage_to_clade": dict(zip(LINEAGES, CLADES)),
+        "aa_mutations": MUTATIONS,
+        "aa_features": torch.rand(len(CLADES), len(MUTATIONS)) < 0.5,
+    }
+    filenames = {
+        "columns_filename": os.path.join(dirname, "columns.pkl"),
+        "features_filename": os.path.join(dirname, "features.pt"),
+    }
+    with open(filenames["columns_filename"], "wb") as f:
+        pickle.dump(columns, f)
+    torch.save(features, filenames["features_filename"])
+    save_columnar(columns, os.path.join(dirname, "columns"))
+    return filenames
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"end_day": 100},
+        {"include": {"location": "^Europe"}},
+        {"exclude": {"location": "^Europe", "clade": r"^fine\.0"}},
+        {"min_region_size": 200},
+    ],
+    ids=str,
+)
+def test_load_gisaid_data_columnar(kwargs):
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = make_data(dirname)
+        expected = load_gisaid_data(**filenames, **kwargs)
+        filenames["columns_filename"] = os.path.join(dirname, "columns")
+        actual = load_gisaid_data(**filenames, **kwargs)
+
+    assert actual["location_id"] == expected["location_id"]
+    assert torch.equal(actual["weekly_clades"], expected["weekly_clades"])
+    assert torch.equal(actual["state_to_country"], expected["state_to_country"])
+    assert torch.equal(actual["pc_index"], expected["pc_index"])
+
+
+@pytest.mark.parametrize("end_day", [None, 100])
+def test_load_gisaid_data_counts(end_day):
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = make_data(dirname)
+        dataset = load_gisaid_data(**filenames, min_region_size=200, end_day=end_day)
+        with open(filenames["columns_filename"], "rb") as f:
+            columns = pickle.load(f)
+
+    # Compare to a naive per-row computation.
+    location_id = dataset["location_id"]
+    clade_id = dataset["clade_id"]
+    expected = torch.zeros(dataset["weekly_clades"].shape)
+    for day, location, clade in zip(
+        columns["day"], columns["location"], columns["clade"]
+    ):
+        if end_day is not None and day > end_day:
+            continue
+        p = location_id.get(location)
+        if p is None:
+            p = location_id[" / ".join(location.split(" / ")[:2])]
+        expected[day // TIMESTEP, p, clade_id[clade]] += 1
+    assert torch.equal(dataset["weekly_clades"], expected)
+
+    # Check precomputed likelihood constants.
+    expected = (expected.sum(-1) + 1).lgamma().sum() - (expected + 1).lgamma().sum()
+    actual = dataset["sparse_counts"]["log_factorial"]
+    assert torch.allclose(actual, expected)
+
+
+def test_features_sparse():
+    features = torch.randn(5, 4) * (torch.rand(5, 4) < 0.5)
+    features[:, 0] = 1  # no implicit zeros
+    sparse = features.to_sparse()
+    assert torch.equal(get_feature_gaps(sparse), get_feature_gaps(features))
+    coef = torch.randn(3, 2, 4)
+    expected = features_matmul(coef, features)
+    actual = features_matmul(coef, sparse)
+    assert actual.shape == expected.shape == (3, 2, 5)
+    assert torch.allclose(actual, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("model_type", ["reparam", "reparam-localrate"])
+def test_load_gisaid_data_sparse(model_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = make_data(dirname)
+        expected = load_gisaid_data(**filenames)
+        actual = load_gisaid_data(**filenames, sparse_features=True)
+    assert actual["features"].is_sparse
+    assert torch.equal(actual["features"].to_dense(), expected["features"])
+
+    traces = []
+    for dataset in [expected, actual]:
+        pyro.set_rng_seed(0)
+        traces.append(poutine.trace(model).get_trace(dataset, model_type))
+    assert torch.allclose(
+        traces[0].nodes["rate_loc"]["value"], traces[1].nodes["rate_loc"]["value"]
+    )
+
+    expected = subset_gisaid_data(expected, max_clades=4)
+    actual = subset_gisaid_data(actual, max_clades=4)
+    assert actual["mutations"] == expected["mutations"]
+    assert torch.equal(actual["features"].to_dense(), expected["features"])
+
+
+def rank_loo_lineages_naive(dataset, min_samples):
+    def get_parent(lineage):
+        parent = pangolin.get_parent(pangolin.decompress(lineage))
+        return None if parent is None else pangolin.compress(parent)
+
+    lineage_id = dataset["lineage_id"]
+    clade_counts = dataset["weekly_clades"].sum([0, 1])
+    counts = clade_counts.new_zeros(len(lineage_id))
+    counts.scatter_add_(0, dataset["clade_id_to_lineage_id"], clade_counts)
+    descendent_counts = counts.clone()
+    for c, lineage in enumerate(dataset["lineage_id_inv"]):
+        ancestor = get_parent(lineage)
+        while ancestor is not None:
+            a = lineage_id.get(ancestor)
+            if a is not None:
+                descendent_counts[a] += counts[c]
+            ancestor = get_parent(ancestor)
+    total = counts.sum().item()
+    cut_size = torch.min(descendent_counts, total - descendent_counts)
+    ranked = [
+        (size, lineage)
+        for size, lineage in zip(cut_size.tolist(), dataset["lineage_id_inv"])
+        if lineage not in ("A", "B", "B.1")
+        if size >= min_samples
+    ]
+    ranked.sort(reverse=True)
+    return [name for size, name in ranked]
+
+
+@pytest.mark.parametrize(
+    "model_type", ["reparam", "reparam-localinit", "reparam-ragged"]
+)
+def test_model_sparse_likelihood(model_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+
+    pyro.set_rng_seed(0)
+    trace = poutine.trace(model).get_trace(dataset, model_type)
+    trace.compute_log_prob()
+    data = {
+        name: site["value"]
+        for name, site in trace.nodes.items()
+        if site["type"] == "sample" and not site["is_observed"]
+        if not site_is_subsample(site)
+    }
+    dense_trace = poutine.trace(poutine.condition(model, data)).get_trace(
+        dataset, model_type + "-dense"
+    )
+    dense_trace.compute_log_prob()
+    expected = dense_trace.nodes["obs"]["log_prob"].sum()
+    actual = trace.nodes["obs"]["log_prob"].sum()
+    assert torch.allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize("min_samples", [0, 10, 50])
+def test_rank_loo_lineages(min_samples):
+    lineages = ["A", "A.1", "B", "B.1", "B.1.1", "B.1.1.7", "B.1.1.529", "BA.1"]
+    lineages += ["BA.1.1", "BA.2", "B.1.617.2", "AY.4", "AY.4.2", "AY.44", "P.1"]
+    lineages.sort()
+    clade_id_to_lineage_id = torch.arange(len(lineages)).repeat(2)
+    C = len(clade_id_to_lineage_id)
+    weekly_clades = torch.randint(0, 5, (4, 3, C)).float()
+    dataset = {
+        "lineage_id_inv": lineages,
+        "lineage_id": {name: i for i, name in enumerate(lineages)},
+        "clade_id_to_lineage_id": clade_id_to_lineage_id,
+        "weekly_clades": weekly_clades,
+    }
+    expected = rank_loo_lineages_naive(dataset, min_samples)
+    actual = rank_loo_lineages(dataset, min_samples)
+    assert actual == expected
+
+
+@pytest.mark.parametrize(
+    "model_type",
+    ["reparam", "reparam-localinit", "reparam-localrate", "reparam-ragged", "dense"],
+)
+def test_make_loo_dataset(model_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+    heldout = [[1], [2, 3], []]
+    loo_dataset = make_loo_dataset(dataset, heldout)
+    assert loo_dataset["loo_mask"].shape == (3, len(CLADES))
+
+    pyro.set_rng_seed(0)
+    loo_trace = poutine.trace(model).get_trace(loo_dataset, model_type)
+    loo_trace.compute_log_prob()
+    latents = {
+        name: site["value"]
+        for name, site in loo_trace.nodes.items()
+        if site["type"] == "sample" and not site["is_observed"]
+        if not site_is_subsample(site)
+    }
+
+    for k, ids in enumerate(heldout):
+        # Construct a leave-one-out dataset as in vary_leaves.
+        weekly_clades = dataset["weekly_clades"].clone()
+        weekly_clades[:, :, ids] = 0
+        pc_index = weekly_clades.ne(0).any(0).reshape(-1).nonzero(as_tuple=True)[0]
+        loo_k = dataset.copy()
+        loo_k["weekly_clades"] = weekly_clades
+        loo_k["sparse_counts"] = dense_to_sparse(weekly_clades)
+        loo_k["pc_index"] = pc_index
+
+        # Check the likelihood matches, conditioned on the k-th latents.
+        pos = torch.searchsorted(dataset["pc_index"], pc_index)
+        data = {}
+        for name, value in latents.items():
+            value = value[k].squeeze()
+            if name.startswith("pc_"):
+                value = value[pos]
+            data[name] = value
+        trace = poutine.trace(poutine.condition(model, data)).get_trace(
+            loo_k, model_type
+        )
+        trace.compute_log_prob()
+        expected = trace.nodes["obs"]["log_prob"].sum()
+        actual = loo_trace.nodes["obs"]["log_prob"][k].sum()
+        assert torch.allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize("guide_type", ["map", "normal", "full", "custom"])
+def test_fit_svi_loo(guide_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+    dataset = make_loo_dataset(dataset, [[1], [2, 3]])
+    result = fit_svi(
+        dataset,
+        model_type="reparam-localinit",
+        guide_type=guide_type,
+        num_steps=3,
+        jit=False,
+        log_every=0,
+        num_ell_particles=2,
+    )
+    F = len(MUTATIONS)
+    C = len(CLADES)
+    assert result["median"]["coef"].reshape(2, -1).shape == (2, F)
+    assert result["median"]["rate_loc"].reshape(2, -1).shape == (2, C)
+    assert result["ELL"].shape == (2,)
+
+
+def test_batched_low_rank_guide():
+    K = 3
+
+    def toy_model():
+        with pyro.plate("loo", K, dim=-2):
+            pyro.sample("x", dist.Normal(0, 1))
+            with pyro.plate("i", 4, dim=-1):
+                pyro.sample("y", dist.LogNormal(0, 1))
+
+    pyro.clear_param_store()
+    guide = AutoBatchedLowRankMultivariateNormal(toy_model, rank=2)
+    samples = guide()
+    assert samples["x"].shape == (K, 1)
+    assert samples["y"].shape == (K, 4)
+    assert guide.batch_size == K
+    assert guide.cov_factor.shape == (5 * K, 2)
+
+    # The posterior should factorize over the plate.
+    posterior = guide.get_posterior()
+    latent = posterior.sample()
+    actual = posterior.log_prob(latent)
+    expected = 0.0
+    for k in range(K):
+        index = torch.tensor([k] + [K + 4 * k + i for i in range(4)])
+        scale = guide.scale[index]
+        expected += dist.LowRankMultivariateNormal(
+            guide.loc[index],
+            guide.cov_factor[index] * scale.unsqueeze(-1),
+            scale * scale,
+        ).log_prob(latent[index])
+    assert torch.allclose(actual, expected)
+
+
+def test_get_site_kinds():
+    def toy_model(dataset, model_type):
+        F = len(dataset["mutations"])
+        pyro.sample("scalar", dist.Normal(0, 1))
+        pyro.sample("coef", dist.Normal(torch.zeros(F), 1).to_event(1))
+        pyro.sample("other", dist.Normal(torch.zeros(F + 1), 1).to_event(1))
+        with pyro.plate("clade", 3, dim=-1):
+            pyro.sample("rate_loc", dist.Normal(0, 1))
+
+    dataset = {"mutations": ["S:D614G", "S:N501Y"]}
+    actual = _get_site_kinds(toy_model, dataset, "reparam")
+    assert actual == {
+        "scalar": None,
+        "coef": "feature",
+        "other": None,
+        "rate_loc": "clade",
+    }
+
+
+@pytest.mark.parametrize("guide_type", ["map", "normal", "full", "custom"])
+def test_fit_svi_warm_start(guide_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = make_data(dirname)
+        dataset = load_gisaid_data(**filenames)
+        subset = load_gisaid_data(
+            include={"gene": "^S:", "location": "^Europe"}, **filenames
+        )
+    options = dict(
+        model_type="reparam-localinit",
+        guide_type=guide_type,
+        jit=False,
+        log_every=0,
+        num_samples=2,
+        num_ell_particles=2,
+    )
+    full = fit_svi(dataset, num_steps=10, **options)
+
+    # Warm starting on the same dataset should recover the full fit.
+    options["learning_rate"] = 1e-10
+    result = fit_svi(dataset, num_steps=1, warm_start=full, **options)
+    for name in ["coef", "rate_loc", "init_loc", "pc_rate"]:
+        expected = full["median"][name]
+        actual = result["median"][name]
+        assert torch.allclose(actual, expected, atol=1e-5), name
+
+    # Warm starting on a subset should remap features and clades.
+    result = fit_svi(subset, num_steps=1, warm_start=full, **options)
+    ids = [dataset["mutations"].index(m) for m in subset["mutations"]]
+    expected = full["median"]["coef_decentered"][ids]
+    actual = result["median"]["coef_decentered"]
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+    # Warm starting a batch of leave-one-out fits should broadcast.
+    loo_dataset = make_loo_dataset(dataset, [[1], [2, 3]])
+    result = fit_svi(loo_dataset, num_steps=1, warm_start=full, **options)
+    expected = full["median"]["coef"]
+    actual = result["median"]["coef"].reshape(2, -1)
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+@pytest.mark.filterwarnings("ignore:.*torch.jit.trace.* is deprecated:FutureWarning")
+@pytest.mark.parametrize("model_type", ["reparam", "reparam-ragged"])
+def test_fit_svi_jit(model_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+    result = fit_svi(
+        dataset,
+        model_type=model_type,
+        guide_type="custom",
+        num_steps=3,
+        jit=True,
+        log_every=0,
+        num_samples=2,
+        num_ell_particles=2,
+    )
+    assert all(math.isfinite(loss) for loss in result["losses"])
+
+
+def test_fit_svi_early_stop():
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+    result = fit_svi(
+        dataset,
+        model_type="reparam-localinit",
+        guide_type="map",
+        num_steps=1000,
+        jit=False,
+        log_every=0,
+        num_samples=2,
+        num_ell_particles=2,
+        early_stop=math.inf,
+        early_stop_window=10,
+    )
+    assert len(result["losses"]) == 20
+
+
+def test_fit_svi_early_stop_loo():
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+    num_steps = []
+    for K in [1, 3]:
+        result = fit_svi(
+            make_loo_dataset(dataset, [[1]] * K),
+            model_type="reparam-localinit",
+            guide_type="map",
+            num_steps=200,
+            jit=False,
+            log_every=0,
+            num_samples=2,
+            num_ell_particles=2,
+            early_stop=0.025,
+            early_stop_window=10,
+        )
+        num_steps.append(len(result["losses"]))
+    assert num_steps[0] < 200
+    assert num_steps[0] == num_steps[1]
+
+
+@pytest.mark.parametrize(
+    "model_type", ["reparam", "reparam-localinit", "reparam-ragged"]
+)
+def test_model_subsample(model_type):
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = bucket_by_place(load_gisaid_data(**make_data(dirname)))
+    P = len(dataset["place_buckets"]["active"])
+    B = 2
+
+    trace = poutine.trace(model).get_trace(dataset, model_type)
+    expected = trace.log_prob_sum()
+    latents = {
+        name: site["value"]
+        for name, site in trace.nodes.items()
+        if site["type"] == "sample" and not site["is_observed"]
+        if not site_is_subsample(site)
+    }
+
+    # The subsampled log density is unbiased over all subsamples of places.
+    actual = 0.0
+    for places in itertools.combinations(range(P), B):
+        data = {"place": torch.tensor(places)}
+        trace = poutine.trace(poutine.condition(model, data)).get_trace(
+            dataset, model_type, subsample_size=B
+        )
+        pc_subsample = trace.nodes["place_clade"]["value"]
+        for name, value in latents.items():
+            data[name] = value[pc_subsample] if name.startswith("pc_") else value
+        trace = poutine.trace(poutine.condition(model, data)).get_trace(
+            dataset, model_type, subsample_size=B
+        )
+        actual += trace.log_prob_sum() / math.comb(P, B)
+    assert torch.allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize("jit", [False, True], ids=["nojit", "jit"])
+@pytest.mark.parametrize("guide_type", ["map", "normal", "custom"])
+def test_fit_svi_subsample(guide_type, jit):
+    with tempfile.TemporaryDirectory() as dirname:
+        dataset = load_gisaid_data(**make_data(dirname))
+    result = fit_svi(
+        dataset,
+        model_type="reparam",
+        guide_type=guide_type,
+        num_steps=11,
+        num_samples=5,
+        num_ell_particles=4,
+        log_every=0,
+        jit=jit,
+        subsample_size=2,
+    )
+    assert all(math.isfinite(loss) for loss in result["losses"])
+    assert result["median"]["coef"].shape == dataset["features"].shape[-1:]
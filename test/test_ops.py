@@ -7,22 +7,32 @@ import torch
 from torch.autograd import grad
 
 from pyrocov.ops import (
+    linear_logsumexp,
+    log_factorial_cache_clear,
+    log_factorial_cache_info,
+    log_factorial_sum,
     logistic_logsumexp,
+    segment_logsumexp,
     sparse_multinomial_likelihood,
     sparse_poisson_likelihood,
 )
 
 
 @pytest.mark.parametrize("T,P,S", [(5, 6, 7)])
-@pytest.mark.parametrize("backend", ["sequential"])
-def test_logistic_logsumexp(T, P, S, backend):
+@pytest.mark.parametrize(
+    "backend,block_size",
+    [("sequential", None), ("chunked", None), ("chunked", 1), ("chunked", 2)],
+)
+def test_logistic_logsumexp(T, P, S, backend, block_size):
     alpha = torch.randn(P, S, requires_grad=True)
     beta = torch.randn(P, S, requires_grad=True)
     delta = torch.randn(P, S, requires_grad=True)
     tau = torch.randn(T, P)
 
     expected = logistic_logsumexp(alpha, beta, delta, tau, backend="naive")
-    actual = logistic_logsumexp(alpha, beta, delta, tau, backend=backend)
+    actual = logistic_logsumexp(
+        alpha, beta, delta, tau, backend=backend, block_size=block_size
+    )
     assert torch.allclose(actual, expected)
 
     probe = torch.randn(expected.shape)
@@ -32,6 +42,52 @@ def test_logistic_logsumexp(T, P, S, backend):
         assert torch.allclose(a, e), name
 
 
+@pytest.mark.parametrize("batch_shape", [(), (3,), (2, 1)], ids=str)
+@pytest.mark.parametrize("block_size", [None, 1, 2, 100])
+@pytest.mark.parametrize("T,P,C", [(5, 6, 7)])
+@pytest.mark.parametrize("batched_time", [False, True])
+def test_linear_logsumexp(T, P, C, block_size, batch_shape, batched_time):
+    init = torch.randn(batch_shape + (P, C), requires_grad=True)
+    rate = torch.randn(batch_shape + (P, C), requires_grad=True)
+    if batched_time:
+        time = torch.randn((T,) + batch_shape + (P,))
+        time_ = time[..., None]
+    else:
+        time = torch.randn(T)
+        time_ = time.reshape((T,) + (1,) * init.dim())
+
+    expected = (init + rate * time_).logsumexp(-1)
+    actual = linear_logsumexp(init, rate, time, block_size=block_size)
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected)
+
+    probe = torch.randn(expected.shape)
+    expected_grads = grad((probe * expected).sum(), [init, rate])
+    actual_grads = grad((probe * actual).sum(), [init, rate])
+    for e, a, name in zip(expected_grads, actual_grads, ["init", "rate"]):
+        assert torch.allclose(a, e, atol=1e-6), name
+
+
+@pytest.mark.parametrize("batch_shape", [(), (3,), (2, 4)], ids=str)
+@pytest.mark.parametrize("lengths", [[1], [3, 0, 2], [0, 4, 1, 0, 5]], ids=str)
+def test_segment_logsumexp(lengths, batch_shape):
+    ptr = torch.tensor([0] + lengths).cumsum(0)
+    x = torch.randn(batch_shape + (sum(lengths),), requires_grad=True)
+
+    expected = torch.stack(
+        [x[..., i:j].logsumexp(-1) for i, j in zip(ptr[:-1], ptr[1:])], -1
+    )
+    actual = segment_logsumexp(x, ptr)
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected)
+
+    probe = torch.randn(expected.shape)
+    finite = expected.isfinite()
+    expected_grad = grad((probe * expected)[finite].sum(), [x])[0]
+    actual_grad = grad((probe * actual)[finite].sum(), [x])[0]
+    assert torch.allclose(actual_grad, expected_grad)
+
+
 @pytest.mark.parametrize("T,P,S", [(2, 3, 4), (5, 6, 7), (8, 9, 10)])
 def test_sparse_poisson_likelihood(T, P, S):
     log_rate = torch.randn(T, P, S)
@@ -64,3 +120,37 @@ def test_sparse_multinomial_likelihood(T, P, S):
     nonzero_logits = logits[nnz]
     actual = sparse_multinomial_likelihood(total_count, nonzero_logits, nonzero_value)
     assert torch.allclose(actual, expected)
+
+    log_factorial = (total_count + 1).lgamma().sum() - (
+        nonzero_value + 1
+    ).lgamma().sum()
+    actual = sparse_multinomial_likelihood(
+        total_count, nonzero_logits, nonzero_value, log_factorial
+    )
+    assert torch.allclose(actual, expected)
+
+
+def test_log_factorial_sum_cache():
+    log_factorial_cache_clear()
+    x = torch.tensor([0.0, 1.0, 2.0, 3.0])
+    expected = (x + 1).lgamma().sum()
+    assert torch.allclose(log_factorial_sum(x), expected)
+    assert torch.allclose(log_factorial_sum(x), expected)
+    info = log_factorial_cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+
+    # In-place modifications invalidate entries.
+    x[0] = 4.0
+    assert torch.allclose(log_factorial_sum(x), (x + 1).lgamma().sum())
+    assert log_factorial_cache_info().misses == 2
+
+    # Entries are removed when their tensor dies.
+    del x
+    assert log_factorial_cache_info().currsize == 0
+
+    # The cache is bounded.
+    xs = [torch.rand(3) for _ in range(log_factorial_cache_info().maxsize + 10)]
+    for x in xs:
+        log_factorial_sum(x)
+    info = log_factorial_cache_info()
+    assert info.currsize == info.maxsize
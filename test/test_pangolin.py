@@ -0,0 +1,110 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+import torch
+
+from pyrocov.pangolin import (
+    PANGOLIN_ALIASES,
+    LineageIndex,
+    compress,
+    compress_many,
+    decompress,
+    decompress_many,
+    find_descendents,
+)
+
+NAMES = [
+    "A",
+    "A.1",
+    "B",
+    "B.1",
+    "B.1.1",
+    "B.1.1.7",
+    "B.1.617.2",
+    "AY.4",
+    "AY.4.2",
+    "AY.44",
+    "B.1.1.529",
+    "BA.1",
+    "BA.2",
+    "P.1",
+]
+FINE_NAMES = ["fine", "fine.", "fine..", "fine.0", "fine.0.", "fine.1", "fine.10"]
+
+
+def find_descendents_naive(names):
+    longnames = [decompress(name) for name in names]
+    descendents = {}
+    for long1, short1 in zip(longnames, names):
+        prefix = long1 + "."
+        descendents[short1] = [
+            short2
+            for long2, short2 in zip(longnames, names)
+            if long2.startswith(prefix)
+        ]
+    return descendents
+
+
+@pytest.mark.parametrize("names", [NAMES, FINE_NAMES, NAMES[::-1]])
+def test_lineage_index(names):
+    index = LineageIndex(names)
+    expected = find_descendents_naive(names)
+    assert find_descendents(names) == expected
+    for x in names:
+        for y in names:
+            assert index.is_ancestor(x, y) == (y in expected[x])
+        parent = index.get_parent(x)
+        if parent is not None:
+            assert x in expected[parent]
+            assert not any(x in expected[y] for y in expected[parent])
+
+    values = torch.randn(3, len(names))
+    actual = index.subtree_sum(values)
+    for i, x in enumerate(names):
+        ids = [i] + [index.ids[y] for y in expected[x]]
+        assert torch.allclose(actual[:, i], values[:, ids].sum(-1), atol=1e-5)
+
+
+def decompress_naive(name):
+    if name.startswith("fine") or name.split(".")[0] in ("A", "B"):
+        return name
+    for key, value in PANGOLIN_ALIASES.items():
+        if name == key or name.startswith(key + "."):
+            return value + name[len(key) :]
+    raise ValueError(name)
+
+
+def compress_naive(name):
+    if name.startswith("fine") or name.count(".") <= 3:
+        return name
+    for key, value in PANGOLIN_ALIASES.items():
+        if key != "I" and (name == value or name.startswith(value + ".")):
+            return key + name[len(value) :]
+    raise ValueError(name)
+
+
+def test_compress_decompress():
+    names = set(NAMES + FINE_NAMES)
+    for key, value in PANGOLIN_ALIASES.items():
+        for suffix in ["", ".1", ".2.3", ".29.1"]:
+            names.add(key + suffix)
+            names.add(value + suffix)
+    names = sorted(names)
+
+    expected = [decompress_naive(name) for name in names]
+    assert [decompress(name) for name in names] == expected
+    assert decompress_many(names + names) == expected + expected
+
+    expected = [compress_naive(name) for name in names]
+    assert [compress(name) for name in names] == expected
+    assert compress_many(names + names) == expected + expected
+
+
+def test_compress_many_errors():
+    names = ["B.1.1.7", "B.9.9.9.9", "B.1.1.529.1"]
+    with pytest.raises(ValueError):
+        compress_many(names)
+    assert compress_many(names, errors="ignore") == ["B.1.1.7", None, "BA.1"]
+    with pytest.warns(UserWarning):
+        assert decompress_many(["ZZZ.1"], errors="warn") == [None]
@@ -1,8 +1,47 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
-from pyrocov.sarscov2 import nuc_mutations_to_aa_mutations
+import random
+
+import pyrocov.sarscov2
+import pyrocov.usher
+from pyrocov.sarscov2 import (
+    GENOME_LENGTH,
+    nuc_mutations_to_aa_mutations,
+    nuc_mutations_to_aa_mutations_batch,
+)
+from pyrocov.usher import Mutation, encode_mutations
+
+
+def parse_mutation(m):
+    return Mutation(int(m[1:-1]), m[0], m[-1])
 
 
 def test_nuc_to_aa():
     assert nuc_mutations_to_aa_mutations(["A23403G"]) == ["S:D614G"]
+
+
+def test_nuc_to_aa_batch(monkeypatch):
+    ref = "".join(random.choice("ACGT") for _ in range(GENOME_LENGTH))
+    monkeypatch.setattr(pyrocov.sarscov2, "REFERENCE_SEQ", ref)
+    monkeypatch.setattr(pyrocov.usher, "_REFS", {})
+    pyrocov.sarscov2._translate_codon.cache_clear()
+
+    mutation_sets = []
+    for _ in range(100):
+        positions = random.sample(range(1, GENOME_LENGTH + 1), 10)
+        ms = frozenset(f"{ref[p - 1]}{p}{random.choice('ACGT')}" for p in positions)
+        mutation_sets.append(ms)
+    mutation_sets += mutation_sets[:10]
+    mutation_sets += [
+        encode_mutations(parse_mutation(m) for m in ms) for ms in mutation_sets
+    ]
+    actual = nuc_mutations_to_aa_mutations_batch(mutation_sets)
+    assert len(actual) == len(mutation_sets)
+    for ms, aa_mutations in zip(mutation_sets, actual):
+        assert sorted(aa_mutations) == sorted(nuc_mutations_to_aa_mutations(ms))
+    for ms, codes in zip(mutation_sets[:110], mutation_sets[110:]):
+        assert sorted(nuc_mutations_to_aa_mutations(ms)) == sorted(
+            nuc_mutations_to_aa_mutations(codes)
+        )
+    pyrocov.sarscov2._translate_codon.cache_clear()
@@ -7,12 +7,126 @@ import random
 import tempfile
 from collections import defaultdict
 
+import numpy as np
+import pytest
+from Bio.Phylo.BaseTree import Clade, Tree
+from Bio.Phylo.NewickIO import Writer
+
 from pyrocov.align import PANGOLEARN_DATA
-from pyrocov.usher import prune_mutation_tree, refine_mutation_tree
+from pyrocov.external.usher import parsimony_pb2
+from pyrocov.fasta import ShardedFastaWriter
+from pyrocov.usher import (
+    apply_mutations,
+    apply_mutations_batch,
+    decode_mutations,
+    encode_mutations,
+    load_array_tree,
+    load_mutation_tree,
+    load_proto,
+    prune_mutation_tree,
+    prune_mutation_trees,
+    refine_mutation_tree,
+)
+
+# Reference nucleotides must be consistent across all test trees.
+REF_NUCS = [random.Random(0).randint(0, 3) for _ in range(101)]
+
+
+def make_proto(filename, num_nodes, seed=0):
+    """
+    Creates a random usher-style mutation tree with pango lineages.
+    """
+    rng = random.Random(seed)
+    clades = [Clade(name="node_0")]
+    for i in range(1, num_nodes):
+        clade = Clade(branch_length=float(rng.randint(0, 3)), name=f"node_{i}")
+        rng.choice(clades).clades.append(clade)
+        clades.append(clade)
+    for clade in clades:
+        if not clade.clades:
+            clade.name = clade.name.replace("node", "sample")
+    tree = Tree(root=clades[0])
+    proto = parsimony_pb2.data()
+    proto.newick = next(iter(Writer([tree]).to_strings()))
+    for i, clade in enumerate(tree.find_clades()):
+        meta = proto.metadata.add()
+        if i == 0:
+            meta.clade = "A"
+        elif rng.random() < 0.1:
+            meta.clade = f"A.{i}"
+        node = proto.node_mutations.add()
+        for _ in range(int(clade.branch_length or 0)):
+            mut = node.mutation.add()
+            mut.position = rng.randint(1, 100)
+            mut.ref_nuc = REF_NUCS[mut.position]
+            mut.par_nuc = mut.ref_nuc
+            mut.mut_nuc.append(rng.randint(0, 3))
+    with open(filename, "wb") as f:
+        f.write(proto.SerializeToString())
+
+
+@pytest.mark.parametrize("num_nodes", [1, 2, 100])
+def test_array_tree(num_nodes):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "tree.pb")
+        make_proto(filename, num_nodes)
+        proto, expected = load_proto(filename)
+        _, actual = load_array_tree(filename)
+        assert load_array_tree(filename)[1] is actual  # cached
+
+    clades = list(expected.find_clades())
+    assert len(actual) == len(clades)
+    assert actual.names == [c.name for c in clades]
+    clade_to_id = {c: i for i, c in enumerate(clades)}
+    for i, clade in enumerate(clades):
+        children = [clade_to_id[c] for c in clade.clades]
+        assert actual.get_children(i).tolist() == children
+        for c in children:
+            assert actual.parents[c] == i
+        if clade.branch_length is not None:
+            assert actual.branch_lengths[i] == clade.branch_length
+        mutations = [
+            (m.position, "ACGT"[m.ref_nuc], "".join("ACGT"[n] for n in m.mut_nuc))
+            for m in proto.node_mutations[i].mutation
+        ]
+        assert [tuple(m) for m in actual.get_mutations(i)] == mutations
+
+
+def test_load_mutation_tree():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "tree.pb")
+        make_proto(filename, 200)
+        actual = load_mutation_tree(filename)[0]
+        proto, tree = load_proto(filename)
+
+    # Compare to a naive computation.
+    clades = list(tree.find_clades())
+    parents = {c: p for p in clades for c in p.clades}
+    for clade, meta in zip(clades, proto.metadata):
+        if not meta.clade:
+            continue
+        path = [clade]
+        while path[-1] in parents:
+            path.append(parents[path[-1]])
+        muts = {}
+        for c in reversed(path):
+            for m in proto.node_mutations[clades.index(c)].mutation:
+                muts[m.position] = (m.position, "ACGT"[m.ref_nuc], "ACGT"[m.mut_nuc[0]])
+        assert set(map(tuple, actual[meta.clade])) == set(muts.values())
 
 
 def test_refine_prune():
-    filename1 = os.path.join(PANGOLEARN_DATA, "lineageTree.pb")
+    check_refine_prune(os.path.join(PANGOLEARN_DATA, "lineageTree.pb"), 10000)
+
+
+def test_refine_prune_synthetic():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "lineageTree.pb")
+        make_proto(filename, 500)
+        check_refine_prune(filename, 100)
+
+
+def check_refine_prune(filename1, max_num_nodes):
     with tempfile.TemporaryDirectory() as tmpdirname:
         filename2 = os.path.join(tmpdirname, "refinedTree.pb")
         filename3 = os.path.join(tmpdirname, "prunedTree.pb")
@@ -30,4 +144,113 @@ def test_refine_prune():
         weights = {fine: random.lognormvariate(0, 1) for fine in fine_to_coarse}
         for fine in coarse_to_fine.values():
             weights[fine] = math.inf
-        prune_mutation_tree(filename2, filename3, weights=weights, max_num_nodes=10000)
+        prune_mutation_tree(
+            filename2, filename3, weights=weights, max_num_nodes=max_num_nodes
+        )
+
+
+@pytest.mark.parametrize("max_num_nodes", [1, 10, 100, 500])
+def test_prune_mutation_tree(max_num_nodes):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename1 = os.path.join(tmpdirname, "tree.pb")
+        filename2 = os.path.join(tmpdirname, "pruned.pb")
+        make_proto(filename1, 300)
+        expected = load_mutation_tree(filename1)[0]
+        weights = {clade: random.choice([0, 1, math.inf]) for clade in expected}
+        weights["A"] = 0
+        clades = prune_mutation_tree(filename1, filename2, max_num_nodes, weights)
+        actual, proto, tree = load_mutation_tree(filename2)
+        _, bio_tree = load_proto(filename2)
+
+    assert len(tree) == min(300, max_num_nodes)
+    assert len(list(bio_tree.find_clades())) == len(tree)
+    assert set(actual) == clades
+    for clade, mutations in actual.items():
+        assert mutations == expected[clade]
+
+
+def test_prune_mutation_trees():
+    sizes = [500, 100, 30, 10]
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "tree.pb")
+        make_proto(filename, 300)
+        weights = {clade: random.random() for clade in load_mutation_tree(filename)[0]}
+
+        # Prune in a single pass.
+        filenames = {n: os.path.join(tmpdirname, f"multi.{n}.pb") for n in sizes}
+        actual = prune_mutation_trees(filename, filenames, weights)
+
+        # Prune separately.
+        for n in sizes:
+            filename_n = os.path.join(tmpdirname, f"single.{n}.pb")
+            expected = prune_mutation_tree(filename, filename_n, n, weights)
+            assert actual[n] == expected
+            with open(filenames[n], "rb") as f1, open(filename_n, "rb") as f2:
+                assert f1.read() == f2.read()
+
+
+def test_mutation_codes():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "tree.pb")
+        make_proto(filename, 200)
+        expected = load_mutation_tree(filename)[0]
+        actual = load_mutation_tree(filename, as_codes=True)[0]
+
+    ref = "".join("ACGT"[n] for n in REF_NUCS[1:])
+    assert set(actual) == set(expected)
+    for clade, codes in actual.items():
+        assert codes.dtype == np.int32
+        assert (codes[1:] > codes[:-1]).all()
+        assert decode_mutations(codes) == expected[clade]
+        assert np.array_equal(encode_mutations(expected[clade]), codes)
+        assert apply_mutations(ref, codes) == apply_mutations(ref, expected[clade])
+
+
+def test_mutation_codes_ambiguous():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "tree.pb")
+        make_proto(filename, 200)
+        proto = load_proto(filename)[0]
+        i = next(
+            i
+            for i, meta in enumerate(proto.metadata)
+            if meta.clade and proto.node_mutations[i].mutation
+        )
+        mut = proto.node_mutations[i].mutation[-1]
+        mut.mut_nuc.append((mut.mut_nuc[0] + 1) % 4)
+        with open(filename, "wb") as f:
+            f.write(proto.SerializeToString())
+        expected = load_mutation_tree(filename)[0]
+        actual = load_mutation_tree(filename, as_codes=True)[0]
+
+    assert any(len(m.mut) > 1 for ms in expected.values() for m in ms)
+    assert actual == expected
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_apply_mutations_batch(batch_size):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        filename = os.path.join(tmpdirname, "tree.pb")
+        make_proto(filename, 200)
+        mutations = load_mutation_tree(filename, as_codes=True)[0]
+        names = sorted(mutations)
+        codes = np.concatenate([mutations[name] for name in names])
+        offsets = np.cumsum([0] + [len(mutations[name]) for name in names])
+        ref = "".join("ACGT"[n] for n in REF_NUCS[1:])
+
+        actual = apply_mutations_batch(ref, codes, offsets)
+        assert actual.shape == (len(names), len(ref))
+        expected = [apply_mutations(ref, mutations[name]) for name in names]
+        assert [seq.tobytes().decode() for seq in actual] == expected
+
+        pattern = os.path.join(tmpdirname, "seqs.*.fasta")
+        with ShardedFastaWriter(pattern, max_count=50) as writer:
+            apply_mutations_batch(
+                ref, codes, offsets, writer=writer, names=names, batch_size=batch_size
+            )
+        lines = []
+        for i in range(math.ceil(len(names) / 50)):
+            with open(pattern.replace("*", str(i))) as f:
+                lines.extend(f.read().split())
+    assert lines[0::2] == [">" + name for name in names]
+    assert lines[1::2] == expected
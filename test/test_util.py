@@ -0,0 +1,89 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import gzip
+import os
+import tempfile
+
+import pytest
+
+from pyrocov.util import (
+    LRUCache,
+    gunzip_tempfile,
+    load_lru_caches,
+    read_lines,
+    save_lru_caches,
+    split_lines,
+)
+
+
+@pytest.mark.parametrize("num_chunks", [1, 2, 3, 10, 100])
+def test_split_lines(num_chunks):
+    lines = [f"{i}\t{'x' * (i % 7)}\n" for i in range(50)]
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, "data.tsv.gz")
+        with gzip.open(filename, "wt") as f:
+            f.writelines(lines)
+        with gunzip_tempfile(filename) as tempname:
+            begin = len(lines[0])
+            chunks = split_lines(tempname, num_chunks, begin)
+            assert len(chunks) <= num_chunks
+            actual = []
+            for b, e in chunks:
+                actual.extend(read_lines(tempname, b, e))
+        assert not os.path.exists(tempname)
+    assert actual == lines[1:]
+
+
+def test_lru_cache():
+    calls = []
+
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    cache = LRUCache(square, maxsize=2)
+    assert [cache(x) for x in [1, 2, 1, 3, 2]] == [1, 4, 1, 9, 4]
+    assert calls == [1, 2, 3, 2]  # 2 was evicted by 3
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert len(cache) == 2
+
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, "cache.pkl")
+        save_lru_caches(filename, {"square": cache})
+        warm = LRUCache(square, maxsize=2)
+        load_lru_caches(filename, {"square": warm})
+    assert warm(2) == 4 and warm(3) == 9
+    assert (warm.hits, warm.misses) == (2, 0)
+
+
+def test_lru_cache_version():
+    def square(x):
+        return x * x
+
+    cache = LRUCache(square, depends=[gzip])
+    assert cache.version == LRUCache(square, depends=[gzip]).version
+    assert cache.version != LRUCache(square).version
+    cache(2)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, "cache.pkl")
+        save_lru_caches(filename, {"square": cache})
+        stale = LRUCache(square)
+        load_lru_caches(filename, {"square": stale})
+        fresh = LRUCache(square, depends=[gzip])
+        load_lru_caches(filename, {"square": fresh})
+    assert len(stale) == 0
+    assert len(fresh) == 1
+
+
+def test_lru_cache_updates():
+    cache = LRUCache(abs)
+    cache(-1)
+    assert cache.pop_stats() == (0, 1, [])  # not recorded by default
+
+    cache.record_updates = True
+    cache(-1)
+    cache(-2)
+    assert cache.pop_stats() == (1, 1, [((-2,), 2)])
+    assert cache.pop_stats() == (0, 0, [])